@@ -0,0 +1,178 @@
+"""
+asyncio transport for the serial devices (SC10 shutter, RS232 controllers).
+
+A reader thread drains the port and hands the bytes to the event loop, so reads
+never block the loop (this also works with the Proactor loop on Windows, which
+has no add_reader for COM ports). Each request gets one future per expected
+response frame, frames are split on the device's terminator. Requests on one
+port are serialised with an asyncio.Lock, so coroutines can share a port.
+
+Devices with their own communication layer (pipython GCSDevice) can't be put on
+this transport, for those runSerialised runs the blocking call in a worker
+thread, serialised per device. The mixins at the end add async variants
+(setPositionAsync, moveAsync, setShutterAsync, ...) to the hardware classes.
+They match d35.utils.aio of the PyQt5 package, which these scripts don't import.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import serial
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncSerialTransport:
+    def __init__(self,ser,terminator=b'\r'):
+        """
+        ser is an open serial.Serial, terminator the byte string that ends a response frame
+        """
+        self.ser = ser
+        self.terminator = terminator
+        self._buffer = b''
+        self._pending = deque() # futures waiting for a frame, in order of the requests
+        self._lock = None
+        self._loop = None
+        self._thread = None
+        self._running = False
+
+    @classmethod
+    def open(cls,comport,baudrate=9600,terminator=b'\r',**kwargs):
+        ser = serial.Serial(comport,baudrate,timeout=0.05,parity=serial.PARITY_NONE,stopbits=serial.STOPBITS_ONE,bytesize=serial.EIGHTBITS,**kwargs)
+        return cls(ser,terminator)
+
+    async def start(self):
+        """ Start the reader, needs to be called from the event loop that will use the transport """
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        if self.ser.timeout is None or self.ser.timeout>0.1:
+            self.ser.timeout = 0.05 # keep the reader responsive to close()
+        self.ser.reset_input_buffer()
+        self._running = True
+        self._thread = threading.Thread(target=self._reader,daemon=True)
+        self._thread.start()
+        return self
+
+    def _reader(self):
+        while self._running:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except serial.SerialException as e:
+                self._loop.call_soon_threadsafe(self._fail,e)
+                return
+            if data:
+                self._loop.call_soon_threadsafe(self._feed,data)
+
+    def _feed(self,data):
+        self._buffer += data
+        while True:
+            idx = self._buffer.find(self.terminator)
+            if idx<0:
+                return
+            end = idx+len(self.terminator)
+            frame, self._buffer = self._buffer[:end], self._buffer[end:]
+            while self._pending and self._pending[0].done():
+                self._pending.popleft() # cancelled by a timeout
+            if self._pending:
+                self._pending.popleft().set_result(frame)
+            else:
+                logger.debug("Dropping unsolicited frame {!r}".format(frame))
+
+    def _fail(self,error):
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def request(self,payload,responses=1,timeout=1.0):
+        """
+        writes payload and returns the list of the next responses frames, raises asyncio.TimeoutError
+        """
+        async with self._lock:
+            futures = [self._loop.create_future() for _ in range(responses)]
+            self._pending.extend(futures)
+            self.ser.write(payload)
+            try:
+                return await asyncio.wait_for(asyncio.gather(*futures),timeout)
+            except asyncio.TimeoutError:
+                # drop whatever is left of this exchange so the next request starts clean
+                for future in futures:
+                    future.cancel()
+                self._buffer = b''
+                raise
+
+    async def close(self):
+        self._running = False
+        if self._thread is not None:
+            await self._loop.run_in_executor(None,self._thread.join)
+        self.ser.close()
+
+
+async def runSerialised(lock,func,*args,**kwargs):
+    """
+    runs the blocking func in a worker thread while holding the device's asyncio.Lock
+    """
+    async with lock:
+        return await asyncio.get_running_loop().run_in_executor(None,lambda: func(*args,**kwargs))
+
+
+class AsyncDeviceMixin:
+    """
+    async variants run the blocking calls in a worker thread, one call per device at a time
+    """
+    _asyncLock = None
+
+    def runAsync(self,func,*args,**kwargs):
+        if self._asyncLock is None:
+            self._asyncLock = asyncio.Lock()
+        return runSerialised(self._asyncLock,func,*args,**kwargs)
+
+
+class AsyncStageMixin(AsyncDeviceMixin):
+    async def getPositionAsync(self):
+        return await self.runAsync(self.getPosition)
+
+    async def setPositionAsync(self,position,**kwargs):
+        return await self.runAsync(self.setPosition,position,**kwargs)
+
+    async def isOnTargetAsync(self):
+        return await self.runAsync(self.isOnTarget)
+
+    async def waitOnTargetAsync(self,timeout=None,poll=0.01):
+        """
+        polls the on-target state without blocking the event loop, raises TimeoutError
+        """
+        start = time.perf_counter()
+        while not await self.isOnTargetAsync():
+            if timeout is not None and time.perf_counter()-start>timeout:
+                raise TimeoutError
+            await asyncio.sleep(poll)
+        return True
+
+    async def moveAsync(self,position,timeout=None,poll=0.01,**kwargs):
+        await self.setPositionAsync(position,**kwargs)
+        return await self.waitOnTargetAsync(timeout,poll)
+
+
+class AsyncShutterMixin(AsyncDeviceMixin):
+    async def getShutterAsync(self):
+        return await self.runAsync(self.getShutter)
+
+    async def setShutterAsync(self,state=False,timeout=1000,poll=0.005):
+        """
+        same timeout semantics (ms) as setShutter, waiting doesn't block the event loop
+        """
+        await self.runAsync(self.setShutter,state,timeout=0)
+        if timeout == 0:
+            return
+        if self._pending is None and self._shadowShutter is state:
+            return state # request was coalesced, the shadow state is confirmed
+        start = time.perf_counter()
+        while await self.runAsync(self._queryState) is not state:
+            if timeout>=0 and (time.perf_counter()-start)>(timeout/1000.):
+                raise TimeoutError
+            await asyncio.sleep(poll)
+        self._confirm(state)
+        return state
@@ -470,7 +470,7 @@ def OpenShutter(state, addr = 0):
 # Result:   Bool                success true/false
 def SyncOutput(syncHigh, addr = 0):
     # referring to DLL function
-    geFunc = greateyesDLL.OpenShutter
+    geFunc = greateyesDLL.SyncOutput
     geFunc.restype = ctypes.c_bool
 
     # casting arguments
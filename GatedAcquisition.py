@@ -0,0 +1,101 @@
+"""
+Hardware gated pump on/off acquisition with the greateyes camera and the SC10.
+
+The SC10 is put in external gate mode (mode=5), it opens while its trigger
+input is high. The input is driven by one of the camera's TTL outputs:
+    output="shutter"  the shutter output, high during exposure with the lead and
+                      lag times set by SetShutterTimings (use the SC10 open time)
+    output="sync"     the sync output, high during exposure only
+Whether a frame is pumped is chosen with the showShutter/showSync flag of
+StartMeasurement_DynBitDepth, so on/off alternation needs no serial traffic and
+runs at the camera frame rate. The serial connection is only used to switch the
+SC10 mode when entering and leaving the gated mode.
+"""
+import time
+
+import numpy as np
+
+import CameraSystem
+from sc10 import SC10
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class GatedAcquisition:
+    OUTPUTS = ("shutter","sync")
+
+    def __init__(self,shutter,output="shutter",open_time=10,close_time=10,timeout=30.,addr=0):
+        """
+        shutter is an SC10 or a ThorlabsShutterHardware holding one,
+        open_time/close_time in ms are the lead and lag of the shutter output
+        """
+        if output not in self.OUTPUTS:
+            raise ValueError("output has to be one of {}".format(self.OUTPUTS))
+        self.sc10 = getattr(shutter,'_dev',shutter)
+        self.output = output
+        self.open_time = open_time
+        self.close_time = close_time
+        self.timeout = timeout # s, per frame
+        self.addr = addr
+        self._mode = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def start(self):
+        """
+        prepares the camera outputs and switches the SC10 to external gate mode
+        """
+        if self.output == "shutter":
+            CameraSystem.SetShutterTimings(self.open_time,self.close_time,self.addr)
+            CameraSystem.OpenShutter(2,self.addr) # automatic, TTL high during measurements with showShutter
+        else:
+            CameraSystem.OpenShutter(0,self.addr)
+        CameraSystem.SyncOutput(False,self.addr)
+        self._mode = self.sc10.mode
+        self.sc10.setMode(SC10.MODE_EXTERNAL)
+        logger.info("Gated acquisition on the {} output".format(self.output))
+
+    def stop(self):
+        """
+        leaves the outputs low and restores the previous SC10 mode
+        """
+        CameraSystem.OpenShutter(0,self.addr)
+        CameraSystem.SyncOutput(False,self.addr)
+        if self._mode is not None:
+            self.sc10.setMode(self._mode)
+            self._mode = None
+
+    def acquire(self,pump,wait_function=None):
+        """
+        takes one frame, the SC10 opens during the exposure if pump is set
+        """
+        if self.output == "shutter":
+            flags = dict(showSync=False,showShutter=bool(pump))
+        else:
+            flags = dict(showSync=bool(pump),showShutter=False)
+        if not CameraSystem.StartMeasurement_DynBitDepth(addr=self.addr,**flags):
+            raise IOError("Could not start measurement: {}".format(CameraSystem.StatusMSG))
+        start = time.perf_counter()
+        while CameraSystem.DllIsBusy(self.addr):
+            if time.perf_counter()-start>self.timeout:
+                CameraSystem.StopMeasurement(self.addr)
+                raise TimeoutError("No frame within {} s".format(self.timeout))
+            if wait_function is not None:
+                wait_function()
+        return CameraSystem.GetMeasurementData_DynBitDepth(self.addr)
+
+    def acquireOnOff(self,pairs,wait_function=None):
+        """
+        alternates pumped and unpumped frames, returns the (on, off) stacks
+        """
+        on, off = [], []
+        for _ in range(pairs):
+            on.append(self.acquire(True,wait_function))
+            off.append(self.acquire(False,wait_function))
+        return np.array(on), np.array(off)
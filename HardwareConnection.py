@@ -6,13 +6,16 @@ import logging
 
 
 import time
+import threading
 from Reference import ShutterWidget, ClosedLoopStageWidget
-import serial
+from sc10 import SC10
+from AsyncSerial import AsyncStageMixin, AsyncShutterMixin
+from ShadowState import ShadowState, ShutterStateError
 
 #logger name?
 logger = logging.getLogger(__name__)
 
-class PIStageHardware(QtCore.QObject):
+class PIStageHardware(AsyncStageMixin,QtCore.QObject):
     signalDeviceConnect = QtCore.pyqtSignal()
     signalDeviceDisconnected = QtCore.pyqtSignal()
     newSetpoint = QtCore.pyqtSignal(float)
@@ -215,31 +218,50 @@ class PIStageWidget(ClosedLoopStageWidget):
             self.handleError(e)
 
 
-class ThorlabsShutterHardware(QtCore.QObject):
+class ThorlabsShutterHardware(AsyncShutterMixin,QtCore.QObject):
+    """ SC10 shutter with a shadow state. After a confirmed transition the shadow
+    state is trusted for validity seconds, repeated requests for the same state are
+    coalesced and getShutter doesn't touch the serial port. A background thread
+    verifies the state every verify_interval seconds and renews the window, a
+    disagreement is emitted by stateMismatch and raised by the next call. The state
+    machine is ShadowState.ShadowState, guarded by the device lock. """
     signalOpenedShutter = QtCore.pyqtSignal()
     signalClosedShutter = QtCore.pyqtSignal()
     signalDeviceConnect = QtCore.pyqtSignal()
     signalDeviceDisconnected = QtCore.pyqtSignal()
+    stateMismatch = QtCore.pyqtSignal(bool) # state reported by the hardware
 
-    def __init__(self):
+    def __init__(self,validity=1.0,verify_interval=2.0):
         super().__init__()
-        self._shadowShutter = None # Local copy of desired state
+        self.verify_interval = verify_interval # s, 0 disables the background verification
+        # The verifier thread and the GUI share the port and the shadow state
+        self._lock = threading.RLock()
+        self.shadow = ShadowState(validity,lock=self._lock)
+        self._verifier = None
+        self._stopVerifier = threading.Event()
 
 	## changed to accomodate SC10, true if shutter is open 
     def _queryState(self):
-        jump = self._dev.write('ens?\r'.encode())
-        self._dev.read(size=jump)
-        res = self._dev.read()
-        self._dev.read(size=3)
-        if  res == b'1':
-            return True
-        elif res == b'0':
-            return False       
+        with self._lock:
+            return self._dev.qopenShutter()
 
     def _emitSignal(self, state):
         if state: self.signalOpenedShutter.emit() 
         else: self.signalClosedShutter.emit()
 
+    # read by the async variants of AsyncSerial
+    _pending = property(lambda self: self.shadow.pending)
+    _shadowShutter = property(lambda self: self.shadow.state)
+    coalesced = property(lambda self: self.shadow.coalesced)
+
+    def _confirm(self,state,emit=True):
+        if self.shadow.confirm(state) or emit:
+            self._emitSignal(state)
+
+    def latencyStatistics(self):
+        """ Round trip statistics of the shutter commands in ms """
+        return self._dev.latencyStatistics()
+
     #### changed to comport, set default baud rate to 9600 but could consider increasing through terminal. 
     def open(self,comport=None,baud=9600):
         if comport is None:
@@ -249,54 +271,90 @@ class ThorlabsShutterHardware(QtCore.QObject):
                 # Could try to connect to the first shutter we can find
                 # But for now let's give up
                 raise
-        self._dev = serial.Serial(comport,baud,timeout=1,parity=serial.PARITY_NONE,stopbits=serial.STOPBITS_ONE,bytesize=serial.EIGHTBITS)
 	## sets mode to manual
-        jump = self._dev.write("mode=1\r".encode())
-        self._dev.read(size=jump+2)
+        self._dev = SC10(comport,baud,mode=SC10.MODE_MANUAL)
         self.signalDeviceConnect.emit()
-        self._shadowShutter = self.getShutter(forceEmit=True)
+        self.getShutter(forceEmit=True)
+        if self.verify_interval>0:
+            self._stopVerifier.clear()
+            self._verifier = threading.Thread(target=self._verify,daemon=True)
+            self._verifier.start()
 	## deal with this safety feature later 
 	#if self._queryState():
            # self._dev.setShutter(False)     
     
     ### changed already 
     def close(self):
-        self._dev.close()
+        self._stopVerifier.set()
+        if self._verifier is not None:
+            self._verifier.join()
+            self._verifier = None
+        self._dev.shutdown()
 
     def setShutter(self,state=False,timeout=1000):
         """ Open or close the shutter, shutter will open if state is set to true. 
         If timeout is 0, will not check if shutter movement completed.
         If timeout is <0 will wait until shutter movement completed
         If timeout is >0 will wait value in ms for shutter to movement to complete or raise TimeoutError """
-        # If the state of the shutter doesn't match the set state, it toggles the shutter. 
-        if self._queryState() != state:
-            jump = self._dev.write('ens\r'.encode())
-            self._dev.read(size=jump+2)
+        self.shadow.checkMismatch()
+        state = bool(state)
+        with self._lock:
+            if self.shadow.needsCommand(state):
+                # The driver toggles and confirms the new state in the same exchange.
+                self.shadow.commanded(state)
+                self._dev.setShutter(state)
+                self.shadow.confirm(state)
+                confirmed = True
+            else:
+                confirmed = False
+        if confirmed:
+            self._emitSignal(state)
         #self._dev.send_comm(0x04CB,0x00,0x01 if state else 0x02)
         if timeout != 0:
-            return self.waitOnShutter(state,timeout)
+            return state
 
 
     def waitOnShutter(self,state: bool,timeout=1000):
         """ Wait until shutter reports complete opening """
+        if self.shadow.holds(state):
+            return state
         start = time.time()
-        while self._queryState() is not state:
+        while self._dev.isOpen() is not state:
             QtWidgets.QApplication.processEvents()
             if timeout>=0 and (time.time()-start)>(timeout/1000.):
                 raise TimeoutError
-        self._shadowShutter = state
-        self._emitSignal(state)
+        self._confirm(state)
         return state
 
     def getShutter(self,forceEmit=False):
         """ Query the state of the shutter, return true if shutter is open """
-        # As per Thorlabs Doc, Req SOL is 0x04CC
-        state = self._queryState()
-        if state is not self._shadowShutter or forceEmit:
+        self.shadow.checkMismatch()
+        with self._lock:
+            if not forceEmit and self.shadow.valid():
+                return self.shadow.state
+            # Local state of the driver, verified with the controller every verify_interval
+            state = self._dev.isOpen()
+            previous = self.shadow.state
+            confirmed = self.shadow.observed(state)
+        if confirmed and (forceEmit or state is not previous):
             self._emitSignal(state)
-            self._shadowShutter = state
         return state
 
+    def _verify(self):
+        while not self._stopVerifier.wait(self.verify_interval):
+            try:
+                with self._lock:
+                    previous = self.shadow.state
+                    error = self.shadow.verify(self._queryState)
+                    state = self.shadow.state
+            except Exception:
+                logger.exception("Shutter verification failed:")
+                continue
+            if error is not None:
+                self.stateMismatch.emit(state)
+            elif state is not previous:
+                self._emitSignal(state)
+
 class ThorlabsShutterWidget(ShutterWidget):
     def __init__(self,device=None,parent=None):
         if device is None:
@@ -318,4 +376,7 @@ class ThorlabsShutterWidget(ShutterWidget):
         self._dev.setShutter(False)
 
     def _update(self):
-        self._dev.getShutter()
\ No newline at end of file
+        try:
+            self._dev.getShutter()
+        except ShutterStateError:
+            logger.exception("Shutter state mismatch:")
\ No newline at end of file
@@ -1,64 +1,7 @@
-import serial
+from sc10 import SC10, SC10Error
 #originally named SC10
-class Shutter:
-    def __init__(self,comport='COM9'):
-        """
-        Initialized hardware with a closed shutter
-        """
-        self.ser = serial.Serial(comport,9600,timeout=1,parity=serial.PARITY_NONE,stopbits=serial.STOPBITS_ONE,bytesize=serial.EIGHTBITS)
-        jump = self.ser.write("mode=0\r".encode())
-        self.ser.read(size=jump+2)
-        # if self.qopenShutter():
-        #    self.toggleShutter()
-        
-    def toggleShutter(self):
-        """
-        toggles the state of the shutter
-        """
-        jump = self.ser.write('ens\r'.encode())
-        self.ser.read(size=jump+2)
-        
-    def qopenShutter(self):
-        """
-        Checks if shutter is open
-        """
-        jump = self.ser.write('ens?\r'.encode())
-        # print(jump)
-        self.ser.read(size=jump)
-        res = self.ser.read()
-        self.ser.read(size=3)
-        res = b'1'
-        if  res == b'1':
-            return True
-        elif res == b'0':
-            return False
-        else:
-            print('Something\'s amiss, closing serial connection...')
-            self.shutdown()
-    
-    def qcloseShutter(self):
-        """
-        checks if shutter is closed
-        """
-        return not self.qopenShutter()
-    
-    def openShutter(self):
-        """
-        opens shutter, if closed
-        """
-        if not self.qopenShutter():
-            self.toggleShutter()
-    
-    def closeShutter(self):
-        """
-        closes shutter if opened
-        """
-        if self.qopenShutter():
-            self.toggleShutter()
-        
-    def shutdown(self):
-        """
-        closes the serial connection. MUST EXICUTED BEFORE CALLING ANOTHER 
-        INSTANCE OF THIS CLASS, otherwise you need restart your kernel.
-        """
-        self.ser.close()
\ No newline at end of file
+class Shutter(SC10):
+    """
+    Kept for scripts importing Shutter, the protocol is implemented in sc10.SC10
+    """
+    pass
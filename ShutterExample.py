@@ -13,3 +13,20 @@ bb.toggleShutter()
 print('Shutter Closed? '+str(bb.qcloseShutter()))
 
 
+
+# Hardware gated pump on/off frames, see GatedAcquisition.py.
+# The SC10 trigger input has to be wired to the camera's shutter output.
+import numpy
+import CameraSystem
+from GatedAcquisition import GatedAcquisition
+
+CameraSystem.SetupCameraInterface()
+CameraSystem.ConnectCamera()
+CameraSystem.InitCamera()
+CameraSystem.SetExposure(10)
+with GatedAcquisition(bb,output="shutter",open_time=10,close_time=10) as gated:
+    on, off = gated.acquireOnOff(5)
+print('Pumped frames: '+str(on.shape)+', unpumped frames: '+str(off.shape))
+print('Mean on-off difference: '+str(numpy.mean(on.astype(float)-off)))
+CameraSystem.DisconnectCamera()
+bb.shutdown()
@@ -0,0 +1,135 @@
+"""
+Frame count policies for the scan engine.
+
+Without a policy every point of a plan is taken once. A policy groups the
+points that differ only in its axis (e.g. pump on and off at one delay) and is
+asked after every complete group whether to take the group again. The
+executor averages repeated frames per point and stores the number of frames in
+<dataset>_frames.
+
+SNRPolicy repeats a delay until the pump-probe signal
+    dOD = -log10(on/off)
+averaged over a pixel roi reaches target_snr (mean over its standard error),
+or until max_frames pairs were taken. Points with a large contrast are done
+after min_frames, noisy ones get more frames.
+"""
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Welford(object):
+    """ Running mean and variance. """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self,value):
+        self.n += 1
+        delta = value-self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(value-self.mean)
+
+    @property
+    def variance(self):
+        return self.m2/(self.n-1) if self.n>1 else np.inf
+
+    @property
+    def stderr(self):
+        return np.sqrt(self.variance/self.n) if self.n>1 else np.inf
+
+
+class FramePolicy(object):
+    """ Base class, takes every group once. axis is the name of the innermost
+    plan axis whose points form a group. """
+
+    def __init__(self,axis):
+        self.axis = axis
+
+    def bind(self,plan):
+        """ Called by ScanPlan, the policy axis has to be the innermost. """
+        names = [axis.name for axis in plan.axes]
+        if names[-1] != self.axis:
+            raise ValueError("Policy axis {} has to be the innermost axis of {}".format(self.axis,plan.name))
+        self._last = plan.axes[-1].order[-1]
+
+    def key(self,index):
+        return index[:-1]
+
+    def groupEnd(self,index):
+        """ True if index is the last point of its group. """
+        return index[-1] == self._last
+
+    def add(self,index,result):
+        pass
+
+    def more(self,key):
+        return False
+
+
+class SNRPolicy(FramePolicy):
+    """ Repeat the on/off pair of a delay until the dOD reaches target_snr, see
+    module doc. on and off are the indices of the states on the axis, roi the
+    pixel range (start, stop) of the signal. """
+
+    def __init__(self,target_snr,max_frames=20,min_frames=3,axis="pump",on=0,off=1,roi=None):
+        super().__init__(axis)
+        self.target_snr = target_snr
+        self.max_frames = max_frames
+        self.min_frames = max(2,min_frames)
+        self.on = on
+        self.off = off
+        self.roi = roi
+        self.stats = dict() # key -> Welford of dOD
+        self._pair = dict() # key -> {state index: roi mean} of the current repeat
+        self._repeats = dict() # key -> groups taken, also counts failed frames
+
+    def _roiMean(self,result):
+        result = np.asarray(result,dtype=np.double)
+        if self.roi is not None:
+            result = result[...,self.roi[0]:self.roi[1]]
+        return float(np.mean(result))
+
+    def add(self,index,result):
+        if result is None:
+            return
+        key = self.key(index)
+        pair = self._pair.setdefault(key,dict())
+        pair[index[-1]] = self._roiMean(result)
+        if self.on in pair and self.off in pair:
+            on, off = pair.pop(self.on), pair.pop(self.off)
+            if on>0 and off>0:
+                self.stats.setdefault(key,Welford()).add(-np.log10(on/off))
+
+    def snr(self,key):
+        stats = self.stats.get(key)
+        if stats is None or stats.n<2:
+            return 0.
+        if stats.stderr == 0:
+            return np.inf
+        return abs(stats.mean)/stats.stderr
+
+    def more(self,key):
+        stats = self.stats.get(key)
+        n = 0 if stats is None else stats.n
+        self._repeats[key] = self._repeats.get(key,0)+1
+        if self._repeats[key]>=self.max_frames:
+            n = max(n,self.max_frames) # no frames at all, don't try forever
+        if n<self.min_frames:
+            return True
+        if n>=self.max_frames:
+            logger.debug("{}: cap of {} frames reached at SNR {:.1f}".format(key,self.max_frames,self.snr(key)))
+            return False
+        return self.snr(key)<self.target_snr
+
+    def summary(self):
+        """ Frames and SNR over all groups. """
+        n = np.array([stats.n for stats in self.stats.values()])
+        snr = np.array([self.snr(key) for key in self.stats])
+        if not len(n):
+            return dict(groups=0)
+        return dict(groups=len(n),frames=int(n.sum()),mean_frames=float(n.mean()),capped=int(np.sum(n>=self.max_frames)),
+            median_snr=float(np.median(snr)))
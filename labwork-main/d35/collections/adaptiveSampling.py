@@ -0,0 +1,177 @@
+"""
+Adaptive delay sampling for gas transients.
+
+A uniform delay grid spends most of the time far from time zero, where the
+cross-correlation is flat. The AdaptiveDelaySampler first takes a coarse pass
+over the full range, then places the remaining points in batches where they
+help most, until the time budget is used up:
+    - if the trace can be fitted (utils/fitting.py), where the model is most
+      sensitive to t0 and FWHM, i.e. where a point reduces their uncertainty
+      the most
+    - otherwise where the gradient of the measured trace is largest
+Points are picked from the fine grid (step), a delay already measured counts
+less with every repeat, so steep regions get more points and repeats without
+starving the rest.
+
+    sampler = AdaptiveDelaySampler(5,15,0.1,budget=300)
+    batch = sampler.coarse()
+    while batch is not None:
+        spectra = ...take a spectrum at every delay of batch...
+        sampler.update(batch,spectra)
+        batch = sampler.nextBatch()
+    delays, mean, counts = sampler.trace()
+"""
+import time
+
+import numpy as np
+
+from ..utils.fitting import fitGasTransient, gaussMod, FS_PER_UNIT
+from ..utils.motion import DEFAULT_MOTION_MODEL
+from .scanOrder import estimateScanTime
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def spectrumSignal(spectrum,roi=None):
+    """ Scalar signal of a spectrum, mean log10 intensity over the pixel roi (start, stop). """
+    spectrum = np.asarray(spectrum,dtype=np.double)
+    if roi is not None:
+        spectrum = spectrum[...,roi[0]:roi[1]]
+    return np.mean(np.log10(np.clip(spectrum,1,None)),axis=-1)
+
+
+class AdaptiveDelaySampler(object):
+    """ Chooses the delays of a gas transient, see module doc. budget in s
+    includes the coarse pass and the fits, point_time is the estimated acquisition time per
+    point in s (refined from the batches), stage moves are estimated with model. """
+
+    def __init__(self,start,stop,step,budget,coarse_step=None,batch=None,point_time=0.1,roi=None,model=DEFAULT_MOTION_MODEL,clock=time.perf_counter):
+        self.grid = np.arange(start,stop,step) # candidate delays
+        if coarse_step is None:
+            coarse_step = step*max(1,len(self.grid)//20)
+        self.coarse_grid = np.arange(start,stop,coarse_step)
+        self.batch = max(4,len(self.coarse_grid)//2) if batch is None else batch
+        self.budget = budget
+        self.point_time = point_time
+        self.roi = roi
+        self.model = model
+        self.clock = clock # simulated scans pass their own clock
+        self.delays = [] # all measured delays, in acquisition order
+        self.spectra = []
+        self.signal = []
+        self.report = None # last fit
+        self.fit_time = 0. # s the last fit and scoring took, counted against the budget
+        self._started = None
+        self._position = None
+
+    def coarse(self):
+        """ First batch, the coarse grid over the full range. """
+        self._started = self.clock()
+        return self.coarse_grid.copy()
+
+    @property
+    def elapsed(self):
+        return 0. if self._started is None else self.clock()-self._started
+
+    def update(self,delays,spectra,duration=None):
+        """ Add the spectra taken at delays, duration (s) of the batch refines point_time. """
+        delays = np.asarray(delays,dtype=np.double)
+        spectra = np.asarray(spectra)
+        if duration is not None and len(delays):
+            # the moves are predicted by the motion model, point_time is the rest
+            travel, move_time = estimateScanTime(delays,np.arange(len(delays)),self.model,start=self._position)
+            self.point_time = max(duration-move_time,0.)/len(delays)
+        self.delays.extend(delays)
+        self.spectra.extend(spectra)
+        self.signal.extend(spectrumSignal(spectra,self.roi))
+        if len(delays):
+            self._position = delays[-1]
+
+    def _gridIndex(self,delays):
+        return np.clip(np.searchsorted(self.grid,np.asarray(delays)-1e-9),0,len(self.grid)-1)
+
+    def counts(self):
+        """ Number of points taken per grid delay. """
+        return np.bincount(self._gridIndex(self.delays),minlength=len(self.grid))
+
+    def trace(self):
+        """ Unique measured delays, mean signal and number of points per delay. """
+        delays, inverse, counts = np.unique(np.round(self.delays,9),return_inverse=True,return_counts=True)
+        mean = np.bincount(inverse,weights=self.signal)/counts
+        return delays, mean, counts
+
+    def averagedSpectra(self):
+        """ Unique delays and the mean spectrum per delay. """
+        delays, inverse, counts = np.unique(np.round(self.delays,9),return_inverse=True,return_counts=True)
+        spectra = np.zeros((len(delays),)+np.shape(self.spectra[0]))
+        np.add.at(spectra,inverse,np.asarray(self.spectra,dtype=np.double))
+        return delays, (spectra.T/counts).T
+
+    def fit(self):
+        delays, mean, counts = self.trace()
+        if len(delays)<6:
+            return None
+        report = fitGasTransient(delays,mean-np.median(mean))
+        if report["opt"] is None or not np.all(np.isfinite(report["err"])):
+            return None
+        self.report = report
+        return report
+
+    def scores(self):
+        """ Value of one more point at every grid delay. """
+        report = self.fit()
+        x = self.grid*FS_PER_UNIT
+        if report is not None:
+            opt = np.array(report["opt"],dtype=np.double)
+            score = np.zeros(len(x))
+            for n in (0,1): # t0 and FWHM
+                dp = np.zeros(len(opt))
+                dp[n] = max(1e-3,1e-2*abs(opt[1]))
+                sensitivity = np.abs(gaussMod(x,*(opt+dp))-gaussMod(x,*(opt-dp)))
+                if np.max(sensitivity)>0:
+                    score += sensitivity/np.max(sensitivity)
+        else:
+            delays, mean, counts = self.trace()
+            if len(delays)<2:
+                return np.ones(len(x))
+            gradient = np.abs(np.gradient(mean,delays))
+            score = np.interp(self.grid,delays,gradient)
+            if np.max(score)>0:
+                score = score/np.max(score)
+        # keep a floor so the flat parts get the odd point
+        return (score+0.05)/(1+self.counts())
+
+    def _affordable(self,n,fit_time=0.):
+        """ Number of points, at most n, that fit into the remaining budget after a fit of fit_time s. """
+        remaining = self.budget-self.elapsed-fit_time
+        return min(n,int(remaining/max(self.point_time,1e-3)))
+
+    def nextBatch(self):
+        """ Next delays to take, sorted for short stage travel, or None if the budget is used up.
+        The time of the fit is counted, the batch is shortened to fit the remaining budget. """
+        n = self._affordable(self.batch,self.fit_time) # expect the fit to take as long as the last one
+        if n<1:
+            return None
+        start = self.clock()
+        score = self.scores()
+        self.fit_time = self.clock()-start
+        n = self._affordable(n)
+        if n<1:
+            return None
+        counts = np.zeros(len(self.grid))
+        picked = []
+        for _ in range(n):
+            k = int(np.argmax(score/(1+counts)))
+            picked.append(k)
+            counts[k] += 1
+        delays = np.sort(self.grid[picked])
+        # walk the batch from the end nearer to the stage
+        if self._position is not None and abs(self._position-delays[-1])<abs(self._position-delays[0]):
+            delays = delays[::-1]
+        while len(delays):
+            travel, move_time = estimateScanTime(delays,np.arange(len(delays)),self.model,start=self._position)
+            if self.elapsed+move_time+len(delays)*self.point_time<=self.budget:
+                return delays
+            delays = delays[:len(delays)//2]
+        return None
@@ -0,0 +1,177 @@
+"""
+Online average over repeated transient scans.
+
+Every iteration of a TransientSession measures the same delays again. The
+ScanAggregator keeps the running mean and variance (Welford) of the pump on
+and pump off spectra and of
+    dOD = -log10((on-bg_on)/(off-bg_off))
+per delay and pixel, adding one scan at a time, so the average is always up to
+date and never needs all scans in memory. Points a scan didn't take (aborted
+scan, failed frames) are skipped, counts holds the number of scans per point.
+
+After every scan the convergence is noted:
+    noise   median standard error of the dOD mean over the pixel roi
+    change  rms change of the dOD mean by the last scan
+With white noise the noise falls as 1/sqrt(scans), once it flattens more scans
+don't help. The session stops by itself when noise reaches target_noise.
+
+The average is written to one SWMR file (see utils/streamWriter.py) next to
+the scans, updated after every scan:
+    mean/on, mean/off, mean/dOD, variance/..., counts  (delays, width)
+    convergence/scans, convergence/noise, convergence/change
+ConvergenceView (convergenceView.py) shows it live.
+
+    aggregator = ScanAggregator(delays,geometry.columns,path,backgrounds=(bg_off,bg_on))
+    aggregator.addFile(scan_file)
+    if aggregator.converged(): ...
+"""
+import h5py
+import numpy as np
+
+from ..utils.streamWriter import StreamWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+KEYS = ("on","off","dOD")
+
+
+def deltaOD(on,off,backgrounds=None):
+    """ -log10(on/off) after subtracting the backgrounds (off, on), NaN where undefined. """
+    on = np.asarray(on,dtype=np.double)
+    off = np.asarray(off,dtype=np.double)
+    if backgrounds is not None:
+        off = off-backgrounds[0]
+        on = on-backgrounds[1]
+    with np.errstate(divide="ignore",invalid="ignore"):
+        dOD = -np.log10(on/off)
+    dOD[(on<=0)|(off<=0)] = np.nan
+    return dOD
+
+
+class ScanAggregator(object):
+    """ Running average of repeated scans, see module doc. delays is the delay
+    axis, width the number of pixels, backgrounds (off, on) spectra or frames
+    (averaged) subtracted for the dOD, roi the pixel range (start, stop) of the
+    convergence numbers, x_axis the chip column of the pixels (see
+    utils/frameGeometry.py). Without path nothing is written. """
+
+    def __init__(self,delays,width,path=None,backgrounds=None,roi=None,target_noise=None,min_scans=3,x_axis=None):
+        self.delays = np.asarray(delays)
+        self.shape = (len(self.delays),width)
+        self.x_axis = np.arange(width) if x_axis is None else np.asarray(x_axis)
+        if backgrounds is not None:
+            backgrounds = tuple(np.mean(np.atleast_2d(bg),axis=0) for bg in backgrounds)
+        self.backgrounds = backgrounds
+        self.roi = roi
+        self.target_noise = target_noise
+        self.min_scans = min_scans
+        self.scans = 0
+        self.counts = {key: np.zeros(self.shape,dtype=np.int32) for key in KEYS}
+        self.mean = {key: np.zeros(self.shape) for key in KEYS}
+        self._m2 = {key: np.zeros(self.shape) for key in KEYS}
+        self.history = dict(scans=[],noise=[],change=[])
+        self.stop_requested = False # set by the operator, e.g. in the ConvergenceView
+        self.onUpdate = [] # called with the aggregator after every scan
+        self.writer = None
+        if path is not None:
+            self._openFile(path)
+
+    def _openFile(self,path):
+        # derived from the scan files, so a resumed session writes it again
+        self.writer = StreamWriter(path,mode="w",swmr=True)
+        attrs = dict(delays=self.delays,x_axis=self.x_axis)
+        for key in KEYS:
+            self.writer.createDataset("mean/"+key,self.shape[1:],grid=self.shape[:1],fillvalue=np.nan,attrs=attrs)
+            self.writer.createDataset("variance/"+key,self.shape[1:],grid=self.shape[:1],fillvalue=np.nan,attrs=attrs)
+        self.writer.createDataset("counts",self.shape[1:],grid=self.shape[:1],dtype=np.int32,attrs=attrs)
+        for key in self.history:
+            self.writer.createDataset("convergence/"+key,(),dtype=np.int32 if key == "scans" else np.double)
+        if self.roi is not None:
+            self.writer.setAttrs("/",roi=self.roi)
+        self.writer.startSWMR()
+        logger.info("Averaging scans in {}".format(path))
+
+    def _update(self,key,value):
+        valid = np.isfinite(value)
+        n = self.counts[key]
+        n += valid
+        mean = self.mean[key]
+        delta = np.where(valid,value-mean,0)
+        mean += np.divide(delta,n,out=np.zeros(self.shape),where=n>0)
+        self._m2[key] += delta*np.where(valid,value-mean,0)
+
+    def variance(self,key="dOD"):
+        n = self.counts[key]
+        return np.divide(self._m2[key],n-1,out=np.full(self.shape,np.nan),where=n>1)
+
+    def stderr(self,key="dOD"):
+        n = self.counts[key]
+        return np.sqrt(np.divide(self.variance(key),n,out=np.full(self.shape,np.nan),where=n>1))
+
+    def average(self,key="dOD"):
+        """ Mean of key, NaN where no scan has data. """
+        return np.where(self.counts[key]>0,self.mean[key],np.nan)
+
+    def _roi(self,array):
+        return array if self.roi is None else array[:,self.roi[0]:self.roi[1]]
+
+    def noise(self):
+        stderr = self._roi(self.stderr())
+        stderr = stderr[np.isfinite(stderr)]
+        return float(np.median(stderr)) if len(stderr) else np.inf
+
+    def add(self,on,off):
+        """ Add one scan, on and off of shape (delays, width). Points without
+        data (all zero or NaN) are skipped. Returns the convergence entry. """
+        values = dict(on=np.array(on,dtype=np.double),off=np.array(off,dtype=np.double))
+        for value in values.values():
+            if value.shape != self.shape:
+                raise ValueError("Scan has shape {}, expected {}".format(value.shape,self.shape))
+            value[~np.any(value != 0,axis=-1)] = np.nan
+        values["dOD"] = deltaOD(values["on"],values["off"],self.backgrounds)
+        previous = self.average()
+        for key in KEYS:
+            self._update(key,values[key])
+        self.scans += 1
+
+        change = self._roi(self.average()-previous)
+        change = change[np.isfinite(change)]
+        entry = dict(scans=self.scans,noise=self.noise(),change=float(np.sqrt(np.mean(change**2))) if len(change) else np.nan)
+        for key, value in entry.items():
+            self.history[key].append(value)
+        logger.info("Average of {} scans: noise {:.2e}, change {:.2e}".format(self.scans,entry["noise"],entry["change"]))
+        self._write(entry)
+        for callback in self.onUpdate:
+            callback(self)
+        return entry
+
+    def addFile(self,data_file,name="res0"):
+        """ Add the scan stored in data_file, e.g. by TransientSession.runScan. """
+        with h5py.File(data_file,"r",swmr=True) as f:
+            group = f["data"][name]
+            on, off = group["on"][()], group["off"][()]
+        return self.add(on[:self.shape[0]],off[:self.shape[0]])
+
+    def _write(self,entry):
+        if self.writer is None:
+            return
+        for key in KEYS:
+            self.writer.write("mean/"+key,slice(None),self.average(key))
+            self.writer.write("variance/"+key,slice(None),self.variance(key))
+        self.writer.write("counts",slice(None),self.counts["dOD"])
+        for key, value in entry.items():
+            self.writer.append("convergence/"+key,value)
+        self.writer.flush()
+
+    def converged(self):
+        """ True if the noise reached target_noise after at least min_scans scans. """
+        return self.target_noise is not None and self.scans>=self.min_scans and self.noise()<=self.target_noise
+
+    def done(self):
+        return self.stop_requested or self.converged()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,142 @@
+"""
+Cache of background frames.
+
+A background is only valid for the camera settings it was taken with. The
+BackgroundCache stores the frames under a key of the settings that change it
+    exposure, gain, ADC quality and speed, ROI with binning, image mode
+plus what the caller adds (pump state, sample position, number of frames),
+together with the sensor temperature and the time they were taken. A cached
+background is reused while it is younger than validity (s) and the sensor
+temperature is within max_drift (K) of the one it was taken at, otherwise it
+is taken again and replaces the old one.
+
+With a path the cache is kept in an HDF5 file, so later sessions of the day
+(and resumed ones) reuse it as well.
+
+    cache = BackgroundCache(path,validity=3600)
+    key = cameraSettings(cam,background="off",position=(x,y))
+    frames = cache.getOrAcquire(key,lambda: executor.run(plan)["camera"],cam.getTemperature())
+"""
+import os
+import json
+import time
+import hashlib
+
+import h5py
+import numpy as np
+
+from ..utils.jsonable import jsonable
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def cameraSettings(cam,**extra):
+    """ Key of the camera settings a background depends on, extra items are added. """
+    key = dict()
+    for name, getter in (("exposure","getExposure"),("gain","getGain"),("adc_low_noise","getADCLowNoise"),
+                         ("speed","getSpeed"),("roi","getROI"),("image_mode","getImageMode")):
+        try:
+            key[name] = jsonable(getattr(cam,getter)())
+        except Exception as e:
+            # a setting that can't be read never matches, the background is taken again
+            logger.warning("Could not read camera {}: {}".format(name,e))
+            key[name] = "unknown {}".format(time.time())
+    key.update(jsonable(extra))
+    return key
+
+
+class BackgroundCache(object):
+    """ Background frames by camera settings, see module doc. validity in s,
+    max_drift in K, None disables the check. """
+
+    def __init__(self,path=None,validity=3600,max_drift=0.5,clock=time.time):
+        self.path = path
+        self.validity = validity
+        self.max_drift = max_drift
+        self.clock = clock
+        self.entries = dict() # key string -> dict(frames, time, temperature)
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def _keyString(key):
+        return json.dumps(jsonable(key),sort_keys=True)
+
+    @staticmethod
+    def _entryName(key_string):
+        return hashlib.sha1(key_string.encode()).hexdigest()[:16]
+
+    def _load(self):
+        with h5py.File(self.path,"r") as f:
+            for group in f.values():
+                self.entries[group.attrs["key"]] = dict(frames=group["frames"][()],time=float(group.attrs["time"]),
+                    temperature=float(group.attrs["temperature"]))
+        logger.info("Loaded {} cached backgrounds from {}".format(len(self.entries),self.path))
+
+    def _store(self,key_string,entry):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder,exist_ok=True)
+        with h5py.File(self.path,"a") as f:
+            name = self._entryName(key_string)
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            group.create_dataset("frames",data=entry["frames"])
+            group.attrs["key"] = key_string
+            group.attrs["time"] = entry["time"]
+            group.attrs["temperature"] = entry["temperature"]
+
+    def _expired(self,entry,temperature):
+        """ Reason the entry can't be used any more or None. """
+        age = self.clock()-entry["time"]
+        if self.validity is not None and age>self.validity:
+            return "expired after {:.0f} s".format(age)
+        if self.max_drift is not None and temperature is not None and np.isfinite(entry["temperature"]):
+            drift = abs(temperature-entry["temperature"])
+            if drift>self.max_drift:
+                return "sensor temperature drifted by {:.2f} K".format(drift)
+        return None
+
+    def get(self,key,temperature=None):
+        """ Cached frames for key, None if there are none or they are no longer valid. """
+        key_string = self._keyString(key)
+        entry = self.entries.get(key_string)
+        if entry is None:
+            return None
+        reason = self._expired(entry,temperature)
+        if reason is not None:
+            logger.info("Cached background {} {}, taking a new one".format(self._entryName(key_string),reason))
+            return None
+        return entry["frames"]
+
+    def put(self,key,frames,temperature=None):
+        key_string = self._keyString(key)
+        entry = dict(frames=np.asarray(frames),time=self.clock(),temperature=np.nan if temperature is None else float(temperature))
+        self.entries[key_string] = entry
+        if self.path is not None:
+            self._store(key_string,entry)
+
+    def invalidate(self,key=None):
+        """ Drop the background of key, all of them without key. """
+        keys = list(self.entries) if key is None else [self._keyString(key)]
+        for key_string in keys:
+            self.entries.pop(key_string,None)
+        if self.path is not None and os.path.exists(self.path):
+            with h5py.File(self.path,"a") as f:
+                for key_string in keys:
+                    name = self._entryName(key_string)
+                    if name in f:
+                        del f[name]
+
+    def getOrAcquire(self,key,acquire,temperature=None):
+        """ Cached frames for key, or the frames returned by acquire() which are cached. """
+        frames = self.get(key,temperature)
+        if frames is not None:
+            logger.info("Using cached background {}".format(self._entryName(self._keyString(key))))
+            return frames
+        frames = acquire()
+        if frames is not None:
+            self.put(key,frames,temperature)
+        return frames
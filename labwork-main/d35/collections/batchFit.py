@@ -0,0 +1,275 @@
+"""
+Batch fitting of gas transient files.
+
+Finds the gasTransient_*.hdf5 files below the given folders (default the
+XUVData folder on the Desktop), fits the cross-correlation of each with
+utils.fitting.fitGasTransient in a process pool and writes one row per file
+    file, timestamp, t0, FWHM, amplitude, background, gamma with their errors, residual
+to a CSV or HDF5 table. The trace is prepared like in plotGasTransients: mean
+over repeated scans, optional normalisation per spectrum, log10, optional
+highpass and background subtraction, then the mean (or an SVD component) over
+the pixel range.
+
+Results are cached by the hash of the file contents and the settings, a rerun
+only fits new or changed files.
+
+    batchFitGasTransients D:/XUVData/2023_05_04 --output fits.csv --x-range 200 900 --workers 6
+"""
+import os
+import sys
+import csv
+import json
+import time
+import fnmatch
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+
+from ..utils.fitting import fitGasTransient, FS_PER_UNIT
+from ..utils.functions import find_index, highpass
+
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1 # increase when the fit or the table changes, old cache entries are ignored
+
+SETTINGS = dict(
+    x_range = (25,1340), # x axis range averaged for the trace, like the default region of plotGasTransients
+    background = None, # delay range subtracted from the data
+    average_intensities = False, # normalise each spectrum to its mean
+    highpass = None, # bandwidth of the highpass, None for no filter
+    svd = None, # index of the SVD component fitted instead of the mean
+    fix_decay = False,
+    force_invert = False,
+    try_invert = True,
+    maxfev = 10000,
+    )
+
+PARAMETERS = ("t0","fwhm","amplitude","background","gamma") # order of fitGasTransient opt
+COLUMNS = (("file","timestamp","delay_points","status")
+    +tuple(name for p in PARAMETERS for name in (p,p+"_err"))+("residual","error"))
+
+
+def findFiles(roots,pattern="gasTransient_*.hdf5"):
+    """ Sorted paths of the files matching pattern below the roots. """
+    files = []
+    for root in roots:
+        if os.path.isfile(root):
+            files.append(os.path.abspath(root))
+            continue
+        for folder, _, names in os.walk(root):
+            files.extend(os.path.join(folder,name) for name in fnmatch.filter(names,pattern))
+    return sorted(set(files))
+
+def fileHash(path,chunk=1<<20):
+    h = hashlib.sha1()
+    with open(path,"rb") as f:
+        for block in iter(lambda: f.read(chunk),b""):
+            h.update(block)
+    return h.hexdigest()
+
+def cacheKey(file_hash,settings):
+    return hashlib.sha1(json.dumps(dict(file=file_hash,settings=settings,version=CACHE_VERSION),
+        sort_keys=True).encode()).hexdigest()
+
+
+def loadGasTransient(path):
+    """ delays, x axis, data and attributes of a gas transient file. """
+    with h5py.File(path,"r",swmr=True) as f: # files of a running scan are open in SWMR mode
+        if f.attrs.get("experiment_type") != "gasTransient":
+            logger.warning("{} does not appear to be a Gas Transient".format(path))
+        f_data = f["data/res0"]
+        delays = np.asarray(f_data.attrs["delays"]).squeeze()
+        data = f_data[()].astype(np.double)
+        try:
+            x = np.asarray(f_data.attrs["x_axis"]).squeeze()
+        except KeyError:
+            x = np.arange(data.shape[-1])
+        attrs = dict(timestamp=float(f.attrs.get("timestamp",np.nan)))
+    return delays, x, data, attrs
+
+def prepareTrace(delays,x,data,x_range=SETTINGS["x_range"],background=None,average_intensities=False,
+                 highpass_bandwidth=None,svd=None):
+    """ Trace to fit from the data of a file, the processing of plotGasTransients. """
+    if data.ndim>2:
+        # average repeated scans and frames, keep the delay and pixel axes
+        delay_axis = pixel_axis = -1
+        for n, dim in enumerate(data.shape):
+            if dim == len(delays):
+                delay_axis = n
+            if dim == len(x):
+                pixel_axis = n
+        axes = [n for n in range(data.ndim) if n not in (delay_axis,pixel_axis)]
+        if len(axes) != data.ndim-2:
+            raise ValueError("Could not parse input data array of shape {}".format(data.shape))
+        data = np.mean(data,axis=tuple(axes))
+    if average_intensities:
+        data = (data.T/np.mean(data,axis=1)).T
+    data = np.log10(data)
+    if highpass_bandwidth:
+        data = highpass(data,highpass_bandwidth)
+    if background is not None:
+        iy_min, iy_max = find_index(delays,background)
+        data = data-np.mean(data[iy_min:iy_max,:],axis=0)
+    ix_min, ix_max = find_index(x,x_range)
+    if svd is not None:
+        U, s, V = np.linalg.svd(data[:,ix_min:ix_max])
+        return U[:,svd]*s[svd]
+    return np.mean(data[:,ix_min:ix_max],axis=1)
+
+def fitFile(path,settings):
+    """ Table row of the fit of one file, runs in the worker processes. """
+    row = dict(file=path,status="failed",error="")
+    try:
+        delays, x, data, attrs = loadGasTransient(path)
+        row.update(attrs,delay_points=len(delays))
+        trace = prepareTrace(delays,x,data,x_range=settings["x_range"],background=settings["background"],
+            average_intensities=settings["average_intensities"],highpass_bandwidth=settings["highpass"],svd=settings["svd"])
+        report = fitGasTransient(delays,trace,fix_decay=settings["fix_decay"],force_invert=settings["force_invert"],
+            try_invert=settings["try_invert"],maxfev=settings["maxfev"])
+    except Exception as e:
+        row["error"] = "{}: {}".format(type(e).__name__,e)
+        return row
+    if report["opt"] is None:
+        row.update(status="not converged")
+        return row
+    for n, name in enumerate(PARAMETERS):
+        if n<len(report["opt"]):
+            row[name], row[name+"_err"] = float(report["opt"][n]), float(report["err"][n])
+    row.update(status="ok",residual=float(report["residual"]))
+    return row
+
+
+class FitCache(object):
+    """ Rows of earlier fits by cacheKey, kept in a JSON file. """
+
+    def __init__(self,path=None):
+        self.path = path
+        self.rows = dict()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.rows = json.load(f)
+            except ValueError:
+                logger.warning("Ignoring unreadable fit cache {}".format(path))
+            logger.info("Loaded {} cached fits from {}".format(len(self.rows),path))
+
+    def get(self,key):
+        return self.rows.get(key)
+
+    def put(self,key,row):
+        self.rows[key] = row
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path+".tmp"
+        with open(tmp,"w") as f:
+            json.dump(self.rows,f)
+        os.replace(tmp,self.path) # don't leave a truncated cache when interrupted
+
+
+def batchFit(files,settings=None,workers=None,cache=None):
+    """ Fit files in a pool of workers processes (None for one per CPU, 1 to fit
+    in this process), returns the rows in the order of files. Failed fits are
+    rows with status failed and the error, they are not cached. """
+    settings = dict(SETTINGS,**(settings or dict()))
+    settings["x_range"] = list(settings["x_range"])
+    if settings["background"] is not None:
+        settings["background"] = list(settings["background"])
+    cache = cache if cache is not None else FitCache()
+    rows = dict()
+    keys = dict()
+    for path in files:
+        keys[path] = cacheKey(fileHash(path),settings)
+        row = cache.get(keys[path])
+        if row is not None:
+            rows[path] = dict(row,file=path) # the file may have been moved
+    todo = [path for path in files if path not in rows]
+    logger.info("{} files, {} cached, {} to fit".format(len(files),len(files)-len(todo),len(todo)))
+
+    start = time.perf_counter()
+    def done(path,row):
+        rows[path] = row
+        if row["status"] != "failed":
+            cache.put(keys[path],row)
+        logger.info("[{}/{}] {} {}".format(len(rows),len(files),os.path.basename(path),row["status"]+
+            (" "+row["error"] if row["error"] else "")))
+    try:
+        if workers == 1 or len(todo)<2:
+            for path in todo:
+                done(path,fitFile(path,settings))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(fitFile,path,settings): path for path in todo}
+                for future in as_completed(futures):
+                    done(futures[future],future.result())
+    finally:
+        cache.save()
+    if todo:
+        logger.info("Fitted {} files in {:.1f} s".format(len(todo),time.perf_counter()-start))
+    return [rows[path] for path in files]
+
+
+def writeTable(rows,path):
+    """ Write the rows as CSV, or as HDF5 (one dataset per column) for .h5/.hdf5 paths. """
+    if os.path.splitext(path)[1].lower() in (".h5",".hdf5"):
+        with h5py.File(path,"w") as f:
+            for column in COLUMNS:
+                values = [row.get(column,np.nan) for row in rows]
+                if column in ("file","status","error"):
+                    f.create_dataset(column,data=[str(v) for v in values],dtype=h5py.string_dtype())
+                else:
+                    f.create_dataset(column,data=np.array(values,dtype=np.double))
+            f.attrs["t0_unit"] = "fs"
+            f.attrs["fwhm_unit"] = "fs"
+            f.attrs["fs_per_stage_unit"] = FS_PER_UNIT
+    else:
+        with open(path,"w",newline="") as f:
+            writer = csv.DictWriter(f,fieldnames=COLUMNS,restval="",extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+    logger.info("Fit results written to {}".format(path))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="batchFitGasTransients",
+        description="Fit all gas transient files below the folders, t0 and FWHM in fs.")
+    parser.add_argument("roots",nargs="*",default=[os.path.join(os.path.expanduser("~"),"Desktop","XUVData")],
+        help="folders searched for gasTransient_*.hdf5 files, or files (default ~/Desktop/XUVData)")
+    parser.add_argument("--output",default=None,help="results table, .csv or .hdf5 (default fits.csv in the first folder)")
+    parser.add_argument("--pattern",default="gasTransient_*.hdf5")
+    parser.add_argument("--workers",type=int,default=None,help="worker processes, default one per CPU")
+    parser.add_argument("--x-range",type=float,nargs=2,default=SETTINGS["x_range"],help="x axis range of the trace")
+    parser.add_argument("--background",type=float,nargs=2,default=None,help="delay range subtracted as background")
+    parser.add_argument("--average",action="store_true",help="normalise each spectrum to its mean")
+    parser.add_argument("--highpass",type=int,default=None,help="highpass bandwidth")
+    parser.add_argument("--svd",type=int,default=None,help="fit this SVD component instead of the mean")
+    parser.add_argument("--fix-decay",action="store_true")
+    parser.add_argument("--invert",choices=("try","force","no"),default="try",help="fit the inverted trace as well")
+    parser.add_argument("--cache",default=None,help="cache file (default batchFit_cache.json in the first folder)")
+    parser.add_argument("--no-cache",action="store_true",help="fit all files again, without reading or writing the cache")
+    config = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    files = findFiles(config.roots,config.pattern)
+    if not files:
+        logger.error("No {} files found in {}".format(config.pattern,", ".join(config.roots)))
+        return 1
+    folder = config.roots[0] if os.path.isdir(config.roots[0]) else os.path.dirname(os.path.abspath(config.roots[0]))
+    settings = dict(x_range=config.x_range,background=config.background,average_intensities=config.average,
+        highpass=config.highpass,svd=config.svd,fix_decay=config.fix_decay,
+        force_invert=config.invert=="force",try_invert=config.invert=="try")
+    cache = FitCache(None if config.no_cache else (config.cache or os.path.join(folder,"batchFit_cache.json")))
+    rows = batchFit(files,settings,config.workers,cache)
+    writeTable(rows,config.output or os.path.join(folder,"fits.csv"))
+    failed = [row for row in rows if row["status"] == "failed"]
+    if failed:
+        logger.warning("{} of {} fits failed".format(len(failed),len(rows)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
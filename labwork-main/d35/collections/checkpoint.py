@@ -0,0 +1,164 @@
+"""
+Checkpoint journal for long scan sessions.
+
+The journal is an append-only JSON lines file next to the data files. It holds
+the session configuration, the device configuration at every (re)start, the
+data file of every scan iteration and every completed point as
+(scan, plan, index), e.g. (12, "res0", [delay index, shutter state index]).
+
+Completed points are only committed to the journal after the data file was
+flushed (the StreamWriter calls commit after each flush), so a point in the
+journal is always in the file. A crash loses at most the points since the
+last flush, these are taken again on resume.
+
+    journal = ScanJournal(path,config=scanConfig)
+    executor.run(plan,group,checkpoint=journal.scope(n_scan,writer))
+"""
+import os
+import json
+import time
+import threading
+
+from ..utils.jsonable import jsonable
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def deviceConfiguration(controller=None,cam=None):
+    """ Snapshot of the device settings worth comparing on resume. """
+    devices = dict()
+    if cam is not None:
+        for key, getter in (("exposure","getExposure"),("gain","getGain"),("adc_low_noise","getADCLowNoise"),
+                            ("speed","getSpeed"),("temperature","getTemperature"),("setpoint","getSetpoint")):
+            try:
+                devices["camera_"+key] = jsonable(getattr(cam,getter)())
+            except Exception as e:
+                logger.debug("Could not read camera {}: {}".format(key,e))
+    if controller is not None:
+        for name in ("xstage","ystage","longStage","piezoStage"):
+            stage = getattr(controller,name,None)
+            if stage is None:
+                continue
+            try:
+                devices[name] = jsonable(stage.getPosition())
+            except Exception as e:
+                logger.debug("Could not read {} position: {}".format(name,e))
+    return devices
+
+
+class JournalScope(object):
+    """ Checkpoint of one scan iteration, passed to ScanExecutor.run. With a
+    writer, marks are queued behind the data and committed after the flush. """
+
+    def __init__(self,journal,scan,writer=None):
+        self.journal = journal
+        self.scan = scan
+        self.writer = writer
+        if writer is not None:
+            writer.onFlush.append(journal.commit)
+
+    def done(self,plan):
+        return self.journal.done(self.scan,plan)
+
+    def mark(self,plan,index):
+        if self.writer is not None:
+            self.writer.call(self.journal.mark,self.scan,plan,index)
+        else:
+            self.journal.mark(self.scan,plan,index)
+            self.journal.commit()
+
+    def markPlan(self,plan):
+        """ Mark a whole plan (e.g. the gas reference) done. """
+        self.mark(plan,None)
+
+
+class ScanJournal(object):
+    """ Append-only journal of a scan session, see module doc. Opening an
+    existing journal loads its state, config is only stored for a new one. """
+
+    def __init__(self,path,config=None):
+        self.path = path
+        self.config = dict() if config is None else dict(config)
+        self.devices = []
+        self.files = dict() # scan -> data file
+        self._done = dict() # (scan, plan) -> set of index tuples, None marks the whole plan
+        self._pending = []
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        else:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder,exist_ok=True)
+            self._append(dict(type="session",time=time.time(),config=jsonable(self.config)))
+
+    def _load(self):
+        with open(self.path) as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be cut off by a crash
+                    logger.warning("Skipping corrupt line {} of {}".format(n+1,self.path))
+                    continue
+                kind = record.get("type")
+                if kind == "session":
+                    self.config = record["config"]
+                elif kind == "devices":
+                    self.devices.append(record["devices"])
+                elif kind == "scan":
+                    self.files[record["scan"]] = record["file"]
+                elif kind == "point":
+                    index = None if record["index"] is None else tuple(record["index"])
+                    self._done.setdefault((record["scan"],record["plan"]),set()).add(index)
+        logger.info("Loaded journal {}: {} scans, {} completed points".format(
+            self.path,len(self.files),sum(len(points) for points in self._done.values())))
+
+    def _append(self,*records):
+        with open(self.path,"a") as f:
+            for record in records:
+                f.write(json.dumps(record)+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recordDevices(self,devices):
+        """ Store the device configuration, call on every start and resume. """
+        self.devices.append(jsonable(devices))
+        self._append(dict(type="devices",time=time.time(),devices=self.devices[-1]))
+
+    def startScan(self,scan,data_file):
+        """ Store the data file of scan iteration scan. """
+        self.files[scan] = data_file
+        self._append(dict(type="scan",time=time.time(),scan=scan,file=data_file))
+
+    def scope(self,scan,writer=None):
+        return JournalScope(self,scan,writer)
+
+    def mark(self,scan,plan,index):
+        """ Note a completed point, written by the next commit. """
+        index = None if index is None else tuple(int(n) for n in index)
+        with self._lock:
+            self._done.setdefault((scan,plan),set()).add(index)
+            self._pending.append(dict(type="point",scan=scan,plan=plan,index=None if index is None else list(index)))
+
+    def commit(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            self._append(*pending)
+
+    def done(self,scan,plan):
+        """ Set of the completed index tuples of plan in scan. """
+        return set(self._done.get((scan,plan),()))
+
+    def isDone(self,scan,plan):
+        """ True if plan was marked done as a whole. """
+        return None in self._done.get((scan,plan),())
+
+    def firstIncomplete(self,scans,plan):
+        """ First scan in range(scans) in which plan isn't marked done. """
+        for scan in range(scans):
+            if not self.isDone(scan,plan):
+                return scan
+        return scans
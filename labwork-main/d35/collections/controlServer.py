@@ -0,0 +1,497 @@
+"""
+Headless control server for the camera, stages, shutter and the scan engine.
+
+Scans and hardware commands can be sent from another process, e.g. a notebook,
+without the GUIs. The server only listens on the loopback interface. Messages
+in both directions are length prefixed:
+    uint32 message length, uint32 header length, JSON header, binary payload
+numpy arrays travel as payload with dtype and shape in the header.
+
+Requests are {"type": "request", "id": n, "method": ..., "params": {...}} and
+answered by {"type": "response", "id": n, "result": ...} or "error". Methods:
+    status                     camera, stages, shutter and the scan jobs
+    setExposure, getPosition, moveStage, setShutter
+                               refused with an error while a scan runs
+    submit                     queue a scan: {"type": "gasTransient", "transient",
+                               "statics" or "background", ...} with the keys of
+                               the scan queue definitions (scanQueue.py), returns
+                               the job id, the jobs run one after the other
+    abort                      abort the running scan
+    subscribe                  topics "frames", "progress" and "jobs"
+Subscribed clients get events: {"type": "frame", "job", "plan", "index",
+"detector"} with the spectrum as payload after every point, {"type":
+"progress", "job", "done", "points"} and {"type": "job", "job", "state",
+"file", "error"}. Every client has its own sender thread and a bounded queue,
+when a client doesn't keep up its oldest events are dropped (responses never
+are), so observers can't slow the acquisition down.
+
+    python -m d35.collections.controlServer --simulate # simulated hardware
+
+    server = ControlServer(cam,controller,destination_folder)
+    server.start()
+    client = ControlClient(server.port)
+    client.subscribe("progress","jobs")
+    job = client.call("submit",type="gasTransient",cell_x=12.8,cell_y=19.2,
+        piezo_start=5,piezo_end=15,piezo_step=0.1,camera_exposure=40)
+"""
+import collections
+import itertools
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from .engine import PipelinedExecutor
+from .plans import backgroundPlan, gasTransientPlan, transientPlan, staticsPlan
+from ..utils.streamWriter import StreamWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+LOOPBACK = ("127.0.0.1","localhost","::1")
+TOPICS = ("frames","progress","jobs")
+STAGES = ("xstage","ystage","piezoStage","longStage")
+_PREFIX = struct.Struct("!II") # message length, header length
+
+
+def encode(header,payload=None):
+    """ Message bytes of the header dict and an optional numpy array or bytes payload. """
+    if isinstance(payload,np.ndarray):
+        header = dict(header,dtype=payload.dtype.str,shape=list(payload.shape))
+        payload = np.ascontiguousarray(payload).tobytes()
+    header = json.dumps(header).encode()
+    payload = payload or b""
+    return _PREFIX.pack(4+len(header)+len(payload),len(header))+header+payload
+
+def _receive(sock,n):
+    data = bytearray()
+    while len(data)<n:
+        chunk = sock.recv(n-len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+def readMessage(sock):
+    """ (header, payload) of the next message, the payload as numpy array if
+    the header has a dtype. Raises ConnectionError once the peer closed. """
+    length, header_length = _PREFIX.unpack(_receive(sock,_PREFIX.size))
+    data = _receive(sock,length-4)
+    header = json.loads(data[:header_length].decode())
+    payload = data[header_length:]
+    if "dtype" in header:
+        payload = np.frombuffer(payload,dtype=header["dtype"]).reshape(header["shape"])
+    return header, payload
+
+
+class _Connection(object):
+    """ Server side of a client: reader and sender thread, bounded event queue. """
+
+    def __init__(self,server,sock,address,max_events):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.max_events = max_events
+        self.topics = set()
+        self.dropped = 0
+        self._messages = collections.deque()
+        self._events = 0 # droppable messages in _messages
+        self._condition = threading.Condition()
+        self._closed = False
+        self._reader = threading.Thread(target=self._read,name="ControlReader-{}".format(address[1]),daemon=True)
+        self._sender = threading.Thread(target=self._send,name="ControlSender-{}".format(address[1]),daemon=True)
+        self._reader.start()
+        self._sender.start()
+
+    def send(self,message,event=False):
+        """ Queue message bytes, events are dropped oldest first when the queue is full. """
+        with self._condition:
+            if self._closed:
+                return
+            if event:
+                if self._events>=self.max_events:
+                    for n, (droppable, _) in enumerate(self._messages):
+                        if droppable:
+                            del self._messages[n]
+                            self._events -= 1
+                            self.dropped += 1
+                            break
+                self._events += 1
+            self._messages.append((event,message))
+            self._condition.notify()
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while not self._messages and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                event, message = self._messages.popleft()
+                if event:
+                    self._events -= 1
+            try:
+                self.sock.sendall(message)
+            except OSError:
+                self.close()
+                return
+
+    def _read(self):
+        try:
+            while True:
+                header, payload = readMessage(self.sock)
+                if header.get("type") == "request":
+                    self.send(self.server._handle(self,header))
+        except (ConnectionError,OSError):
+            pass
+        except Exception:
+            logger.exception("Dropping client {}:".format(self.address))
+        self.close()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.server._disconnected(self)
+
+
+class ControlServer(object):
+    """ See module doc. cam is a XUVCamera, controller the stage controller
+    with xstage, ystage, piezoStage, longStage and shutter. Scans are written
+    to destination_folder. """
+
+    def __init__(self,cam,controller,destination_folder,host="127.0.0.1",port=0,max_events=256):
+        if host not in LOOPBACK:
+            raise ValueError("The control server only listens on the loopback interface, not on {}".format(host))
+        self.cam = cam
+        self.controller = controller
+        self.destination_folder = destination_folder
+        self.host = host
+        self.port = port
+        self.max_events = max_events
+        # read by the executor instead of the controller's buttons
+        self.aborted = False
+        self.paused = False
+        self.jobs = dict() # id -> dict(definition, state, file, error)
+        self._ids = itertools.count()
+        self._pending = queue.Queue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._busy = threading.Lock() # held while a scan runs
+        self._socket = None
+        self._running = False
+        self.executor = PipelinedExecutor(self,lambda: time.sleep(1e-3))
+        self.executor.onPoint.append(self._point)
+        self._job = None
+        self._done = 0
+
+    def start(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        self._socket = socket.socket(family,socket.SOCK_STREAM)
+        self._socket.bind((self.host,self.port))
+        self._socket.listen()
+        self.port = self._socket.getsockname()[1]
+        self._running = True
+        threading.Thread(target=self._accept,name="ControlAccept",daemon=True).start()
+        threading.Thread(target=self._work,name="ControlScans",daemon=True).start()
+        logger.info("Control server listening on {}:{}".format(self.host,self.port))
+        return self
+
+    def stop(self):
+        self._running = False
+        self.aborted = True
+        self._pending.put(None)
+        if self._socket is not None:
+            self._socket.close()
+        for connection in list(self._connections):
+            connection.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, address = self._socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            with self._lock:
+                self._connections.append(_Connection(self,sock,address,self.max_events))
+            logger.info("Client {} connected".format(address))
+
+    def _disconnected(self,connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+                logger.info("Client {} disconnected".format(connection.address))
+
+    def publish(self,topic,header,payload=None):
+        """ Send an event to the clients subscribed to topic. """
+        with self._lock:
+            connections = [c for c in self._connections if topic in c.topics]
+        if not connections:
+            return
+        message = encode(header,payload)
+        for connection in connections:
+            connection.send(message,event=True)
+
+    # requests
+    def _handle(self,connection,request):
+        try:
+            method = getattr(self,"do_"+request.get("method",""),None)
+            if method is None:
+                raise ValueError("Unknown method {!r}".format(request.get("method")))
+            result = method(connection,**request.get("params",dict()))
+            return encode(dict(type="response",id=request.get("id"),result=result))
+        except Exception as e:
+            logger.warning("Request {} failed: {!r}".format(request.get("method"),e))
+            return encode(dict(type="response",id=request.get("id"),error="{}: {}".format(type(e).__name__,e)))
+
+    @contextmanager
+    def _hardware(self):
+        """ Lock for direct hardware commands, refused while a scan runs. """
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("A scan is running")
+        try:
+            yield
+        finally:
+            self._busy.release()
+
+    def _stage(self,name):
+        if name not in STAGES:
+            raise ValueError("Unknown stage {!r}, use one of {}".format(name,STAGES))
+        return getattr(self.controller,name)
+
+    def do_status(self,connection):
+        jobs = {n: dict(type=job["definition"]["type"],state=job["state"],file=job["file"],error=job["error"]) for n, job in self.jobs.items()}
+        status = dict(jobs=jobs,running=self._job,dropped=connection.dropped,clients=len(self._connections))
+        try:
+            with self._hardware():
+                status["exposure"] = self.cam.getExposure()
+                status["positions"] = {name: float(self._stage(name).getPosition()) for name in STAGES if hasattr(self.controller,name)}
+        except RuntimeError:
+            pass # no hardware queries during a scan
+        return status
+
+    def do_subscribe(self,connection,topics=TOPICS):
+        unknown = set(topics)-set(TOPICS)
+        if unknown:
+            raise ValueError("Unknown topics {}".format(sorted(unknown)))
+        connection.topics.update(topics)
+        return sorted(connection.topics)
+
+    def do_unsubscribe(self,connection,topics=TOPICS):
+        connection.topics.difference_update(topics)
+        return sorted(connection.topics)
+
+    def do_setExposure(self,connection,exposure):
+        with self._hardware():
+            self.cam.setExposure(int(exposure))
+            self.cam.commit()
+        return self.cam.getExposure()
+
+    def do_getPosition(self,connection,stage):
+        with self._hardware():
+            return float(self._stage(stage).getPosition())
+
+    def do_moveStage(self,connection,stage,position,wait=True,timeout=60.):
+        with self._hardware():
+            stage = self._stage(stage)
+            stage.setPosition(position)
+            start = time.perf_counter()
+            while wait and not stage.isOnTarget():
+                if time.perf_counter()-start>timeout:
+                    raise TimeoutError
+                time.sleep(1e-3)
+            return float(stage.getPosition())
+
+    def do_setShutter(self,connection,state):
+        with self._hardware():
+            self.controller.shutter.setShutter(bool(state))
+        return bool(state)
+
+    def do_submit(self,connection,**definition):
+        self._plan(definition) # reject bad definitions now
+        job = next(self._ids)
+        self.jobs[job] = dict(definition=definition,state="queued",file=None,error=None)
+        self._pending.put(job)
+        self._publishJob(job)
+        return job
+
+    def do_abort(self,connection):
+        running = self._job is not None
+        if running:
+            self.aborted = True
+        return running
+
+    # scans
+    def _plan(self,definition):
+        kind = definition.get("type")
+        exposure = definition.get("camera_exposure")
+        if kind in ("gasTransient","transient"):
+            delays = np.arange(definition["piezo_start"],definition["piezo_end"],definition["piezo_step"])
+            if kind == "gasTransient":
+                return gasTransientPlan(self.controller,self.cam,definition["cell_x"],definition["cell_y"],delays,
+                    long_delay_pos=definition.get("long_delay_pos"),exposure=exposure)
+            return transientPlan(self.controller,self.cam,definition["sample_x"],definition["sample_y"],delays,exposure=exposure)
+        if kind == "statics":
+            return staticsPlan(self.controller,self.cam,[tuple(definition["membrane"]),tuple(definition["sample"])],
+                ["membrane","sample"],definition["num_frames"],exposure=exposure)
+        if kind == "background":
+            return backgroundPlan(self.controller,self.cam,definition["x"],definition["y"],definition.get("frames",10),
+                pump=definition.get("pump",False))
+        raise ValueError("Unknown scan type {!r}".format(kind))
+
+    def _publishJob(self,job):
+        state = self.jobs[job]
+        self.publish("jobs",dict(type="job",job=job,state=state["state"],file=state["file"],error=state["error"]))
+
+    def _point(self,plan,index,detector,result):
+        self._done += 1
+        header = dict(job=self._job,plan=plan.name)
+        self.publish("progress",dict(header,type="progress",done=self._done,points=plan.points))
+        self.publish("frames",dict(header,type="frame",index=[int(n) for n in index],detector=detector),np.asarray(result))
+
+    def _work(self):
+        while True:
+            job = self._pending.get()
+            if job is None or not self._running:
+                return
+            state = self.jobs[job]
+            definition = state["definition"]
+            name = "{}{}_{}.hdf5".format(definition.get("filename_base",definition["type"]+"_"),
+                definition.get("name","job{}".format(job)),time.strftime("%Y_%m_%d_%H_%M_%S"))
+            with self._busy:
+                self._job, self._done, self.aborted = job, 0, False
+                state["state"] = "running"
+                state["file"] = os.path.join(self.destination_folder,name)
+                self._publishJob(job)
+                try:
+                    plan = self._plan(definition)
+                    with StreamWriter(state["file"],swmr=True) as writer:
+                        writer.setAttrs("/",experiment_type=definition["type"],fileinfo=definition.get("fileinfo",""),timestamp=time.time())
+                        writer.group("script_parameters",attrs={k: v for k, v in definition.items() if v is not None})
+                        self.executor.run(plan,writer.group("data"),keep=False)
+                    state["state"] = "aborted" if self.executor.aborted else "done"
+                except Exception as e:
+                    logger.exception("Job {} failed:".format(job))
+                    state["state"], state["error"] = "failed", "{}: {}".format(type(e).__name__,e)
+                finally:
+                    self._job = None
+                self._publishJob(job)
+
+
+class ControlClient(object):
+    """ Client of a ControlServer on this machine. call() blocks for the
+    response, events go to the callbacks in onEvent (called on the receiver
+    thread with header and payload) and to the events queue, which keeps the
+    last max_events. """
+
+    def __init__(self,port,host="127.0.0.1",timeout=10.,max_events=1024):
+        self.sock = socket.create_connection((host,port),timeout=timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.timeout = timeout
+        self.onEvent = []
+        self.events = collections.deque(maxlen=max_events)
+        self._ids = itertools.count()
+        self._responses = dict() # id -> [event, response]
+        self._lock = threading.Lock()
+        self._receiver = threading.Thread(target=self._receive,name="ControlClient",daemon=True)
+        self._receiver.start()
+
+    def _receive(self):
+        try:
+            while True:
+                header, payload = readMessage(self.sock)
+                if header.get("type") == "response":
+                    with self._lock:
+                        waiting = self._responses.get(header.get("id"))
+                    if waiting is not None:
+                        waiting[1] = header
+                        waiting[0].set()
+                    continue
+                self.events.append((header,payload))
+                for callback in self.onEvent:
+                    callback(header,payload)
+        except (ConnectionError,OSError):
+            pass
+
+    def call(self,method,**params):
+        """ Result of method on the server, raises RuntimeError with the server's error. """
+        n = next(self._ids)
+        waiting = [threading.Event(),None]
+        with self._lock:
+            self._responses[n] = waiting
+        try:
+            self.sock.sendall(encode(dict(type="request",id=n,method=method,params=params)))
+            if not waiting[0].wait(self.timeout):
+                raise TimeoutError("No response to {}".format(method))
+        finally:
+            with self._lock:
+                del self._responses[n]
+        response = waiting[1]
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response.get("result")
+
+    def subscribe(self,*topics):
+        return self.call("subscribe",topics=list(topics or TOPICS))
+
+    def submit(self,**definition):
+        return self.call("submit",**definition)
+
+    def waitForJob(self,job,timeout=None,poll=0.1):
+        """ Final state of job (done, aborted or failed). """
+        start = time.perf_counter()
+        while True:
+            state = self.call("status")["jobs"][str(job)]["state"]
+            if state not in ("queued","running"):
+                return state
+            if timeout is not None and time.perf_counter()-start>timeout:
+                raise TimeoutError
+            time.sleep(poll)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m d35.collections.controlServer",description="Headless control server on the loopback interface.")
+    parser.add_argument("--port",type=int,default=5735)
+    parser.add_argument("--folder",default=os.path.join(os.path.expanduser("~"),"Desktop","XUVData",time.strftime("%Y_%m_%d")),
+        help="folder the scans are written to")
+    parser.add_argument("--simulate",action="store_true",help="use the simulated hardware of d35.simulation")
+    config = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    os.makedirs(config.folder,exist_ok=True)
+    if config.simulate:
+        from ..simulation import simulatedCamera
+        from ..simulation.benchmark import SimulatedSetup
+        cam, controller = simulatedCamera(), SimulatedSetup()
+    else:
+        from .d35 import cam, controller # connects the hardware
+    server = ControlServer(cam,controller,config.folder,port=config.port).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
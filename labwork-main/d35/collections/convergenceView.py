@@ -0,0 +1,88 @@
+"""
+Live view of a ScanAggregator (aggregator.py)
+
+Shows the noise of the averaged dOD against the number of scans together with
+the 1/sqrt(scans) expected for white noise, the change of the mean by the last
+scan and the current mean dOD. Where the noise leaves the 1/sqrt(scans) line
+more scans don't help, "Stop after this scan" ends the session after the
+running scan.
+"""
+from PyQt5 import QtWidgets
+import pyqtgraph as pg
+from pyqtgraph import GraphicsLayoutWidget, ImageItem
+
+import numpy as np
+
+from ..utils.functions import axes_to_rect
+
+
+class ConvergenceView(QtWidgets.QWidget):
+    def __init__(self,aggregator,parent=None):
+        super().__init__(parent)
+        self.aggregator = aggregator
+        self.setWindowTitle("Scan Average")
+
+        self.plotLayoutWidget = GraphicsLayoutWidget()
+        self.stopButton = QtWidgets.QPushButton("Stop after this scan")
+        self.stopButton.setCheckable(True)
+        self.statusLabel = QtWidgets.QLabel("No scans yet")
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.plotLayoutWidget)
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self.statusLabel)
+        controls.addStretch()
+        controls.addWidget(self.stopButton)
+        layout.addLayout(controls)
+
+        self._initPlotUI()
+        self.stopButton.toggled.connect(self._stopToggled)
+        aggregator.onUpdate.append(self.refresh)
+
+    def _initPlotUI(self):
+        plt_win = self.plotLayoutWidget
+
+        self.pltNoiseView = plt_win.addPlot(row=0,col=0)
+        self.pltNoiseView.setLogMode(x=True,y=True)
+        self.pltNoiseView.setLabel('left','Noise (dOD)')
+        self.pltNoiseView.setLabel('bottom','Scans')
+        self.pltNoiseView.addLegend()
+        self.pltNoise = self.pltNoiseView.plot(pen=pg.mkPen('w'),symbolBrush='w',name="noise")
+        self.pltExpected = self.pltNoiseView.plot(pen=pg.mkPen('y',style=2),name="1/sqrt(scans)")
+        self.pltChange = self.pltNoiseView.plot(pen=pg.mkPen('c'),symbolBrush='c',name="change")
+
+        self.pltImageView = plt_win.addPlot(row=0,col=1)
+        self.pltImageView.setLabel('left','Delay')
+        self.pltImageView.setLabel('bottom','X')
+        self.pltImage = ImageItem()
+        self.pltImageView.addItem(self.pltImage)
+        self.pltImageView.addColorBar(self.pltImage,values=(-0.05,0.05),colorMap='CET-D1')
+
+    def _stopToggled(self,checked):
+        self.aggregator.stop_requested = checked
+
+    def refresh(self,aggregator=None):
+        """ Redraw from the aggregator, called after every scan. """
+        aggregator = self.aggregator if aggregator is None else aggregator
+        history = aggregator.history
+        scans = np.array(history["scans"],dtype=np.double)
+        noise = np.array(history["noise"])
+        finite = np.isfinite(noise)
+        if np.any(finite):
+            self.pltNoise.setData(scans[finite],noise[finite])
+            first = np.argmax(finite)
+            self.pltExpected.setData(scans[first:],noise[first]*np.sqrt(scans[first]/scans[first:]))
+        change = np.array(history["change"])
+        finite = np.isfinite(change)&(change>0)
+        if np.any(finite):
+            self.pltChange.setData(scans[finite],change[finite])
+
+        dOD = np.nan_to_num(aggregator.average("dOD"))
+        self.pltImage.setImage(dOD.T,autoLevels=False)
+        self.pltImage.setRect(axes_to_rect(aggregator.x_axis,aggregator.delays))
+
+        status = "{} scans, noise {:.2e}".format(aggregator.scans,aggregator.noise())
+        if aggregator.target_noise is not None:
+            status += " (target {:.2e})".format(aggregator.target_noise)
+        if aggregator.converged():
+            status += ", converged"
+        self.statusLabel.setText(status)
@@ -1,14 +1,16 @@
 from ..shutter import ThorlabsShutterWidget, ThorlabsShutterHardware
 from ..stages import PIStageWidget, PIStageHardware, GCSError
 from ..stages import ThorlabsStageWidget, ThorlabsStageHardware, ThorlabsError
+from ..stages.thorlabsStage import D35_THORLABS_DELAYSTAGE_PROFILES
 from ..utils.widgets import StageController
-from ..utils.definitions import ConsoleWindowLogHandler
+from ..utils.qtSignals import ConsoleWindowLogHandler
 
 from ..xuvcamera import XUVCamera, XUVCameraGui
 
 
 from PyQt5 import QtCore,QtWidgets
 
+import os
 import logging
 logger = logging.getLogger(__name__)
 hwlogger = logging.getLogger("D93 DEVICES")
@@ -18,6 +20,9 @@ data_folder = QtCore.QStandardPaths.locate(QtCore.QStandardPaths.DesktopLocation
 
 wait_function = QtWidgets.QApplication.processEvents
 
+# Set D35_SIMULATE=1 in the environment to run against simulated stages, see d35.simulation
+D35_SIMULATE = os.environ.get("D35_SIMULATE","0") == "1"
+
 class ExperimentHelper:
     @staticmethod
     def waitForCamera():
@@ -36,8 +41,7 @@ class ExperimentHelper:
 
     @staticmethod
     def waitForLongStage():
-        while not controller.longStage.isOnTarget():
-            wait_function()
+        controller.longStage.waitMove(wait_function=wait_function)
 
 
     @staticmethod
@@ -92,7 +96,7 @@ class ExperimentHelper:
 
 
 D35_PI_PIEZOSTAGE_USB = dict(model="E-754", connect_type="USB", serial=118044513)
-D35_THORLABS_DELAYSTAGE_SERIAL = dict(serial=40871684,BSC201=409600)
+D35_THORLABS_DELAYSTAGE_SERIAL = dict(serial=40871684,BSC201=409600,profiles=D35_THORLABS_DELAYSTAGE_PROFILES)
 
 
 
@@ -100,11 +104,18 @@ D35_THORLABS_DELAYSTAGE_SERIAL = dict(serial=40871684,BSC201=409600)
 
 
 class D35StageController(StageController):
-    def __init__(self,startup=True,stability=False):
-        self.xstage = PIStageHardware()
-        self.ystage = PIStageHardware()
-        self.longStage = ThorlabsStageHardware()
-        self.piezoStage = PIStageHardware()
+    def __init__(self,startup=True,stability=False,simulate=D35_SIMULATE):
+        if simulate:
+            from ..simulation import SimulatedPIStageHardware, SimulatedThorlabsStageHardware
+            self.xstage = SimulatedPIStageHardware()
+            self.ystage = SimulatedPIStageHardware()
+            self.longStage = SimulatedThorlabsStageHardware()
+            self.piezoStage = SimulatedPIStageHardware()
+        else:
+            self.xstage = PIStageHardware()
+            self.ystage = PIStageHardware()
+            self.longStage = ThorlabsStageHardware()
+            self.piezoStage = PIStageHardware()
 
         self.widget_xstage = PIStageWidget(self.xstage,label="Sample X")
         self.widget_ystage = PIStageWidget(self.ystage,label="Sample Y")
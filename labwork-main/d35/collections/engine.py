@@ -0,0 +1,627 @@
+"""
+Declarative scan engine.
+
+A scan is declared as a ScanPlan: a list of axes, outermost first, and a list of
+detectors. Axes are stage positions (StageAxis, PositionAxis), shutter states
+(ShutterAxis) or plain repeats (RepeatAxis), every axis visits its positions in
+its own order. The ScanExecutor runs a plan point by point:
+    - only axes whose value changes are moved, all moves are started together
+      and the camera is cleared while the stages travel
+    - abort and pause are taken from the stage controller
+    - results are streamed to the HDF5 file point by point while the scan runs,
+      through a StreamWriter (see utils/streamWriter.py)
+Every step is recorded as a span (see utils/tracing.py), a table of the time
+spent per step is logged at the end of a run.
+The PipelinedExecutor additionally starts the moves to the next point as soon as
+the exposure has ended, while the frame is read out, and decodes and writes the
+results on worker threads.
+The scan types in scans.py and the scripts are plan definitions on top of this.
+
+Results of detector d have the shape plan.shape+d.shape. If the plan is split
+on an axis, every position of that axis gets its own dataset named by the
+axis' labels (e.g. "on"/"off"), with that axis removed from the shape.
+"""
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+
+import numpy as np
+
+from ..utils.motion import waitOnTarget
+from ..utils.streamWriter import StreamWriter, StreamGroup
+from ..utils.frameGeometry import frameGeometry
+from ..utils.tracing import tracer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Axis(object):
+    """ One dimension of a scan. positions are the values, order the indices in
+    the order they are visited, labels optional names for the positions. """
+
+    def __init__(self,name,positions,order=None,labels=None):
+        self.name = name
+        self.positions = list(positions)
+        self.order = list(range(len(self.positions))) if order is None else [int(n) for n in order]
+        self.labels = [str(p) for p in self.positions] if labels is None else list(labels)
+        self._current = None # index the axis was last moved to
+
+    def __len__(self):
+        return len(self.positions)
+
+    def context(self):
+        """ Context entered for the duration of the scan. """
+        return nullcontext()
+
+    def move(self,index,step):
+        """ Start the move to positions[index], return without waiting. """
+        self._current = index
+
+    def wait(self,wait_function):
+        """ Wait until the last move is finished. """
+
+    def reset(self):
+        self._current = None
+
+    def attrs(self):
+        """ Attributes stored with the results. """
+        return {self.name: np.asarray(self.positions), self.name+"_order": np.asarray(self.order)}
+
+
+class RepeatAxis(Axis):
+    """ Repeat the inner axes n times. """
+
+    def __init__(self,name,n):
+        super().__init__(name,range(n))
+
+
+class StageAxis(Axis):
+    """ A single stage. Stages supporting fastMode (PIStageHardware) skip the
+    error query per move, errors are checked once the axis is done. """
+
+    def __init__(self,name,stage,positions,order=None,labels=None,fast=True):
+        super().__init__(name,positions,order,labels)
+        self.stage = stage
+        self.fast = fast
+        self._distance = None
+        self._started = None # perf_counter time the last move command returned
+
+    def context(self):
+        if self.fast and hasattr(self.stage,"fastMode"):
+            return self.stage.fastMode()
+        return nullcontext()
+
+    def move(self,index,step):
+        target = self.positions[index]
+        self._distance = None if self._current is None else target-self.positions[self._current]
+        if hasattr(self.stage,"markStep"):
+            self.stage.markStep(step)
+        self.stage.setPosition(target)
+        self._started = time.perf_counter()
+        super().move(index,step)
+
+    def wait(self,wait_function):
+        # Only poll once the move should be finished, if the stage was profiled.
+        # The move runs from the command on, arming and readout in between count towards it.
+        waitOnTarget(self.stage,self._distance,wait_function=wait_function,start=self._started)
+
+
+class PositionAxis(Axis):
+    """ Several stages moved together, every position is a tuple with one value per stage,
+    e.g. the sample stage positions of membrane and sample. """
+
+    def __init__(self,name,stages,positions,order=None,labels=None):
+        super().__init__(name,positions,order,labels)
+        self.stages = stages
+
+    def move(self,index,step):
+        for stage, value in zip(self.stages,self.positions[index]):
+            stage.setPosition(value)
+        super().move(index,step)
+
+    def wait(self,wait_function):
+        while not all(stage.isOnTarget() for stage in self.stages):
+            wait_function()
+
+
+class ShutterAxis(Axis):
+    """ Pump shutter states, True is open. """
+
+    def __init__(self,name,shutter,states=(True,False),order=None,labels=None):
+        if labels is None:
+            labels = ["on" if state else "off" for state in states]
+        super().__init__(name,states,order,labels)
+        self.shutter = shutter
+
+    def move(self,index,step):
+        self.shutter.setShutter(self.positions[index],timeout=0)
+        super().move(index,step)
+
+    def wait(self,wait_function):
+        state = self.positions[self._current]
+        self.shutter.waitOnShutter(state,wait_function=wait_function)
+        if hasattr(self.shutter,"waitSettled"):
+            self.shutter.waitSettled(state,wait_function)
+
+
+class Detector(object):
+    """ Base class, acquire returns one array of shape and dtype or None. """
+    name = "detector"
+    shape = ()
+    dtype = np.double
+    raw_shape = None # shape of the raw data to store along with the result, None to not store it
+    raw_dtype = np.uint16
+    x_axis = None # coordinate of the last axis of shape, default the index
+
+    def prepare(self,wait_function):
+        pass
+
+    def arm(self,wait_function):
+        """ Called after the moves of a point were started, before waiting for them. """
+
+    def acquire(self):
+        self.start()
+        return self.decode(self.read())
+
+    def start(self):
+        """ Start the acquisition, return the perf_counter time the exposure ends or None if unknown. """
+        return None
+
+    def read(self):
+        """ Wait for and return the raw data of the acquisition started last. """
+        raise NotImplementedError
+
+    def decode(self,raw):
+        """ Convert raw data to the result, runs on a worker thread in the PipelinedExecutor. """
+        return raw
+
+    def rawFrame(self,raw):
+        """ Convert raw data to the array of raw_shape stored in the file. """
+        return np.reshape(raw,self.raw_shape)
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class CameraDetector(Detector):
+    """ Spectrum of the XUVCamera. """
+
+    def __init__(self,cam,name="spectrum",exposure=None,timeout=None,geometry=None,dtype=np.double,margin=2e-3,raw_shape=None):
+        self.cam = cam
+        self.name = name
+        self.exposure = exposure # ms, None keeps the exposure set in the GUI
+        self.timeout = timeout # ms, default 10x the exposure
+        self.geometry = frameGeometry(cam) if geometry is None else geometry # FrameGeometry of the camera ROI
+        self.shape = self.geometry.spectrum_shape
+        self.x_axis = self.geometry.x_axis
+        self.dtype = dtype
+        self.margin = margin # s, added to the exposure before the stages may move on
+        if raw_shape == "frame":
+            raw_shape = self.geometry.frame_shape
+        self.raw_shape = raw_shape # e.g. "frame" to also store the frames
+
+    def prepare(self,wait_function):
+        self.cam.releasePreviewLock() # Make sure the preview loop is stopped.
+        geometry = frameGeometry(self.cam)
+        if geometry != self.geometry:
+            raise ValueError("Camera ROI changed from {} to {} after the scan was planned".format(self.geometry,geometry))
+        while not self.cam.clearAcquisition():
+            wait_function()
+        if self.exposure is not None:
+            logger.info("... Exposure: {:d} ms".format(self.exposure))
+            self.cam.setExposure(self.exposure)
+        if self.timeout is None:
+            self.timeout = 10*self.exposure if self.exposure else 10000
+        exposure = self.exposure if self.exposure is not None else self.cam.getExposure()
+        # The PIXIS has no exposure-end event, the end is the start plus the exposure and a margin
+        self._exposure_s = exposure/1000.+self.margin
+        logger.debug("Locking GUI.")
+        self.cam.requestAcquisitionLock()
+
+    def arm(self,wait_function):
+        # Throw away old data
+        while not self.cam.clearAcquisition():
+            wait_function()
+
+    def start(self):
+        if not self.cam.startFrame(): # Start acquisition loop
+            logger.error("Did not start acquisition, error: {}".format(self.cam.cam.getLastError()))
+        return time.perf_counter()+self._exposure_s
+
+    def read(self):
+        err, res = self.cam.grabFrame(timeout=self.timeout)
+        if res is None and err == 32:
+            logger.warning("Could not grab frame")
+        return res
+
+    def decode(self,raw):
+        if raw is None:
+            return None
+        return np.asarray(raw[0][0,0,:],dtype=self.dtype)
+
+    def rawFrame(self,raw):
+        return np.reshape(raw[0],self.raw_shape)
+
+    def finish(self):
+        self.cam.clearAcquisition()
+        self.cam.clearAcquisition()
+        self.cam.releaseAcquisitionLock()
+
+    def abort(self):
+        self.cam.stopFrame()
+        self.cam.releaseAcquisitionLock()
+
+
+class ScanPlan(object):
+    """ Declaration of a scan.
+    axes are visited outermost first, setup is a list of (stage, position) moved
+    before the scan, shutter is closed for these moves and after the scan.
+    pump is the shutter state held during the scan if no ShutterAxis is used. """
+
+    def __init__(self,name,axes,detectors,setup=(),shutter=None,pump=False,split=None,dataset=None,metadata=None,policy=None):
+        self.name = name
+        self.pump = pump
+        self.dataset = name if dataset is None else dataset # name of the dataset (or group if split) in the file
+        self.axes = list(axes)
+        self.detectors = list(detectors)
+        self.setup = list(setup)
+        self.shutter = shutter
+        self.split = split # name of the axis to store in separate datasets
+        self.metadata = dict() if metadata is None else dict(metadata)
+        if split is not None and split not in [axis.name for axis in self.axes]:
+            raise ValueError("Unknown split axis {}".format(split))
+        self.policy = policy # FramePolicy deciding on repeats, see acquisitionPolicy.py
+        if policy is not None:
+            policy.bind(self)
+
+    @property
+    def shape(self):
+        return tuple(len(axis) for axis in self.axes)
+
+    @property
+    def points(self):
+        return int(np.prod(self.shape))
+
+    def iterPoints(self):
+        """ Yield the index tuples in acquisition order. """
+        return itertools.product(*[axis.order for axis in self.axes])
+
+
+class ScanExecutor(object):
+    """ Runs ScanPlans, see module doc. controller is the StageController whose
+    abort, pause and stop buttons are honoured. """
+
+    def __init__(self,controller=None,wait_function=None,flush_every=10):
+        self.controller = controller
+        self.wait_function = wait_function if wait_function is not None else (lambda: time.sleep(1e-3))
+        self.flush_every = flush_every # points between flushes of the HDF5 file
+        self.aborted = False
+        self._declared = dict() # id(plan) -> writer and datasets created by declare
+        self._skip = set() # points done before a resume
+        self.onPoint = [] # called with (plan, index, detector name, result) after a result is stored
+
+    def _checkAbort(self):
+        if self.controller is None:
+            return False
+        with tracer.span("scan.events"):
+            self.wait_function()
+        if self.controller.aborted:
+            logger.warning("Acquisition aborted!")
+            return True
+        while self.controller.paused:
+            self.wait_function()
+        return False
+
+    def _datasets(self,plan,writer,base):
+        """ Create the datasets of the plan below base, return {(detector, split index): path}.
+        Raw frames of detectors with a raw_shape go to (detector, "raw", split index). """
+        paths = dict()
+        split = [axis.name for axis in plan.axes].index(plan.split) if plan.split is not None else None
+        grid = tuple(n for i, n in enumerate(plan.shape) if i != split)
+        attrs = dict()
+        for axis in plan.axes:
+            attrs.update(axis.attrs())
+        for detector in plan.detectors:
+            name = base+"/"+(plan.dataset if len(plan.detectors) == 1 else plan.dataset+"_"+detector.name)
+            if split is None:
+                targets = {None: name}
+            else:
+                name = base+"/"+(plan.dataset if len(plan.detectors) == 1 else plan.dataset+"/"+detector.name)
+                targets = {n: name+"/"+label for n, label in enumerate(plan.axes[split].labels)}
+            for n, path in targets.items():
+                data_attrs = dict(attrs)
+                if detector.shape:
+                    data_attrs["x_axis"] = np.arange(detector.shape[-1]) if detector.x_axis is None else detector.x_axis
+                paths[(detector.name,n)] = writer.createDataset(path,detector.shape,grid=grid,dtype=detector.dtype,attrs=data_attrs)
+                if detector.raw_shape is not None:
+                    paths[(detector.name,"raw",n)] = writer.createDataset(path+"_raw",detector.raw_shape,grid=grid,dtype=detector.raw_dtype)
+        if plan.policy is not None:
+            # frames averaged per point
+            paths["frames"] = writer.createDataset(base+"/"+plan.dataset+"_frames",(),grid=plan.shape,dtype=np.int32,attrs=attrs)
+        return paths, split
+
+    def declare(self,plan,group):
+        """ Create the datasets of plan in group now, needed for plans run after
+        others in a SWMR file, which allows no new datasets once readers may attach. """
+        writer, owned = (group.writer, False) if isinstance(group,StreamGroup) else (StreamWriter(group,flush_every=self.flush_every), True)
+        self._declared[id(plan)] = (writer, owned, group)+self._datasets(plan,writer,group.name.rstrip("/"))
+
+    def _moveTo(self,plan,index,step):
+        """ Start the moves of the axes that change for index, return the moved axes. """
+        moved = [axis for axis, n in zip(plan.axes,index) if axis._current != n]
+        for axis in moved:
+            axis.move(index[plan.axes.index(axis)],step)
+        return moved
+
+    def _acquire(self,detector):
+        """ Return result and raw data (None unless the detector stores raw frames). """
+        if detector.raw_shape is None:
+            return detector.acquire(), None
+        detector.start()
+        raw = detector.read()
+        return detector.decode(raw), raw
+
+    def _points(self,plan):
+        """ Yield the points of plan still to take, in acquisition order. With a
+        policy a group is repeated as long as the policy asks for more, it has
+        to be fed the results of the group before the next point is requested. """
+        points = (index for index in plan.iterPoints() if index not in self._skip)
+        if plan.policy is None:
+            yield from points
+            return
+        for key, group in itertools.groupby(points,key=plan.policy.key):
+            group = list(group)
+            yield from group
+            while plan.policy.more(key):
+                yield from group
+
+    def _loop(self,plan,store):
+        """ Acquire all points of plan, store(index,detector,result,raw) persists a result. """
+        for step, index in enumerate(self._points(plan)):
+            tracer.point = step
+            with tracer.span("scan.move"):
+                moved = self._moveTo(plan,index,step)
+            with tracer.span("scan.arm"):
+                for detector in plan.detectors:
+                    detector.arm(self.wait_function)
+            with tracer.span("scan.settle"):
+                for axis in moved:
+                    axis.wait(self.wait_function)
+
+            self._timestamps[index] = time.time()
+            for detector in plan.detectors:
+                with tracer.span("scan.acquire"):
+                    res, raw = self._acquire(detector)
+                with tracer.span("scan.store"):
+                    store(index,detector,res,raw)
+                if plan.policy is not None and detector is plan.detectors[0]:
+                    plan.policy.add(index,res)
+            if self._checkAbort():
+                return True
+        return False
+
+    def run(self,plan,group=None,keep=True,checkpoint=None,trace=None):
+        """ Run the plan and stream the results to group, an h5py group or a
+        StreamGroup of a StreamWriter. Returns a dict detector name -> array of
+        shape plan.shape+detector.shape, or an empty dict if not keep (the
+        results are only in the file then).
+        checkpoint (see checkpoint.py) records the completed points, points it
+        holds as done are skipped, i.e. the scan is resumed.
+        trace is a file the spans of the run are written to, as Chrome trace JSON. """
+        mark = tracer.mark()
+        results = {d.name: np.zeros(plan.shape+d.shape,dtype=d.dtype) for d in plan.detectors} if keep else dict()
+        if group is not None and id(plan) not in self._declared:
+            self.declare(plan,group)
+        writer, owned, group, paths, split = self._declared.pop(id(plan),(None,False,None,dict(),None))
+        timestamps = self._timestamps = np.full(plan.shape,np.nan)
+        self._skip = checkpoint.done(plan.name) if checkpoint is not None else set()
+        if self._skip:
+            logger.info("Resuming {}: {} points done".format(plan.name,len(self._skip)))
+        self.aborted = False
+        for axis in plan.axes:
+            axis.reset()
+        logger.info("Starting {}: {} points".format(plan.name,plan.points))
+
+        frames = self.frames = np.zeros(plan.shape,dtype=np.int32)
+        means = dict() # (detector, index) -> running mean of repeated points
+
+        def store(index,detector,res,raw=None):
+            if res is None:
+                return
+            if plan.policy is not None:
+                if detector is plan.detectors[0]:
+                    frames[index] += 1
+                n = frames[index]
+                if n>1:
+                    mean = means[(detector.name,index)]
+                    res = mean+(np.asarray(res,dtype=mean.dtype)-mean)/n
+                means[(detector.name,index)] = np.asarray(res,dtype=np.double)
+                if writer is not None and detector is plan.detectors[0]:
+                    writer.write(paths["frames"],index,n)
+            if keep:
+                results[detector.name][index] = res
+            if writer is not None:
+                n = None if split is None else index[split]
+                rest = index if split is None else tuple(m for i, m in enumerate(index) if i != split)
+                writer.write(paths[(detector.name,n)],rest,res)
+                if raw is not None:
+                    writer.write(paths[(detector.name,"raw",n)],rest,detector.rawFrame(raw))
+            if checkpoint is not None and detector is plan.detectors[-1]:
+                checkpoint.mark(plan.name,index)
+            for callback in self.onPoint:
+                try:
+                    callback(plan,index,detector.name,res)
+                except Exception:
+                    logger.exception("Point callback failed:")
+
+        prepared = [] # detectors to abort on an error
+        try:
+            # inside the try, so the writer is closed if a detector can't be prepared
+            if writer is not None:
+                writer.startSWMR()
+            for detector in plan.detectors:
+                detector.prepare(self.wait_function)
+                prepared.append(detector)
+            if plan.setup:
+                if plan.shutter is not None:
+                    plan.shutter.setShutter(False,wait_function=self.wait_function) # Close shutter for safety
+                for stage, position in plan.setup:
+                    if not stage.isPosition(position):
+                        stage.setPosition(position)
+                for stage, position in plan.setup:
+                    while not stage.isOnTarget():
+                        self.wait_function()
+            if plan.pump and plan.shutter is not None:
+                plan.shutter.setShutter(True,wait_function=self.wait_function)
+                if hasattr(plan.shutter,"waitSettled"):
+                    plan.shutter.waitSettled(True,self.wait_function)
+
+            with ExitStack() as stack:
+                for axis in plan.axes:
+                    stack.enter_context(axis.context())
+                self.aborted = self._loop(plan,store)
+
+            logger.info("Finished {}, cleaning up.".format(plan.name))
+            if plan.shutter is not None:
+                plan.shutter.setShutter(False,wait_function=self.wait_function)
+            for detector in plan.detectors:
+                detector.finish()
+        except:
+            logger.exception("Aborting Acquisition: An error occured during the scan:")
+            if plan.shutter is not None:
+                plan.shutter.setShutter(False,wait_function=self.wait_function)
+            for detector in prepared:
+                detector.abort()
+            raise
+        finally:
+            if writer is not None:
+                for key, path in paths.items():
+                    if "raw" not in key and key != "frames":
+                        stamps = timestamps if split is None else np.fmin.reduce(timestamps,axis=split)
+                        if self._skip:
+                            # keep the times of the points taken before the resume
+                            previous = writer.getAttrs(path).get("timestamps")
+                            if previous is not None and np.shape(previous) == stamps.shape:
+                                stamps = np.where(np.isnan(stamps),previous,stamps)
+                        writer.setAttrs(path,timestamps=stamps)
+                if owned:
+                    writer.close()
+                else:
+                    writer.flush()
+            tracer.point = -1
+            logger.info("Time spent in {}:\n{}".format(plan.name,tracer.formatSummary(mark)))
+            if trace is not None:
+                tracer.export(trace,mark)
+        return results
+
+
+class PipelinedExecutor(ScanExecutor):
+    """ ScanExecutor overlapping stage motion with the camera readout.
+
+    As soon as the exposure of a point has ended (Detector.start returns the
+    time), the moves to the next point are started and the frame is read out
+    while the stages travel. Decoding the frames runs on a thread pool and the
+    results are stored by a single writer thread, so neither holds up the
+    acquisition loop. Detectors that can't tell the end of the exposure are
+    read before moving, as in ScanExecutor. """
+
+    def __init__(self,controller=None,wait_function=None,flush_every=10,decoders=2,queue_size=64):
+        super().__init__(controller,wait_function,flush_every)
+        self.decoders = decoders
+        self.queue_size = queue_size # results waiting to be written, the loop blocks if the writer falls behind
+
+    def _writer(self,writes,store,errors):
+        while True:
+            item = writes.get()
+            if item is None:
+                return
+            step, index, detector, future, raw = item
+            try:
+                res = future.result()
+                with tracer.span("scan.store",step):
+                    store(index,detector,res,raw)
+            except Exception as e:
+                logger.exception("Could not store result:")
+                errors.append(e)
+
+    @staticmethod
+    def _decode(detector,raw,step):
+        with tracer.span("scan.decode",step):
+            return detector.decode(raw)
+
+    def _loop(self,plan,store):
+        points = self._points(plan)
+        writes = queue.Queue(self.queue_size)
+        errors = []
+        writer = threading.Thread(target=self._writer,args=(writes,store,errors),daemon=True)
+        writer.start()
+        policy = plan.policy
+        pending = [] # (index, decode future) not yet given to the policy
+        aborted = False
+        try:
+            with ThreadPoolExecutor(self.decoders) as pool:
+                index = next(points,None)
+                step = 0
+                with tracer.span("scan.move",step):
+                    moved = self._moveTo(plan,index,step) if index is not None else []
+                while index is not None:
+                    tracer.point = step
+                    with tracer.span("scan.arm"):
+                        for detector in plan.detectors:
+                            detector.arm(self.wait_function)
+                    with tracer.span("scan.settle"):
+                        for axis in moved:
+                            axis.wait(self.wait_function)
+
+                    self._timestamps[index] = time.time()
+                    with tracer.span("scan.start"):
+                        ends = [detector.start() for detector in plan.detectors]
+                    # at the end of a group the policy needs this frame to decide on the next point
+                    overlap = all(end is not None for end in ends) and (policy is None or not policy.groupEnd(index))
+                    following = None
+                    if overlap:
+                        # Exposure done, the stages can move while the frame is read out
+                        end = max(ends)
+                        with tracer.span("scan.expose"):
+                            while time.perf_counter()<end:
+                                time.sleep(min(1e-3,max(end-time.perf_counter(),0)))
+                        following = next(points,None)
+                        with tracer.span("scan.move",step+1):
+                            moved = self._moveTo(plan,following,step+1) if following is not None else []
+                    with tracer.span("scan.read"):
+                        raws = [detector.read() for detector in plan.detectors]
+                    for detector, raw in zip(plan.detectors,raws):
+                        future = pool.submit(self._decode,detector,raw,step)
+                        writes.put((step,index,detector,future,raw if detector.raw_shape is not None else None))
+                        if policy is not None and detector is plan.detectors[0]:
+                            pending.append((index,future))
+                    if not overlap:
+                        for n, future in pending:
+                            policy.add(n,future.result())
+                        pending = []
+                        following = next(points,None)
+                        with tracer.span("scan.move",step+1):
+                            moved = self._moveTo(plan,following,step+1) if following is not None else []
+                    if errors:
+                        raise errors[0]
+                    if self._checkAbort():
+                        aborted = True
+                        # don't leave the stages travelling to a point that won't be taken
+                        for axis in moved:
+                            axis.wait(self.wait_function)
+                        break
+                    index = following
+                    step += 1
+        finally:
+            writes.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+        return aborted
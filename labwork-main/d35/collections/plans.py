@@ -0,0 +1,50 @@
+"""
+Plan definitions of the d35 scans.
+
+The plans of the scan types in scans.py and the scripts, kept free of the
+hardware setup in d35.py so they can be run against any controller and camera,
+e.g. the simulated ones of the benchmarks (simulation/benchmark.py).
+"""
+from .acquisitionPolicy import SNRPolicy
+from .engine import ScanPlan, StageAxis, PositionAxis, ShutterAxis, RepeatAxis, CameraDetector
+
+
+def backgroundPlan(controller,cam,x,y,frames=10,pump=False,timeout=10000,name="bg0"):
+    """ frames spectra at the sample position (x, y) with the pump shutter in state pump,
+    stored as on/off in the group passed to the executor. """
+    return ScanPlan(name,
+        axes=[RepeatAxis("frame",frames)],
+        detectors=[CameraDetector(cam,timeout=timeout)],
+        setup=[(controller.ystage,y),(controller.xstage,x)],
+        shutter=controller.shutter,pump=pump,dataset="off" if not pump else "on")
+
+def gasTransientPlan(controller,cam,cell_x,cell_y,delays,order=None,long_delay_pos=None,exposure=None,timeout=10000,name="res0"):
+    """ One spectrum per piezo delay with the pump open, results are stored sorted by delay. """
+    setup = [(controller.ystage,cell_y),(controller.xstage,cell_x)]
+    if long_delay_pos is not None:
+        setup.append((controller.longStage,long_delay_pos))
+    return ScanPlan(name,
+        axes=[StageAxis("delays",controller.piezoStage,delays,order=order)],
+        detectors=[CameraDetector(cam,exposure=exposure,timeout=timeout)],
+        setup=setup,shutter=controller.shutter,pump=True)
+
+def transientPlan(controller,cam,sample_x,sample_y,delays,order=None,exposure=None,name="res0",target_snr=None,max_frames=20,roi=None):
+    """ Pump on and pump off spectrum at every piezo delay, stored as name/on and name/off.
+    With target_snr the on/off pair of a delay is repeated until its dOD over
+    the pixel roi reaches target_snr or max_frames, see acquisitionPolicy.py. """
+    policy = SNRPolicy(target_snr,max_frames=max_frames,roi=roi) if target_snr is not None else None
+    return ScanPlan(name,
+        axes=[StageAxis("delays",controller.piezoStage,delays,order=order),
+              ShutterAxis("pump",controller.shutter,states=(True,False))],
+        detectors=[CameraDetector(cam,exposure=exposure)],
+        setup=[(controller.ystage,sample_y),(controller.xstage,sample_x)],
+        shutter=controller.shutter,split="pump",policy=policy)
+
+def staticsPlan(controller,cam,positions,labels,frames,exposure=None,name="res0"):
+    """ Alternate between the sample positions [(x, y), ...] for frames repeats,
+    stored as name/<label>. """
+    return ScanPlan(name,
+        axes=[RepeatAxis("frame",frames),
+              PositionAxis("position",(controller.xstage,controller.ystage),positions,labels=labels)],
+        detectors=[CameraDetector(cam,exposure=exposure)],
+        shutter=controller.shutter,split="position")
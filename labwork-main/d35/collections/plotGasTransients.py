@@ -11,13 +11,10 @@ import os, sys
 from time import strftime, localtime
 
 import logging
-import warnings
-from ..utils.definitions import ConsoleWindowLogHandler
+from ..utils.qtSignals import ConsoleWindowLogHandler
 from ..utils.functions import find_index, axes_to_rect, highpass
 
-from scipy.stats import exponnorm, norm, expon
-from scipy.optimize import curve_fit, OptimizeWarning
-from scipy.ndimage import uniform_filter1d
+from ..utils.fitting import fitGasTransient as fitTransient, gaussMod, gauss, expodecay
 
 class GasTransientsGui(QtWidgets.QMainWindow):
     def __init__(self, *args, **kwargs):
@@ -134,7 +131,7 @@ class GasTransientsGui(QtWidgets.QMainWindow):
 
     def loadFile(self,filePath):
         # load a file, update plots, run fitting if enabled
-        with h5py.File(filePath,'r') as f:
+        with h5py.File(filePath,'r',swmr=True) as f: # files of a running scan are open in SWMR mode
             try:
                 if not f.attrs['experiment_type']=="gasTransient":
                     self.logger.warning("Loaded File does not appear to be a Gas Transient")
@@ -321,6 +318,9 @@ class GasTransientsGui(QtWidgets.QMainWindow):
 
 
     def dispatchFitResult(self,report):
+        if report["opt"] is None:
+            self.logger.warning("Fit did not converge.")
+            return
         self._lastResult = report
         self.plotFit(report)
         self.updateFitInfo(report)
@@ -374,100 +374,13 @@ class fitGasTransient(QtCore.QObject):
         self.unbound = False
         self.maxfev = 10000
 
-    def gauss_mod(x,c,s,a,bg,l=3e-3):
-        s/=(2*np.sqrt(2*np.log(2))) # FWHM to sigma
-        k = 1/(s*l)
-        return exponnorm.pdf(-x,k,loc=-c,scale=s)*a+bg
-
-    def gauss(x,c,s,a,bg,*args):
-        s/=(2*np.sqrt(2*np.log(2)))
-        return norm.pdf(-x,loc=-c,scale=s)
-
-    def expodecay(x,c,s,a,bg,l=3e-3):
-        ex = expon.pdf(-x,loc=-c,scale=1/l)*a+bg
-        return ex
-
+    gauss_mod = staticmethod(gaussMod)
+    gauss = staticmethod(gauss)
+    expodecay = staticmethod(expodecay)
 
     def runFit(self):
-        delay_vector_fs = 6.6*self.x_values
-        data = self.data
-
-        # guess sign and correct data
-        sig1 = np.sign(np.max(uniform_filter1d(data[:],5,mode="nearest")))
-        if self.force_invert:
-            sig1 = -sig1        
-        data *= sig1
-
-        fit = fitGasTransient.gauss_mod
-        if self.fix_decay:
-            # Order of parameters: t0, FWHM, Amplitude, bg, [Gamma]
-            inital_guess = [np.mean(delay_vector_fs),15.0,0.2,0.0]
-        else:
-            inital_guess = [np.mean(delay_vector_fs),15.0,0.2,0.0,3e-2]
-
-        """ Set bounds
-        Bind t0 to be on the scanned range, 
-        the FWHM to be shorter than the scanned range and longer than the single cycle limit
-        the amplitude to be positive. """
-        bounds_max = [np.max(delay_vector_fs),np.max(delay_vector_fs)-np.min(delay_vector_fs), np.inf, np.inf]
-        bounds_min = [np.min(delay_vector_fs),2.6,0,-np.inf]
-        # Optionally, the decay to be not faster than 0.6fs and larger than 0
-        if not self.fix_decay:
-            bounds_max.append(1)
-            bounds_min.append(0)
-
-        error = error1 = False
-        # First Run
-        with warnings.catch_warnings():
-            warnings.simplefilter("error", OptimizeWarning)
-            try:
-                              
-                popt,pcov=curve_fit(fit,delay_vector_fs,data,p0=inital_guess,maxfev=self.maxfev,bounds=(bounds_min,bounds_max))
-                A=popt
-                Aerr=(np.sqrt(np.diag(pcov)))
-                residual= np.sum(np.abs((data-fit(delay_vector_fs,*popt))))
-                
-
-            except OptimizeWarning:
-                residual=np.inf
-                error=True
-                
-            except RuntimeError:
-                residual=np.inf
-                error=True
-
-        if self.try_invert:
-            with warnings.catch_warnings():
-                warnings.simplefilter("error", OptimizeWarning)
-                try:
-                                  
-                    popt,pcov=curve_fit(fit,delay_vector_fs,-data,p0=inital_guess,maxfev=self.maxfev,bounds=(bounds_min,bounds_max))
-                    if np.sum(np.abs((-data-fit(delay_vector_fs,*popt))))<residual:
-                        # Second fit was better
-                        A=popt
-                        Aerr=(np.sqrt(np.diag(pcov)))
-                        residual= np.sum(np.abs((-data-fit(delay_vector_fs,*popt))))
-                        data*=-1
-                    
-
-                except OptimizeWarning:
-                    if error==0: # First run worked, this one didn't
-                        pass
-                    residual=np.inf 
-                    error=1
-                    
-                except RuntimeError:
-                    if error==0:
-                        pass
-                    residual=np.inf
-                    error=1
-
-        self.report= dict(
-            x=self.x_values,
-            y=data,
-            opt=A,
-            err=Aerr,
-            residual=residual)
+        self.report = fitTransient(self.x_values,self.data,fix_decay=self.fix_decay,
+            force_invert=self.force_invert,try_invert=self.try_invert,maxfev=self.maxfev)
         self.fitFinished.emit(self.report)
 
 
@@ -0,0 +1,94 @@
+"""
+Delay orderings for pump-probe scans.
+
+All scans used to walk the delays monotonically and restart at the first delay
+for every iteration, which costs a long fly-back move at the start of each scan.
+The functions here return the order (as indices into the sorted delay vector)
+in which the delays should be visited, for a given scan iteration:
+
+- linear: always from first to last delay
+- serpentine: alternate the direction on every iteration
+- interleaved: stratified passes over the delay range, every pass visits
+  every stride-th delay, alternating direction between passes
+- shuffled: random permutation, decorrelates drifts from the delay
+
+Scans store the order with the data (attribute "acquisition_order") so that the
+analysis can re-sort the points by acquisition time, e.g. to correct for drifts.
+"""
+import numpy as np
+
+from ..utils.motion import DEFAULT_MOTION_MODEL
+
+ORDERS = ("linear","serpentine","interleaved","shuffled")
+
+
+def linearOrder(n,iteration=0):
+    return np.arange(n)
+
+def serpentineOrder(n,iteration=0):
+    order = np.arange(n)
+    if iteration%2:
+        return order[::-1]
+    return order
+
+def interleavedOrder(n,iteration=0,stride=None):
+    """ Visit every stride-th delay per pass. Consecutive passes alternate the direction,
+    so the stage never has to travel back over the full range. """
+    if stride is None:
+        stride = max(1,int(np.ceil(np.sqrt(n))))
+    passes = []
+    for k in range(stride):
+        idx = np.arange(k,n,stride)
+        passes.append(idx if k%2==0 else idx[::-1])
+    order = np.concatenate(passes) if passes else np.arange(0)
+    if iteration%2:
+        return order[::-1]
+    return order
+
+def shuffledOrder(n,iteration=0,seed=None):
+    """ Random permutation. If seed is given, the order is reproducible per iteration. """
+    rng = np.random.default_rng(None if seed is None else seed+iteration)
+    return rng.permutation(n)
+
+def delayOrder(kind,n,iteration=0,**kwargs):
+    """ Return the acquisition order for n delays as an integer array of indices. """
+    if kind == "linear":
+        return linearOrder(n,iteration)
+    if kind == "serpentine":
+        return serpentineOrder(n,iteration)
+    if kind == "interleaved":
+        return interleavedOrder(n,iteration,stride=kwargs.get("stride",None))
+    if kind == "shuffled":
+        return shuffledOrder(n,iteration,seed=kwargs.get("seed",None))
+    raise ValueError("Unknown scan order '{}', use one of {}".format(kind,ORDERS))
+
+
+def estimateScanTime(positions,order,model=DEFAULT_MOTION_MODEL,start=None):
+    """ Estimate travel and move time to visit positions in the given order.
+    If start is None the stage is assumed to already sit at the first position.
+    Returns (travel distance, time in s). """
+    path = np.asarray(positions,dtype=np.double)[np.asarray(order,dtype=int)]
+    if start is not None:
+        path = np.concatenate(([start],path))
+    steps = np.diff(path)
+    if len(steps) == 0:
+        return 0., 0.
+    return float(np.sum(np.abs(steps))), float(np.sum(model.moveTime(steps)))
+
+def compareOrders(positions,model=DEFAULT_MOTION_MODEL,iterations=1,kinds=ORDERS,start=None,**kwargs):
+    """ Estimate travel and time for repeated scans with each ordering.
+    The stage position is carried over between iterations, so the fly-back move
+    at the start of each scan is included. Returns dict kind -> (travel, time). """
+    positions = np.asarray(positions,dtype=np.double)
+    report = dict()
+    for kind in kinds:
+        travel = duration = 0.
+        pos = start
+        for iteration in range(iterations):
+            order = delayOrder(kind,len(positions),iteration,**kwargs)
+            dist, dt = estimateScanTime(positions,order,model,start=pos)
+            travel += dist
+            duration += dt
+            pos = positions[order[-1]] if len(order) else pos
+        report[kind] = (travel,duration)
+    return report
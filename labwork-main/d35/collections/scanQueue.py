@@ -0,0 +1,329 @@
+"""
+Scan queue for unattended operation.
+
+A list of scan definitions is run back to back. A definition is a dict with
+the parameters of the SETTINGS BLOCK of the matching script and its type:
+    gasTransient  cell_x, cell_y, piezo_start, piezo_end, piezo_step, camera_exposure
+                  (runGasTransient.py)
+    transient     a TransientSession config: sample_x, sample_y, piezo_start, ...,
+                  max_scans defaults to 1 (runTransientScan.py)
+    statics       sample=(x, y), membrane=(x, y), num_frames, camera_exposure
+                  (statics.py)
+all optionally with name (added to the file names), long_delay_pos and the
+camera settings camera_gain, camera_slow, camera_high_sensitivity, camera_temp.
+
+The queue visits the definitions in the order that needs the least time for
+sample stage and long stage moves (motion models, see utils/motion.py) and
+camera reconfigurations, greedily from the current stage position. Every
+reference_interval s a gas transient reference is taken, pump-probe sessions
+take their own before every scan.
+
+Progress is kept in a ScanJournal (checkpoint.py) next to the data, an
+interrupted queue continues with ScanQueue.resume and skips the completed
+definitions. A failing definition is logged, the shutter is closed and the
+camera acquisition cleared, and the queue continues with the next one. A
+failing gas reference is recorded as reference_N, the definition it preceded
+still runs. The queue stops on the controller's abort or stop, or after
+max_failures failures in a row, which rather points at the hardware.
+
+    queue = ScanQueue(entries,destination_folder,cam=cam,stageController=controller,
+        reference=dict(cell_x=12.8,cell_y=19.2,piezo_start=5,piezo_end=15,piezo_step=0.1,camera_exposure=40))
+    queue.run()
+"""
+import os
+import time
+
+import numpy as np
+
+from .checkpoint import ScanJournal, deviceConfiguration
+from .engine import PipelinedExecutor
+from .plans import backgroundPlan, staticsPlan
+from ..utils.motion import DEFAULT_MOTION_MODEL
+from ..utils.streamWriter import StreamWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENTRY_TYPES = ("gasTransient","transient","statics")
+
+# entry key, XUVCamera setter, conversion
+CAMERA_SETTINGS = (("camera_exposure","setExposure",int),
+                   ("camera_gain","setGain",int),
+                   ("camera_slow","setSpeed",lambda slow: not slow),
+                   ("camera_high_sensitivity","setADCLowNoise",bool),
+                   ("camera_temp","setTemperature",float))
+
+TRANSIENT_DEFAULTS = dict(max_scans=1,filename_base="scan_",filename_extension="",filename_addDate=True,
+    fileinfo="",show_average=False)
+
+
+def entryPosition(entry):
+    """ Sample stage position (x, y) and long stage position (None if not
+    set) at which the entry starts and ends. """
+    kind = entry["type"]
+    if kind == "gasTransient":
+        x, y = entry["cell_x"], entry["cell_y"]
+    elif kind == "transient":
+        x, y = entry["sample_x"], entry["sample_y"]
+    elif kind == "statics":
+        # background and the last frame are taken on the sample
+        x, y = entry["sample"]
+    else:
+        raise ValueError("Unknown scan type '{}', use one of {}".format(kind,ENTRY_TYPES))
+    return (float(x),float(y)), entry.get("long_delay_pos")
+
+def cameraKey(entry):
+    return tuple(entry.get(key) for key, setter, convert in CAMERA_SETTINGS)
+
+def changeCost(position,camera,entry,models=None,reconfigure_time=2.):
+    """ Time in s to get from stage position and camera settings to the start of entry.
+    models are the MotionModels of the x, y and long stage, the stages move together. """
+    models = (DEFAULT_MOTION_MODEL,)*3 if models is None else models
+    (x, y), long = entryPosition(entry)
+    times = [0.]
+    if position is not None:
+        (x0, y0), long0 = position
+        times += [float(models[0].moveTime(abs(x-x0))),float(models[1].moveTime(abs(y-y0)))]
+        if long is not None and long0 is not None:
+            times.append(float(models[2].moveTime(abs(long-long0))))
+    cost = max(times)
+    if camera is not None and any(new is not None and old is not None and new != old for new, old in zip(cameraKey(entry),camera)):
+        cost += reconfigure_time
+    return cost
+
+def orderEntries(entries,start=None,camera=None,models=None,reconfigure_time=2.):
+    """ Indices of entries in the order of least stage travel and camera
+    reconfiguration time (nearest neighbour), starting at the stage position
+    start ((x, y), long) with the camera settings camera (see cameraKey). """
+    remaining = list(range(len(entries)))
+    order = []
+    position = start
+    camera = (None,)*len(CAMERA_SETTINGS) if camera is None else camera
+    while remaining:
+        costs = [changeCost(position,camera,entries[n],models,reconfigure_time) for n in remaining]
+        n = remaining.pop(int(np.argmin(costs)))
+        order.append(n)
+        xy, long = entryPosition(entries[n])
+        if long is None and position is not None:
+            long = position[1] # the long stage stays where it is
+        position = (xy,long)
+        camera = tuple(old if new is None else new for new, old in zip(cameraKey(entries[n]),camera))
+    return order
+
+
+class ScanQueue(object):
+    """ Runs a list of scan definitions, see module doc. """
+
+    def __init__(self,entries,destination_folder,cam,stageController,wait_function=None,reference=None,
+                 reference_interval=1800.,optimize=True,max_failures=3,journal=None,logger=None):
+        self.cam = cam
+        self.controller = stageController
+        self.wait_function = wait_function if wait_function is not None else (lambda: time.sleep(1e-3))
+        self.destination_folder = destination_folder
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.max_failures = max_failures
+        if journal is None:
+            for entry in entries:
+                entryPosition(entry) # check the definitions before anything runs
+            if reference is not None:
+                reference = dict(reference,type="gasTransient",name=reference.get("name","reference"))
+            order = orderEntries(entries,self._stagePosition(),models=self._motionModels()) if optimize else list(range(len(entries)))
+            os.makedirs(destination_folder,exist_ok=True)
+            journal = ScanJournal(os.path.join(destination_folder,"queue_"+time.strftime("%Y_%m_%d_%H_%M_%S")+".jsonl"),
+                config=dict(entries=list(entries),order=order,reference=reference,reference_interval=reference_interval))
+        self.journal = journal
+        self.entries = journal.config["entries"]
+        self.order = journal.config["order"]
+        self.reference = journal.config["reference"]
+        self.reference_interval = journal.config["reference_interval"]
+        self.executor = PipelinedExecutor(stageController,self.wait_function)
+        self._camera = dict() # settings applied by the queue
+        self._lastReference = None # time.time() of the last gas transient
+        self._references = 0
+
+    @classmethod
+    def resume(cls,journal_file,**kwargs):
+        """ Continue the queue of journal_file, failed definitions are run again. """
+        journal = ScanJournal(journal_file)
+        return cls(None,os.path.dirname(journal_file),journal=journal,**kwargs)
+
+    def _stagePosition(self):
+        try:
+            position = (self.controller.xstage.getPosition(),self.controller.ystage.getPosition())
+            return position, self.controller.longStage.getPosition()
+        except Exception as e:
+            self.logger.debug("Could not read stage positions: {}".format(e))
+            return None
+
+    def _motionModels(self):
+        return tuple(getattr(getattr(self.controller,name,None),"motionModel",None) or DEFAULT_MOTION_MODEL
+            for name in ("xstage","ystage","longStage"))
+
+    def pending(self):
+        """ Entry indices still to run, in queue order. """
+        return [n for n in self.order if not self.journal.isDone(n,"entry")]
+
+    def label(self,n):
+        if isinstance(n,str): # reference_N
+            return "gasTransient {}".format(n)
+        entry = self.entries[n]
+        return "{} {}".format(entry["type"],entry.get("name",n))
+
+    def applyCameraSettings(self,entry):
+        """ Set the camera settings of entry that differ from the ones set before. """
+        for key, setter, convert in CAMERA_SETTINGS:
+            value = entry.get(key)
+            if value is None or self._camera.get(key) == value:
+                continue
+            getattr(self.cam,setter)(convert(value))
+            self._camera[key] = value
+            self.logger.info("... {}: {}".format(key,value))
+
+    def _prepare(self,entry):
+        self.applyCameraSettings(entry)
+        long = entry.get("long_delay_pos")
+        if long is not None and entry["type"] != "gasTransient": # the gas transient plan moves it itself
+            self.controller.longStage.setPosition(long)
+            while not self.controller.longStage.isOnTarget():
+                self.wait_function()
+
+    def _fileExtension(self,entry):
+        return entry.get("filename_extension",str(entry["name"])+"_" if "name" in entry else "")
+
+    def _runGasTransient(self,entry,n=None):
+        from .scans import GasTransient # needs the hardware setup of d35.py
+        gasTransient = GasTransient(entry["cell_x"],entry["cell_y"],entry["piezo_start"],entry["piezo_end"],entry["piezo_step"],
+            cam=self.cam,stageController=self.controller,camera_exposure=entry.get("camera_exposure",40),
+            long_delay_pos=entry.get("long_delay_pos"),fileinfo=entry.get("fileinfo",""),filename_extension=self._fileExtension(entry),
+            data_folder=self.destination_folder,experiment_folder="",logger=self.logger,wait_function=self.wait_function)
+        gasTransient.run()
+        self._lastReference = time.time()
+        return gasTransient.data_file
+
+    def _runTransient(self,entry,n):
+        from .scans import TransientSession # needs the hardware setup of d35.py
+        kwargs = dict(cam=self.cam,stageController=self.controller,wait_function=self.wait_function,logger=self.logger)
+        journal = self.journal.files.get(n)
+        if journal is not None and os.path.exists(journal):
+            # started before the queue was interrupted
+            session = TransientSession.resume(journal,**kwargs)
+        else:
+            config = dict(TRANSIENT_DEFAULTS)
+            config["filename_extension"] = self._fileExtension(entry)
+            config.update({key: value for key, value in entry.items() if key not in ("type","name")})
+            session = TransientSession(config,self.destination_folder,**kwargs)
+            self.journal.startScan(n,session.journal.path)
+        session.run()
+        self._lastReference = time.time() # the session takes a gas reference before every scan
+        return session.journal.path
+
+    def _runStatics(self,entry,n=None):
+        exposure = entry.get("camera_exposure",50)
+        sample, membrane = tuple(entry["sample"]), tuple(entry["membrane"])
+        file_name = entry.get("filename_base","static_")+self._fileExtension(entry)+time.strftime("%Y_%m_%d_%H_%M_%S")+".hdf5"
+        writer = StreamWriter(os.path.join(self.destination_folder,file_name),swmr=True)
+        try:
+            writer.setAttrs("/",experiment_type="static",fileinfo=entry.get("fileinfo",""),timestamp=time.time())
+            writer.group("script_parameters",attrs=dict(entry,sample_x=sample[0],sample_y=sample[1],membrane_x=membrane[0],membrane_y=membrane[1]))
+            background = backgroundPlan(self.controller,self.cam,sample[0],sample[1],entry.get("background_frames",10),pump=False,timeout=exposure*10)
+            plan = staticsPlan(self.controller,self.cam,[membrane,sample],["membrane","sample"],entry["num_frames"],exposure=exposure)
+            self.executor.declare(background,writer.group("data/bg0"))
+            self.executor.declare(plan,writer.group("data"))
+            self.executor.run(background,keep=False)
+            self.executor.run(plan,keep=False)
+        finally:
+            writer.close()
+        return writer.filename
+
+    def _runEntry(self,n):
+        """ Run definition n, return its data file (the session journal of pump-probe scans). """
+        entry = self.entries[n]
+        self._prepare(entry)
+        runners = dict(gasTransient=self._runGasTransient,transient=self._runTransient,statics=self._runStatics)
+        return runners[entry["type"]](entry,n)
+
+    def _recover(self):
+        """ Leave the hardware in a safe state after a failure. """
+        for action, call in (("close the shutter",lambda: self.controller.shutter.setShutter(False)),
+                             ("stop the camera",self.cam.stopFrame),
+                             ("clear the camera",self.cam.clearAcquisition)):
+            try:
+                call()
+            except Exception as e:
+                self.logger.error("Could not {} after the failure: {}".format(action,e))
+
+    def _referenceDue(self):
+        if self.reference is None:
+            return False
+        return self._lastReference is None or time.time()-self._lastReference>=self.reference_interval
+
+    def _referenceKey(self):
+        return "reference_{}".format(self._references)
+
+    def takeReference(self):
+        self.logger.info("Taking gas reference {}".format(self._references))
+        try:
+            self._prepare(self.reference)
+            data_file = self._runGasTransient(self.reference)
+            self.journal.startScan(self._referenceKey(),data_file)
+        finally:
+            self._references += 1 # a failed reference keeps its key in the journal
+
+    def _recordFailure(self,key,error,failures):
+        failures[key] = error
+        self.journal.mark(key,"failed",None)
+        self.journal.commit()
+        self._recover()
+
+    def _stopRequested(self):
+        return self.controller.stopped or self.controller.aborted
+
+    def run(self):
+        """ Run the pending definitions, returns {entry index: error} of the failed ones,
+        failed gas references are included as {"reference_N": error}. """
+        self.journal.recordDevices(deviceConfiguration(self.controller,self.cam))
+        pending = self.pending()
+        self.logger.info("Scan queue {}: {} of {} scans to do".format(self.journal.path,len(pending),len(self.entries)))
+        failures = dict()
+        in_a_row = 0
+        for n in pending:
+            if self._referenceDue():
+                # a failed reference is not blamed on the entry, which runs anyway
+                key = self._referenceKey()
+                try:
+                    self.takeReference()
+                except Exception as e:
+                    self.logger.exception("Queue: gas reference {} failed, continuing with {}.".format(key,self.label(n)))
+                    self._recordFailure(key,e,failures)
+                    in_a_row += 1
+                    if in_a_row>=self.max_failures:
+                        self.logger.error("Queue: {} failures in a row, stopping. Continue with ScanQueue.resume({!r}) after checking the hardware.".format(in_a_row,self.journal.path))
+                        break
+                if self._stopRequested():
+                    break
+            try:
+                self.logger.info("Queue: starting {} ({} of {})".format(self.label(n),self.order.index(n)+1,len(self.order)))
+                start = time.time()
+                data_file = self._runEntry(n)
+            except Exception as e:
+                self.logger.exception("Queue: {} failed, continuing with the next scan.".format(self.label(n)))
+                self._recordFailure(n,e,failures)
+                in_a_row += 1
+                if in_a_row>=self.max_failures:
+                    self.logger.error("Queue: {} failures in a row, stopping. Continue with ScanQueue.resume({!r}) after checking the hardware.".format(in_a_row,self.journal.path))
+                    break
+            else:
+                in_a_row = 0
+                if self._stopRequested():
+                    self.logger.info("Queue: stopped during {}".format(self.label(n)))
+                    break
+                if self.journal.files.get(n) != data_file:
+                    self.journal.startScan(n,data_file)
+                self.journal.mark(n,"entry",None)
+                self.journal.commit()
+                self.logger.info("Queue: {} done in {:.0f} s".format(self.label(n),time.time()-start))
+            if self._stopRequested():
+                break
+        remaining = len(self.pending())
+        self.logger.info("Queue finished, {} failed, {} not done".format(len(failures),remaining))
+        return failures
@@ -23,82 +23,56 @@ import logging
 import numpy as np
 
 from .d35 import ExperimentHelper, cam, controller, wait_function
+from .scanOrder import delayOrder, estimateScanTime
+from ..utils.streamWriter import StreamWriter
+from ..utils.motion import DEFAULT_MOTION_MODEL
+from ..utils.frameGeometry import frameGeometry
+from .checkpoint import ScanJournal, deviceConfiguration
+from .backgroundCache import BackgroundCache, cameraSettings
+from .adaptiveSampling import AdaptiveDelaySampler
+from .aggregator import ScanAggregator
+from .convergenceView import ConvergenceView
+from .engine import PipelinedExecutor
+from .plans import backgroundPlan, gasTransientPlan, transientPlan, staticsPlan
+
+
+def cachedBackground(executor,controller,cam,x,y,frames=10,pump=False,timeout=10000,cache=None):
+    """ Background frames as taken by backgroundPlan, reused from cache (see
+    backgroundCache.py) while the camera settings and temperature match. """
+    def acquire():
+        logging.getLogger(__name__).info("Starting Background with pump {}".format("on" if pump else "off"))
+        plan = backgroundPlan(controller,cam,x,y,frames,pump=pump,timeout=timeout)
+        return executor.run(plan)[plan.detectors[0].name]
+    if cache is None:
+        return acquire()
+    key = cameraSettings(cam,background="on" if pump else "off",position=(x,y),frames=frames)
+    try:
+        temperature = cam.getTemperature()
+    except Exception as e:
+        logging.getLogger(__name__).warning("Could not read the sensor temperature: {}".format(e))
+        temperature = None
+    return cache.getOrAcquire(key,acquire,temperature)
 
 
 class Background(object):
-    def __init__(self,membrane_x,membrane_y,frames=10,camera=cam,stageController=controller):
+    def __init__(self,membrane_x,membrane_y,frames=10,camera=cam,stageController=controller,cache=None):
         self._x = membrane_x
         self._y = membrane_y
         self.frames = frames
         
         self.cam = camera
         self.controller = stageController
-        pass
-    
+        self.executor = PipelinedExecutor(stageController,wait_function)
+        self.cache = cache # BackgroundCache, reuse backgrounds of the same camera settings
+
+    def _run(self,pump):
+        return cachedBackground(self.executor,self.controller,self.cam,self._x,self._y,self.frames,pump,cache=self.cache)
+
     def pumpOff(self):
-        results = np.zeros((self.frames,1340),dtype=np.uint16)
-        #logger.info("Starting Background")
-        try:
-            
-            #logger.debug("Locking GUI")
-            self.cam.requestAcquisitionLock()   
-            #logger.info("Starting Background with pump off") 
-            self.controller.shutter.setShutter(False)
-            self.controller.ystage.setPosition(self._y)
-            self.controller.xstage.setPosition(self._x)      
-            while not (self.controller.ystage.isOnTarget() and self.controller.xstage.isOnTarget()):
-                wait_function()    
-            for n in range(self.frames):      
-                while not self.cam.clearAcquisition():
-                    wait_function()
-                    
-                #logger.info("Take Background")
-                results[n,:] = ExperimentHelper.getSpectrum(10000)
-                wait_function()
-            self.cam.clearAcquisition()
-            self.cam.clearAcquisition()
-            self.cam.releaseAcquisitionLock()
-        except:
-            # logger.exception("Aborting Acquisition: An error occured during the scan:")
-            self.controller.shutter.setShutter(False)
-            self.cam.stopFrame()
-            self.cam.releaseAcquisitionLock()
-            raise        
-        return results
+        return self._run(False)
     
     def pumpOn(self):
-        results = np.zeros((self.frames,1340),dtype=np.uint16)
-        #logger.info("Starting Background")
-        try:
-            
-            #logger.debug("Locking GUI")
-            self.cam.requestAcquisitionLock()   
-            #logger.info("Starting Background with pump off") 
-            self.controller.shutter.setShutter(False)
-            self.controller.ystage.setPosition(self._y)
-            self.controller.xstage.setPosition(self._x)      
-            while not (self.controller.ystage.isOnTarget() and self.controller.xstage.isOnTarget()):
-                wait_function()    
-            for n in range(self.frames):      
-                while not self.cam.clearAcquisition():
-                    wait_function()
-                self.controller.shutter.setShutter(True)                    
-                #logger.info("Take Background")
-                results[n,:] = ExperimentHelper.getSpectrum(10000)
-                wait_function()
-                
-            self.controller.shutter.setShutter(False)                
-            self.cam.clearAcquisition()
-            self.cam.clearAcquisition()
-            self.cam.releaseAcquisitionLock()
-        except:
-            # logger.exception("Aborting Acquisition: An error occured during the scan:")
-            self.controller.shutter.setShutter(False)
-            self.cam.stopFrame()
-            self.cam.releaseAcquisitionLock()
-            raise        
-        return results
-       
+        return self._run(True)
 
 
     
@@ -123,6 +97,16 @@ class GasTransient(object):
 
         self.long_delay_pos = kwargs.pop("long_delay_pos",None)
 
+        # Order in which the delays are visited, see scanOrder.py
+        self.scan_order = kwargs.pop("scan_order","linear")
+        self.iteration = kwargs.pop("iteration",0)
+        self.scan_order_seed = kwargs.pop("scan_order_seed",None)
+        self.motion_model = kwargs.pop("motion_model",None)
+        # "uniform" takes every delay, "adaptive" concentrates the points around time zero, see adaptiveSampling.py
+        self.sampling = kwargs.pop("sampling","uniform")
+        self.time_budget = kwargs.pop("time_budget",300) # s, adaptive sampling only
+        self.coarse_step = kwargs.pop("coarse_step",None)
+
         self.file_settings = dict()
         self.file_settings["filename_base"] = kwargs.pop("filename_base","gasTransient_")
         self.file_settings["filename_extension"] = kwargs.pop("filename_extension","")
@@ -133,6 +117,11 @@ class GasTransient(object):
         self.experiment_type = kwargs.pop("experiment_type","gasTransient")
 
         self.wait_function = kwargs.pop("wait_function",QtWidgets.QApplication.processEvents)
+        # Write the spectra to the file while the scan runs, otherwise only on save()
+        self.stream = kwargs.pop("stream",True)
+        self.data_file = None
+        # Write the timing of the scan steps next to the data file, see utils/tracing.py
+        self.save_trace = kwargs.pop("save_trace",False)
 
         # Pre-process some of the settings, create folders & files.
         self.destination_folder = os.path.join(self.data_folder,self.experiment_folder)
@@ -175,30 +164,15 @@ class GasTransient(object):
 
     def _prepareArrays(self):
         self.delays = np.arange(self.piezo_start,self.piezo_stop,self.piezo_step)
-        self.results = np.zeros((len(self.delays),1340),dtype=np.double)
-
-    def _prepareCamera(self):
-        # Prepare Camera
-        self.cam.releasePreviewLock() # Make sure the preview loop is stopped.
-        while not self.cam.clearAcquisition():
-            self.wait_function()
-
-        self.logger.info("Setting camera settings...")
-        if "camera_exposure" in self.cam_settings:
-            self.logger.info("... Exposure: {:d} ms".format(self.cam_settings["camera_exposure"]))
-            self.cam.setExposure(self.cam_settings["camera_exposure"])
-
-        if "camera_gain" in self.cam_settings:
-            pass
-        if "camera_slow" in self.cam_settings:
-            pass
-        if "camera_high_sensitivity" in self.cam_settings:
-            pass
-        if "camera_temperature" in self.cam_settings:
-            pass
-
-        self.logger.debug("Locking GUI.")
-        self.cam.requestAcquisitionLock()
+        self.order = delayOrder(self.scan_order,len(self.delays),self.iteration,seed=self.scan_order_seed)
+        self.geometry = frameGeometry(self.cam) # spectra are as wide as the camera ROI
+        self.results = np.zeros((len(self.delays),self.geometry.columns),dtype=np.double)
+        model = self.motion_model
+        if model is None:
+            model = getattr(self.controller.piezoStage,"motionModel",None)
+        if model is not None:
+            travel, duration = estimateScanTime(self.delays,self.order,model)
+            self.logger.info("Scan order '{}': {:.1f} travel, {:.1f} s estimated stage time.".format(self.scan_order,travel,duration))
 
     def _createConfig(self):
         config =  dict(
@@ -209,8 +183,13 @@ class GasTransient(object):
             piezo_end = self.piezo_stop,
             piezo_step = self.piezo_step,
             fileinfo = self.fileinfo,
-            experiment_type = self.experiment_type                
+            experiment_type = self.experiment_type,
+            scan_order = self.scan_order,
+            iteration = self.iteration,
+            sampling = self.sampling
             )
+        if self.sampling == "adaptive":
+            config["time_budget"] = self.time_budget
         if self.long_delay_pos is not None:
             config["long_delay_pos"] = self.long_delay_pos
         for key in self.cam_settings:
@@ -219,99 +198,251 @@ class GasTransient(object):
             config[key] = self.file_settings[key]
         return config
 
-    def save(self,**kwargs):
-        for key in kwargs:
-            self.file_settings[key] = kwargs[key]
-
-        self.logger.info("Preparing Files...")
+    def _dataFile(self,filename=None):
         # Prepare the file name
-        if "filename" in kwargs:
-            file_base = kwargs["filename"]
+        if filename is not None:
+            file_base = filename
         else:
             file_base = self.file_settings["filename_base"]+self.file_settings["filename_extension"]
         if self.file_settings["filename_addDate"]:
             file_string = file_base+time.strftime("%Y_%m_%d_%H_%M_%S")+".hdf5"
         else:
             file_string = file_base+".hdf5"
-        data_file = os.path.join(self.destination_folder,file_string)
-        f = h5py.File(data_file, "x")
-        f.attrs["experiment_type"] = self.experiment_type
-        f.attrs["fileinfo"] = self.fileinfo
-        f.attrs["timestamp"] = time.time()
-        parameters = f.create_group("script_parameters")
-        config = self._createConfig()
-        for key in config:
-            parameters.attrs[key] = config[key]
-
-        data_group = f.create_group("data")
-
-        data_set = data_group.create_dataset("res0",data=self.results)
-        data_set.attrs["delays"] = self.delays
-        data_set.attrs["x_axis"] = np.arange(self.results.shape[-1])
+        return os.path.join(self.destination_folder,file_string)
+
+    def _openFile(self,filename=None,swmr=None):
+        self.logger.info("Preparing Files...")
+        writer = StreamWriter(self._dataFile(filename),swmr=self.stream if swmr is None else swmr)
+        writer.setAttrs("/",experiment_type=self.experiment_type,fileinfo=self.fileinfo,timestamp=time.time())
+        writer.group("script_parameters",attrs=self._createConfig())
+        return writer
+
+    def save(self,**kwargs):
+        if self.stream and self.data_file is not None:
+            self.logger.info("Spectra were written to {} during the scan".format(self.data_file))
+            return
+        for key in kwargs:
+            self.file_settings[key] = kwargs[key]
+
+        with self._openFile(kwargs.get("filename")) as writer:
+            attrs = dict(delays=self.delays,x_axis=self.geometry.x_axis,
+                # results are stored sorted by delay, keep the order they were taken in
+                acquisition_order=self.order)
+            if self.sampling == "adaptive":
+                attrs["counts"] = self.counts
+            writer.writeDataset("data/res0",self.results,attrs=attrs)
+            self.data_file = writer.filename
 
         self.logger.info("File saved")
 
 
+    def _runAdaptive(self):
+        """ Coarse pass, then batches concentrated around time zero until the time
+        budget is used. results are the mean spectra per visited delay. """
+        self.geometry = frameGeometry(self.cam) # spectra are as wide as the camera ROI, also used by save
+        sampler = AdaptiveDelaySampler(self.piezo_start,self.piezo_stop,self.piezo_step,self.time_budget,coarse_step=self.coarse_step,
+            model=self.motion_model or getattr(self.controller.piezoStage,"motionModel",None) or DEFAULT_MOTION_MODEL)
+        self.logger.info("Starting adaptive Gas Transient on Piezo stage from {:.1f} to {:.1f}, {:.0f} s budget.".format(self.piezo_start,self.piezo_stop,self.time_budget))
+        executor = PipelinedExecutor(self.controller,self.wait_function)
+        writer = self._openFile(swmr=False) if self.stream else None # the averaged spectra are only known at the end
+        if writer is not None:
+            writer.createDataset("data/points",self.geometry.spectrum_shape,attrs=dict(info="all spectra in acquisition order"))
+            writer.createDataset("data/point_delays",())
+        try:
+            batch = sampler.coarse()
+            while batch is not None:
+                start = time.perf_counter()
+                plan = gasTransientPlan(self.controller,self.cam,self.cell_x,self.cell_y,batch,np.arange(len(batch)),
+                    long_delay_pos=self.long_delay_pos,exposure=self.cam_settings.get("camera_exposure"))
+                spectra = executor.run(plan)[plan.detectors[0].name]
+                sampler.update(batch,spectra,time.perf_counter()-start)
+                if writer is not None:
+                    for delay, spectrum in zip(batch,spectra):
+                        writer.append("data/points",spectrum)
+                        writer.append("data/point_delays",delay)
+                if executor.aborted:
+                    break
+                batch = sampler.nextBatch()
+                if sampler.report is not None:
+                    self.logger.info("t0 {:.1f}±{:.1f} fs, FWHM {:.1f}±{:.1f} fs after {:d} points".format(
+                        sampler.report["opt"][0],sampler.report["err"][0],sampler.report["opt"][1],sampler.report["err"][1],len(sampler.delays)))
+            self.delays, self.results = sampler.averagedSpectra()
+            self.counts = sampler.trace()[2]
+            self.order = np.searchsorted(self.delays,np.round(sampler.delays,9)) # delay index of every point taken
+            if writer is not None:
+                writer.writeDataset("data/res0",self.results,attrs=dict(delays=self.delays,x_axis=self.geometry.x_axis,
+                    counts=self.counts,acquisition_order=self.order))
+        finally:
+            if writer is not None:
+                writer.close()
+                self.data_file = writer.filename
+        self.sampler = sampler
+
     def run(self):
+        if self.sampling == "adaptive":
+            return self._runAdaptive()
         self._prepareArrays()
         self.logger.info("Starting Gas Transient on Piezo stage, going from {:.1f} to {:.1f} with {:.01f} steps.".format(self.piezo_start,self.piezo_stop,self.piezo_step))
-        self._prepareCamera()
+        self.logger.info("Setting camera settings...")
+        plan = gasTransientPlan(self.controller,self.cam,self.cell_x,self.cell_y,self.delays,self.order,
+            long_delay_pos=self.long_delay_pos,exposure=self.cam_settings.get("camera_exposure"))
+        executor = PipelinedExecutor(self.controller,self.wait_function)
+        if not self.stream:
+            self.results = executor.run(plan)[plan.detectors[0].name]
+            return
+        writer = self._openFile()
+        try:
+            executor.declare(plan,writer.group("data"))
+            writer.setAttrs("data/res0",acquisition_order=self.order)
+            trace = os.path.splitext(writer.filename)[0]+".trace.json" if self.save_trace else None
+            self.results = executor.run(plan,writer.group("data"),trace=trace)[plan.detectors[0].name]
+        finally:
+            writer.close()
+            self.data_file = writer.filename
+
+
+class TransientSession(object):
+    """ Pump on/off transient scans repeated max_scans times, one file per scan,
+    with a gas reference before every scan. Progress is kept in a ScanJournal
+    next to the files, an interrupted session continues with resume(), which
+    skips the completed scans, backgrounds, gas references and points.
+    The completed scans are averaged in a ScanAggregator, the session stops
+    early once the average reaches target_noise or the operator stops it. """
+
+    def __init__(self,scanConfig,destination_folder,cam=cam,stageController=controller,wait_function=wait_function,journal=None,logger=None):
+        self.config = dict(scanConfig)
+        self.cam = cam
+        self.controller = stageController
+        self.wait_function = wait_function
+        self.destination_folder = destination_folder
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+        self.delays = np.arange(self.config["piezo_start"],self.config["piezo_end"],self.config["piezo_step"])
+        if journal is None:
+            journal = ScanJournal(self._fileName("journal")+".jsonl",config=self.config)
+        self.journal = journal
+        self.executor = PipelinedExecutor(stageController,wait_function)
+        self.backgrounds = None # (off, on)
+        # kept next to the data, so resumed and later sessions of the day reuse the backgrounds
+        self.cache = BackgroundCache(os.path.join(destination_folder,"background_cache.hdf5"),
+            validity=self.config.get("background_validity",3600),max_drift=self.config.get("background_max_drift",0.5))
+        self.aggregator = None
+        self.averageView = None
+
+    @classmethod
+    def resume(cls,journal_file,**kwargs):
+        """ Continue the session of journal_file, reconnect the hardware first. """
+        journal = ScanJournal(journal_file)
+        return cls(journal.config,os.path.dirname(journal_file),journal=journal,**kwargs)
+
+    def _fileName(self,suffix):
+        file_string = self.config["filename_base"]+self.config["filename_extension"]+suffix
+        if self.config["filename_addDate"]:
+            file_string += "_"+time.strftime("%Y_%m_%d_%H_%M_%S")
+        return os.path.join(self.destination_folder,file_string)
+
+    def takeBackgrounds(self):
+        """ Backgrounds (off, on) for the current camera settings, taken again
+        once the cached ones expired or the sensor temperature drifted. """
+        backgrounds = []
+        for pump in (False,True):
+            backgrounds.append(cachedBackground(self.executor,self.controller,self.cam,self.config["sample_x"],self.config["sample_y"],10,
+                pump=pump,timeout=self.config["camera_exposure"]*10,cache=self.cache))
+        self.backgrounds = tuple(backgrounds)
+        return self.backgrounds
+
+    def takeGasReference(self):
+        self.logger.info("Doing gas reference")
+        gasTransient = GasTransient(self.config.get("gas_x",12.8),self.config.get("gas_y",19.1),
+            self.config.get("gas_start",5),self.config.get("gas_end",15),self.config.get("gas_step",0.1),
+            cam=self.cam,stageController=self.controller,camera_exposure=self.config.get("gas_exposure",40),
+            logger=self.logger,wait_function=self.wait_function,data_folder=self.destination_folder,experiment_folder="",stream=False)
+        gasTransient.run()
+        return gasTransient
+
+    def runScan(self,n_scan):
+        """ Take (or complete) scan n_scan. """
+        data_file = self.journal.files.get(n_scan)
+        resume = data_file is not None and os.path.exists(data_file)
+        gasTransient = None if self.journal.isDone(n_scan,"gas") else self.takeGasReference()
+        order = delayOrder(self.config.get("scan_order","linear"),len(self.delays),n_scan)
+
+        if resume:
+            self.logger.info("Resuming scan {} in {}".format(n_scan,data_file))
+            writer = StreamWriter.resume(data_file,swmr=True)
+            if writer.filename != data_file:
+                self.journal.startScan(n_scan,writer.filename) # the crashed file couldn't be reopened
+        else:
+            self.logger.info("Preparing Files...")
+            writer = StreamWriter(self._fileName("scan_{:03d}".format(n_scan))+".hdf5",swmr=True)
+            self.journal.startScan(n_scan,writer.filename)
+        checkpoint = self.journal.scope(n_scan,writer)
+        try:
+            writer.group("script_parameters",attrs=self.config)
+            data_group = writer.group("data",attrs=dict(delays=self.delays,x_axis=frameGeometry(self.cam).x_axis,acquisition_order=order))
+            if not self.journal.isDone(n_scan,"bg0"):
+                off, on = self.takeBackgrounds()
+                writer.writeDataset("data/bg0/off",off)
+                writer.writeDataset("data/bg0/on",on)
+                checkpoint.markPlan("bg0")
+            if gasTransient is not None:
+                writer.writeDataset("data/gas/on",gasTransient.results,attrs=dict(delays=gasTransient.delays))
+                checkpoint.markPlan("gas")
+
+            # Pump on/off at every delay
+            plan = transientPlan(self.controller,self.cam,self.config["sample_x"],self.config["sample_y"],self.delays,order,
+                exposure=self.config["camera_exposure"],target_snr=self.config.get("target_snr"),
+                max_frames=self.config.get("max_frames",20),roi=self.config.get("snr_roi"))
+            trace = os.path.splitext(writer.filename)[0]+".trace.json" if self.config.get("save_trace") else None
+            self.executor.run(plan,data_group,keep=False,checkpoint=checkpoint,trace=trace)
+            if plan.policy is not None:
+                self.logger.info("Scan {}: {}".format(n_scan,plan.policy.summary()))
+            if not self.executor.aborted:
+                checkpoint.markPlan(plan.name)
+        finally:
+            writer.close()
+
+    def _averageFile(self):
+        folder, name = os.path.split(os.path.splitext(self.journal.path)[0])
+        head, sep, tail = name.rpartition("journal")
+        return os.path.join(folder,(head+"average"+tail if sep else name+"_average")+".hdf5")
+
+    def startAverage(self):
+        """ Average of the completed scans, rebuilt from their files on resume. """
+        geometry = frameGeometry(self.cam)
+        aggregator = ScanAggregator(self.delays,geometry.columns,self._averageFile(),x_axis=geometry.x_axis,backgrounds=self.takeBackgrounds(),
+            roi=self.config.get("snr_roi"),target_noise=self.config.get("target_noise"),min_scans=self.config.get("min_scans",3))
+        for scan, data_file in sorted(self.journal.files.items()):
+            if self.journal.isDone(scan,"res0") and os.path.exists(data_file):
+                aggregator.addFile(data_file)
+        return aggregator
 
+    def run(self):
+        """ Take the remaining scans, returns when all are done, the average
+        converged or the scan is stopped. """
+        self.journal.recordDevices(deviceConfiguration(self.controller,self.cam))
+        self.takeBackgrounds()
+        self.aggregator = self.startAverage()
+        if self.config.get("show_average",True):
+            self.averageView = ConvergenceView(self.aggregator)
+            self.averageView.show()
+            self.averageView.refresh()
         try:
-            # Check if stages need to be moved.
-            if not (self.controller.xstage.isPosition(self.cell_x) and self.controller.ystage.isPosition(self.cell_y)):
-                self.logger.info("Moving sample stage to position X:{:.2f} Y:{:.2f}...".format(self.cell_x,self.cell_y))
-                self.controller.shutter.setShutter(False) # Close shutter for safety
-                self.controller.ystage.setPosition(self.cell_y)
-                self.controller.xstage.setPosition(self.cell_x)
-                self.controller.piezoStage.setPosition(self.delays[0])
-            if self.long_delay_pos is not None:
-                if not (self.controller.longStage.isPosition(self.long_delay_pos)):
-                    self.logger.info("Moving long delay stage to position {}...".format(self.long_delay_pos))
-                    self.controller.longStage.setPosition(self.long_delay_pos)
-                    while not self.controller.longStage.isOnTarget():
-                        self.wait_function()
-            while not (self.controller.ystage.isOnTarget() and self.controller.xstage.isOnTarget()):
-                self.wait_function()
-
-            self.logger.info("! Starting Acquisition !")
-            
-            self.controller.shutter.setShutter(True)
-            for n, tau in enumerate(self.delays):
-
-                self.logger.info("At position {}".format(tau))
-                self.controller.piezoStage.setPosition(tau)
-                while not self.cam.clearAcquisition():
-                    self.wait_function()
-                    # Throw away old data
-                while not self.controller.piezoStage.isOnTarget():
-                    self.wait_function()
-
-
-                if not self.cam.startFrame(): # Start acquisition loop        
-                    self.logger.error("Did not start acquisition, error: {}".format(self.cam.cam.getLastError()))
-                err, res = self.cam.grabFrame(timeout=10000)
-                # res = cam.getFrame()
-                if res is not None:
-                    self.results[n,:] = res[0][0,0,:]
-                else:
-                    if err == 32:
-                        self.logger.warning("Could not grab frame")
-                self.wait_function()
-                if self.controller.aborted:
-                    self.logger.warning("Acquisition aborted!")
+            first = self.journal.firstIncomplete(self.config["max_scans"],"res0")
+            for n_scan in range(first,self.config["max_scans"]):
+                self.logger.info("Iteration Nr. {}".format(n_scan))
+                try:
+                    self.runScan(n_scan)
+                except:
+                    self.logger.exception("Scan {} failed, continue with TransientSession.resume({!r}) after reconnecting the hardware.".format(n_scan,self.journal.path))
+                    raise
+                if self.journal.isDone(n_scan,"res0"):
+                    self.aggregator.addFile(self.journal.files[n_scan])
+                if self.controller.stopped or self.controller.aborted:
+                    self.logger.info("Stopping acquisition after scan {}".format(n_scan))
+                    break
+                if self.aggregator.done():
+                    self.logger.info("Stopping acquisition after scan {}, the average {}".format(n_scan,
+                        "converged" if self.aggregator.converged() else "was stopped"))
                     break
-                while self.controller.paused:
-                    self.wait_function()                    
-
-            self.logger.info("Finished acquisition, cleaning up.")
-            self.controller.shutter.setShutter(False)
-            self.cam.clearAcquisition()
-            self.cam.clearAcquisition()
-            self.cam.releaseAcquisitionLock()
-        except:
-            self.logger.exception("Aborting Acquisition: An error occured during the scan:")
-            self.controller.shutter.setShutter(False)
-            self.cam.stopFrame()
-            self.cam.releaseAcquisitionLock()
-            raise
+        finally:
+            self.aggregator.close()
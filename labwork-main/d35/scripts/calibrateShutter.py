@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Calibrate the open/close latency of the D35 shutter
+This is a sample script file to measure the shutter latency.
+
+The script will:
+- Connect to the stages, shutter and camera
+- Measure the camera intensity with the shutter closed and open (optional)
+- Toggle the shutter repeatedly and time command, reported state and intensity change
+- Save the latency distributions per shutter serial, they are loaded automatically
+  on the next connect and used by ThorlabsShutterHardware.waitSettled
+
+Make sure the pump beam is on the camera if the optical cross-check is used.
+"""
+
+import logging
+import numpy as np
+
+from d35 import xuvcamera
+from d35.collections.d35 import D35StageController
+from d35.shutter.calibration import calibrateAndSave
+
+#%%
+"""
+SETTINGS BLOCK
+"""
+calibrationConfig = dict(
+    # Number of open/close cycles
+    repeats = 50,
+    # Cross-check the latency with the camera intensity
+    optical = False,
+    exposure_ms = 1,
+    # Pause between toggles in s
+    pause = 0.1,
+    )
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+#%%
+controller = D35StageController()
+controller.show()
+
+intensity = None
+if calibrationConfig["optical"]:
+    cam = xuvcamera.XUVCamera()
+    window = xuvcamera.XUVCameraGui(device=cam)
+    window.show()
+    window.connect() # Get camera online with default parameters.
+    cam.setExposure(calibrationConfig["exposure_ms"])
+    def intensity():
+        cam.clearAcquisition()
+        cam.startFrame()
+        err, res = cam.grabFrame(timeout=calibrationConfig["exposure_ms"]*10)
+        return float(np.sum(res[0])) if res is not None else np.nan
+
+latency, records = calibrateAndSave(controller.shutter,repeats=calibrationConfig["repeats"],
+    intensity=intensity,pause=calibrationConfig["pause"])
+for state, stats in latency.statistics().items():
+    logger.info("{}: {}".format(state,", ".join("{} {:.3g}".format(key,value) for key, value in stats.items())))
+controller.shutter.setShutter(False)
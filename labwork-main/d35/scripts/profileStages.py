@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Profile the settle time of the D35 stages
+This is a sample script file to measure the motion model of the stages.
+
+The script will:
+- Connect to the stages
+- For each configured stage, run a step-size sweep around the current position
+- Fit a motion model (velocity, acceleration, settle time, command overhead)
+- Save the model per device serial, it is loaded automatically on the next connect
+
+Make sure the beam is blocked and the stages can move freely around their
+current position, then run the script.
+"""
+
+import logging
+import numpy as np
+
+from d35.collections.d35 import D35StageController
+from d35.utils.stageProfiler import profileAndSave
+
+#%%
+"""
+SETTINGS BLOCK
+"""
+profileConfig = dict(
+    # Step sizes to test per stage, in stage units. Comment out stages you don't want to profile.
+    piezoStage = np.geomspace(0.01,5,8), # um
+    xstage = np.geomspace(0.01,2,6), # mm
+    ystage = np.geomspace(0.01,2,6), # mm
+    longStage = np.geomspace(0.001,5,6), # mm
+    # Repeats per step size and direction
+    repeats = 3,
+    )
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+#%%
+controller = D35StageController()
+controller.show()
+
+for name in ["piezoStage","xstage","ystage","longStage"]:
+    if name not in profileConfig:
+        continue
+    stage = getattr(controller,name)
+    logger.info("Profiling {} (serial {})...".format(name,stage.serial))
+    try:
+        model, records = profileAndSave(stage,profileConfig[name],repeats=profileConfig["repeats"])
+    except Exception:
+        logger.exception("Could not profile {}:".format(name))
+        continue
+    logger.info("... {}".format(model))
+    logger.info("... max. overshoot {:g}".format(max(rec["overshoot"] for rec in records)))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Resume an interrupted Transient Pump On/Off Scan
+
+runTransientScan.py keeps a journal (..._journal_<date>.jsonl) next to the data
+files. After an error (shutter timeout, camera error, stage error) fix the
+cause, set journal_file below and run this script. It reconnects the hardware
+and continues the session at the first missing point, completed scans,
+backgrounds, gas references and points are not taken again. The scan settings
+are taken from the journal.
+"""
+
+import os
+import logging
+
+from d35.collections.scans import TransientSession
+from d35.collections.checkpoint import deviceConfiguration
+
+#%%
+"""
+SETTINGS BLOCK
+"""
+# Journal of the session to resume
+journal_file = os.path.join(os.path.expanduser("~"),"Desktop","XUVData","YYYY_MM_DD","scan_PtProperMembrane_journal_YYYY_MM_DD_HH_MM_SS.jsonl")
+
+log_file = os.path.join(os.path.dirname(journal_file),'message.log')
+
+#%%
+
+"""
+Prepare Logfile
+"""
+
+# get instance of the logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+#%%
+
+"""
+Initialize the hardware and show GUI controlls
+"""
+
+logger.info("Initializing Hardware")
+from d35.collections.d35 import cam, xuvgui, controller, ExperimentHelper
+
+ExperimentHelper.initLogger(logger,log_file)
+
+logger.debug("Starting Camera GUI")
+window = xuvgui
+window.show()
+if not window._connected:
+    window.connect() # Get camera online with default parameters.
+
+logger.debug("Starting Controller GUI")
+controller.show()
+
+#%%
+"""
+Load the session
+"""
+
+session = TransientSession.resume(journal_file,cam=cam,stageController=controller,
+    wait_function=ExperimentHelper.refreshGUI,logger=logger)
+scanConfig = session.config
+
+# Prepare Camera
+cam.releasePreviewLock() # Make sure the preview loop is stopped.
+ExperimentHelper.waitForCamera()
+logger.info("... Exposure: {:d} ms".format(scanConfig["camera_exposure"]))
+cam.setExposure(scanConfig["camera_exposure"])
+
+if session.journal.devices:
+    # Settings may have been lost when reconnecting, compare to the last run
+    current = deviceConfiguration(controller,cam)
+    for key, value in session.journal.devices[-1].items():
+        if key.startswith("camera_") and key != "camera_temperature" and current.get(key) != value:
+            logger.warning("{} was {} and is {} now".format(key,value,current.get(key)))
+
+#%%
+"""
+Resume Scan
+"""
+logger.info("! Resuming pump-probe scan !")
+session.run()
+
+#%%
+
+#####################
+# Clean up
+#####################
+
+controller.piezoStage.shutdown()
@@ -18,12 +18,14 @@ run the script.
 import time
 import os
 from PyQt5 import QtCore, QtWidgets
-import h5py
 import logging
 import numpy as np
 
 from d35 import xuvcamera
 from d35.collections.d35 import D35StageController
+from d35.collections.scans import gasTransientPlan
+from d35.collections.engine import PipelinedExecutor
+from d35.utils.streamWriter import StreamWriter
 
 #%%
 """
@@ -127,28 +129,6 @@ exposure_ms = gasTransientConfig["camera_exposure"]
 logger.info("Starting Gas Transient on Piezo stage, going from {:.1f} to {:.1f} with {:.01f} steps.".format(piezo_start,piezo_end,piezo_step))
 
 delays = np.arange(piezo_start,piezo_end,piezo_step)
-results = np.zeros((len(delays),1340),dtype=np.double)
-
-# Prepare Camera
-cam.releasePreviewLock() # Make sure the preview loop is stopped.
-while not cam.clearAcquisition():
-    wait_function()
-
-logger.info("Setting camera settings...")
-logger.info("... Exposure: {:d} ms".format(exposure_ms))
-cam.setExposure(exposure_ms)
-
-if "camera_gain" in gasTransientConfig:
-    pass
-if "camera_slow" in gasTransientConfig:
-    pass
-if "camera_high_sensitivity" in gasTransientConfig:
-    pass
-if "camera_temperature" in gasTransientConfig:
-    pass
-
-logger.debug("Locking GUI")
-cam.requestAcquisitionLock()
 
 logger.info("Preparing Files...")
 # Prepare the file name
@@ -157,79 +137,20 @@ if gasTransientConfig["filename_addDate"]:
 else:
     file_string = gasTransientConfig["filename_base"]+gasTransientConfig["filename_extension"]+".hdf5"
 data_file = os.path.join(destination_folder,file_string)
-f = h5py.File(data_file, "x")
-f.attrs["experiment_type"] = gasTransientConfig["experiment_type"]
-f.attrs["fileinfo"] = gasTransientConfig["fileinfo"]
-f.attrs["timestamp"] = time.time()
-
-parameters = f.create_group("script_parameters")
-for key in gasTransientConfig:
-    parameters.attrs[key] = gasTransientConfig[key]
+# Spectra are streamed to data/res0 while the scan runs, the file can be opened in SWMR mode meanwhile
+writer = StreamWriter(data_file,swmr=True)
+writer.setAttrs("/",experiment_type=gasTransientConfig["experiment_type"],fileinfo=gasTransientConfig["fileinfo"],timestamp=time.time())
+writer.group("script_parameters",attrs=gasTransientConfig)
 
-data_group = f.create_group("data")
+data_group = writer.group("data")
 
+plan = gasTransientPlan(controller,cam,gasTransientConfig["cell_x"],gasTransientConfig["cell_y"],delays,
+    long_delay_pos=gasTransientConfig.get("long_delay_pos"),exposure=exposure_ms,timeout=exposure_ms*10)
+executor = PipelinedExecutor(controller,wait_function)
 try:
-    # Check if stages need to be moved.
-    if not (controller.xstage.isPosition(gasTransientConfig["cell_x"]) and controller.ystage.isPosition(gasTransientConfig["cell_y"])):
-        logger.info("Moving sample stage to position X:{:.2f} Y:{:.2f}...".format(gasTransientConfig["cell_x"],gasTransientConfig["cell_y"]))
-        controller.shutter.setShutter(False) # Close shutter for safety
-        controller.ystage.setPosition(gasTransientConfig["cell_y"])
-        controller.xstage.setPosition(gasTransientConfig["cell_x"])
-        controller.piezoStage.setPosition(delays[0])
-    if "long_delay_pos" in gasTransientConfig:
-        if not (controller.longStage.isPosition(gasTransientConfig["long_delay_pos"])):
-            logger.info("Moving long delay stage to position {}...".format(gasTransientConfig["long_delay_pos"]))
-            controller.longStage.setPosition(gasTransientConfig["long_delay_pos"])
-            while not controller.longStage.isOnTarget():
-                wait_function()
-    while not (controller.ystage.isOnTarget() and controller.xstage.isOnTarget()):
-        wait_function()
-
-    logger.info("! Starting Acquisition !")
-    
-    controller.shutter.setShutter(True)
-    for n, tau in enumerate(delays):
-
-        logger.info("At position {}".format(tau))
-        controller.piezoStage.setPosition(tau)
-        while not cam.clearAcquisition():
-            wait_function()
-            # Throw away old data
-        while not controller.piezoStage.isOnTarget():
-            wait_function()
-
-
-        if not cam.startFrame(): # Start acquisition loop        
-            logger.error("Did not start acquisition, error: {}".format(cam.cam.getLastError()))
-        err, res = cam.grabFrame(timeout=exposure_ms*10)
-        # res = cam.getFrame()
-        if res is not None:
-            results[n,:] = res[0][0,0,:]
-        else:
-            if err == 32:
-                logger.warning("Could not grab frame")
-        wait_function()
-        if controller.aborted:
-            logger.warning("Acquisition aborted!")
-            break
-        while controller.paused:
-            wait_function()
-
-    logger.info("Finished acquisition, cleaning up.")
-    controller.shutter.setShutter(False)
-    cam.clearAcquisition()
-    cam.clearAcquisition()
-    cam.releaseAcquisitionLock()
-except:
-    logger.exception("Aborting Acquisition: An error occured during the scan:")
-    controller.shutter.setShutter(False)
-    cam.stopFrame()
-    cam.releaseAcquisitionLock()
-    raise
+    executor.run(plan,data_group,keep=False)
 finally:
-    data_set = data_group.create_dataset("res0",data=results)
-    data_set.attrs["delays"] = delays
-    data_set.attrs["x_axis"] = np.arange(results.shape[-1])
+    writer.close()
 
 #%%
 
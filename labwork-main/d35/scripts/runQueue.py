@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Run a queue of scans unattended
+
+The scans below are taken back to back (see d35/collections/scanQueue.py):
+- in the order that needs the least stage travel and camera reconfiguration
+- with a gas transient reference every reference_interval seconds
+- a failing scan is logged and skipped, the queue goes on with the next one
+
+Every scan takes the parameters of the SETTINGS BLOCK of its script
+(runGasTransient.py, runTransientScan.py, statics.py) and its type.
+Progress is kept in queue_<date>.jsonl next to the data files. To continue an
+interrupted queue, set resume_file to it and run the script again, completed
+scans are not taken again.
+
+Copy the script to your experiment folder,
+Adapt the configuration parameters (see below),
+run the script.
+"""
+
+import time
+import os
+from PyQt5 import QtCore
+import logging
+
+from d35.collections.scanQueue import ScanQueue
+
+#%%
+"""
+SETTINGS BLOCK
+"""
+scans = [
+    dict(type = "statics", name = "PtSnO2",
+        sample = (14.4,44.7), membrane = (28.40,44.2),
+        num_frames = 100, camera_exposure = 50),
+    dict(type = "transient", name = "PtSnO2_A",
+        sample_x = 14.4, sample_y = 44.7,
+        piezo_start = 5, piezo_end = 15, piezo_step = 0.1,
+        camera_exposure = 40, max_scans = 20, scan_order = "serpentine"),
+    dict(type = "transient", name = "PtSnO2_A_long",
+        sample_x = 14.4, sample_y = 44.7, long_delay_pos = 18.000,
+        piezo_start = 5, piezo_end = 15, piezo_step = 0.5,
+        camera_exposure = 40, max_scans = 10),
+    dict(type = "gasTransient", name = "cell",
+        cell_x = 12.8, cell_y = 19.2,
+        piezo_start = 5, piezo_end = 15, piezo_step = 0.1,
+        camera_exposure = 40),
+]
+
+# Gas transient taken every reference_interval s, set to None for no references
+reference = dict(cell_x = 12.8, cell_y = 19.2, piezo_start = 5, piezo_end = 15, piezo_step = 0.1, camera_exposure = 40)
+reference_interval = 1800
+
+# Keep the order of scans instead of minimising stage travel
+keep_order = False
+# Stop after this many failed scans in a row
+max_failures = 3
+
+# Queue file to continue, e.g. os.path.join(destination_folder,"queue_YYYY_MM_DD_HH_MM_SS.jsonl")
+resume_file = None
+
+data_folder = QtCore.QStandardPaths.locate(QtCore.QStandardPaths.DesktopLocation,"XUVData",QtCore.QStandardPaths.LocateDirectory) # Find XUVData folder on Desktop
+experiment_folder = time.strftime("%Y_%m_%d/") # YYYY_MM_DD/
+
+# Pre-process some of the settings, create folders & files.
+destination_folder = os.path.join(data_folder,experiment_folder)
+if not os.path.exists(destination_folder): # Create folder if it doesn't exist already
+    os.mkdir(destination_folder)
+log_file = os.path.join(destination_folder,'message.log')
+
+#%%
+
+"""
+Prepare Logfile
+"""
+
+# get instance of the logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+#%%
+
+"""
+Initialize the hardware and show GUI controlls
+"""
+
+logger.info("Initializing Hardware")
+from d35.collections.d35 import cam, xuvgui, controller, ExperimentHelper
+
+ExperimentHelper.initLogger(logger,log_file)
+
+logger.debug("Starting Camera GUI")
+window = xuvgui
+window.show()
+if not window._connected:
+    window.connect() # Get camera online with default parameters.
+
+logger.debug("Starting Controller GUI")
+controller.show()
+
+cam.releasePreviewLock() # Make sure the preview loop is stopped.
+ExperimentHelper.waitForCamera()
+
+#%%
+"""
+Run the queue
+"""
+kwargs = dict(cam=cam,stageController=controller,wait_function=ExperimentHelper.refreshGUI,
+    max_failures=max_failures,logger=logger)
+if resume_file is not None:
+    queue = ScanQueue.resume(resume_file,**kwargs)
+else:
+    queue = ScanQueue(scans,destination_folder,reference=reference,reference_interval=reference_interval,
+        optimize=not keep_order,**kwargs)
+logger.info("Queue file: {}".format(queue.journal.path))
+logger.info("! Starting scan queue !")
+failures = queue.run()
+for n, error in failures.items():
+    logger.error("{} failed: {}".format(queue.label(n),error))
+
+#%%
+
+#####################
+# Clean up
+#####################
+
+controller.piezoStage.shutdown()
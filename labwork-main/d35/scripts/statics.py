@@ -18,12 +18,14 @@ run the script.
 import time
 import os
 from PyQt5 import QtCore, QtWidgets
-import h5py
 import logging
 import numpy as np
 
 from d35 import xuvcamera
 from d35.collections.d35 import D35StageController
+from d35.collections.scans import backgroundPlan, staticsPlan
+from d35.collections.engine import PipelinedExecutor
+from d35.utils.streamWriter import StreamWriter
 
 #%%
 """
@@ -123,29 +125,6 @@ exposure_ms = gasTransientConfig["camera_exposure"]
 wait_function = QtWidgets.QApplication.processEvents
 
 
-resultsBackground = np.zeros((10,1340),dtype=np.double)
-resultsMembrane = np.zeros((gasTransientConfig["num_frames"],1340),dtype=np.double)
-resultsSample = np.zeros((gasTransientConfig["num_frames"],1340),dtype=np.double)
-
-# Prepare Camera
-cam.releasePreviewLock() # Make sure the preview loop is stopped.
-while not cam.clearAcquisition():
-    wait_function()
-
-logger.info("Setting camera settings...")
-logger.info("... Exposure: {:d} ms".format(exposure_ms))
-cam.setExposure(exposure_ms)
-
-if "camera_gain" in gasTransientConfig:
-    pass
-if "camera_slow" in gasTransientConfig:
-    pass
-if "camera_high_sensitivity" in gasTransientConfig:
-    pass
-if "camera_temperature" in gasTransientConfig:
-    pass
-
-
 logger.info("Preparing Files...")
 # Prepare the file name
 if gasTransientConfig["filename_addDate"]:
@@ -153,21 +132,28 @@ if gasTransientConfig["filename_addDate"]:
 else:
     file_string = gasTransientConfig["filename_base"]+gasTransientConfig["filename_extension"]+".hdf5"
 data_file = os.path.join(destination_folder,file_string)
-f = h5py.File(data_file, "x")
-f.attrs["experiment_type"] = gasTransientConfig["experiment_type"]
-f.attrs["fileinfo"] = gasTransientConfig["fileinfo"]
-f.attrs["timestamp"] = time.time()
-
-parameters = f.create_group("script_parameters")
-for key in gasTransientConfig:
-    parameters.attrs[key] = gasTransientConfig[key]
-
-parameters.attrs["sample_x"] = sampleConfig["cell_x"]
-parameters.attrs["sample_y"] = sampleConfig["cell_y"]
-parameters.attrs["membrane_x"] = membraneConfig["cell_x"]
-parameters.attrs["membrane_y"] = membraneConfig["cell_y"]
-
-data_group = f.create_group("data")
+# Results are streamed to the file while the scans run, the file can be opened in SWMR mode meanwhile
+writer = StreamWriter(data_file,swmr=True)
+writer.setAttrs("/",experiment_type=gasTransientConfig["experiment_type"],fileinfo=gasTransientConfig["fileinfo"],timestamp=time.time())
+
+parameters = dict(gasTransientConfig)
+parameters["sample_x"] = sampleConfig["cell_x"]
+parameters["sample_y"] = sampleConfig["cell_y"]
+parameters["membrane_x"] = membraneConfig["cell_x"]
+parameters["membrane_y"] = membraneConfig["cell_y"]
+writer.group("script_parameters",attrs=parameters)
+
+data_group = writer.group("data")
+
+executor = PipelinedExecutor(controller,wait_function)
+background = backgroundPlan(controller,cam,sampleConfig["cell_x"],sampleConfig["cell_y"],10,pump=False,timeout=exposure_ms*10)
+# Alternate between membrane and sample, written to data/res0/membrane and data/res0/sample
+plan = staticsPlan(controller,cam,
+    [(membraneConfig["cell_x"],membraneConfig["cell_y"]),(sampleConfig["cell_x"],sampleConfig["cell_y"])],
+    ["membrane","sample"],gasTransientConfig["num_frames"],exposure=exposure_ms)
+# No datasets can be added once the file is in SWMR mode, create both before the first scan
+executor.declare(background,writer.group("data/bg0"))
+executor.declare(plan,data_group)
 
 
 #%%
@@ -175,122 +161,11 @@ data_group = f.create_group("data")
 """
 
 logger.info("Starting Background")
-try:
-    
-    logger.debug("Locking GUI")
-    cam.requestAcquisitionLock()    
-    for n in range(10):
-        controller.ystage.setPosition(sampleConfig["cell_y"])
-        controller.xstage.setPosition(sampleConfig["cell_x"])        
-        while not cam.clearAcquisition():
-            wait_function()
-        while not (controller.ystage.isOnTarget() and controller.xstage.isOnTarget()):
-            wait_function()
-            
-        logger.info("Take Background")
-
-        if not cam.startFrame(): # Start acquisition loop        
-            logger.error("Did not start acquisition, error: {}".format(cam.cam.getLastError()))
-
-        err, res = cam.grabFrame(timeout=exposure_ms*10)
-        # res = cam.getFrame()
-        if res is not None:
-            resultsBackground[n,:] = res[0][0,0,:]
-        else:
-            if err == 32:
-                logger.warning("Could not grab frame")
-        wait_function()
-        
-    logger.info("Finished background, cleaning up.")
-    cam.clearAcquisition()
-    cam.clearAcquisition()
-    cam.releaseAcquisitionLock()
-except:
-    logger.exception("Aborting Acquisition: An error occured during the scan:")
-    controller.shutter.setShutter(False)
-    cam.stopFrame()
-    cam.releaseAcquisitionLock()
-    raise
-finally:
-    sub_group = data_group.create_group("bg0")     
-    data_set = sub_group.create_dataset("off",data=resultsBackground)
-    
-#%%
-
-
-try:
-    # Check if stages need to be moved.
-    controller.shutter.setShutter(False) # Close shutter for safety
-
-
-    logger.info("! Starting Acquisition !")
-
-    for n, tau in enumerate(range(gasTransientConfig["num_frames"])):
-        logger.info("Number {}".format(n))
-        controller.ystage.setPosition(membraneConfig["cell_y"])
-        controller.xstage.setPosition(membraneConfig["cell_x"])
-        while not cam.clearAcquisition():
-            wait_function()
-
-        while not (controller.ystage.isOnTarget() and controller.xstage.isOnTarget()):
-            wait_function()
-
-        logger.info("At membrane")
-            # Throw away old data
-
-
-        if not cam.startFrame(): # Start acquisition loop        
-            logger.error("Did not start acquisition, error: {}".format(cam.cam.getLastError()))
-
-        err, res = cam.grabFrame(timeout=exposure_ms*10)
-
-        # res = cam.getFrame()
-        if res is not None:
-            resultsMembrane[n,:] = res[0][0,0,:]
-        else:
-            if err == 32:
-                logger.warning("Could not grab frame")
-        wait_function()
-        
-        controller.ystage.setPosition(sampleConfig["cell_y"])
-        controller.xstage.setPosition(sampleConfig["cell_x"])
-        while not cam.clearAcquisition():
-            wait_function()
-
-        while not (controller.ystage.isOnTarget() and controller.xstage.isOnTarget()):
-            wait_function()
-
-        logger.info("At sample")
-            # Throw away old data
-
-
-        if not cam.startFrame(): # Start acquisition loop        
-            logger.error("Did not start acquisition, error: {}".format(cam.cam.getLastError()))
-        err, res = cam.grabFrame(timeout=exposure_ms*10)
-        # res = cam.getFrame()
-        if res is not None:
-            resultsSample[n,:] = res[0][0,0,:]
-        else:
-            if err == 32:
-                logger.warning("Could not grab frame")
-        wait_function()        
-    logger.info("Finished acquisition, cleaning up.")
-    controller.shutter.setShutter(False)
-    cam.clearAcquisition()
-    cam.clearAcquisition()
-    cam.releaseAcquisitionLock()
-except:
-    logger.exception("Aborting Acquisition: An error occured during the scan:")
-    controller.shutter.setShutter(False)
-    cam.stopFrame()
-    cam.releaseAcquisitionLock()
-    raise
-finally:
-    sub_group = data_group.create_group("res0")
-    data_set = sub_group.create_dataset("sample",data=resultsSample)    
-    data_set.attrs["x_axis"] = np.arange(resultsSample.shape[-1])
-    data_set = sub_group.create_dataset("membrane",data=resultsMembrane)
-    data_set.attrs["x_axis"] = np.arange(resultsMembrane.shape[-1])
+executor.run(background,keep=False)
 
 #%%
 
+
+logger.info("! Starting Acquisition !")
+executor.run(plan,keep=False)
+writer.close()
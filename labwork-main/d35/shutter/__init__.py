@@ -1 +1 @@
-from .thorlabsShutter import ThorlabsShutterWidget, ThorlabsShutterHardware
\ No newline at end of file
+from .thorlabsShutter import ThorlabsShutterWidget, ThorlabsShutterHardware, ShutterStateError
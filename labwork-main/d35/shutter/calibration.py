@@ -0,0 +1,162 @@
+"""
+Open/close latency calibration for the shutters.
+
+The shutter is toggled repeatedly and for every toggle three times are taken,
+relative to the moment the command is sent:
+    ack     the command call returned (for the SC10 this includes the reply)
+    state   the controller first reports the new state
+    optical the measured intensity crossed half way between the closed and open
+            level (only if an intensity function is given, e.g. the sum of a
+            camera frame)
+The latency of a toggle is the latest of these. The distributions are stored
+per device serial in SHUTTER_LATENCY_FOLDER, ThorlabsShutterHardware loads them
+on open and uses them in waitSettled.
+
+Works with any object offering setShutter(state,timeout=0) and _queryState(),
+i.e. the Kinesis shutter in this package and the SC10 ThorlabsShutterHardware.
+"""
+import os
+import json
+import time
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+SHUTTER_LATENCY_FOLDER = os.path.join(os.path.expanduser("~"),".d35","shutter")
+
+
+class ShutterLatency(object):
+    """ Measured latency distributions in s for opening and closing. """
+
+    def __init__(self,open=(),close=(),quantile=0.99,margin=1e-3):
+        self.open = np.asarray(open,dtype=np.double)
+        self.close = np.asarray(close,dtype=np.double)
+        self.quantile = quantile # quantile of the distribution used as safe wait
+        self.margin = margin # s, added on top of the quantile
+
+    def __repr__(self):
+        return "ShutterLatency(open={:.4g} s, close={:.4g} s)".format(self.safeWait(True),self.safeWait(False))
+
+    def safeWait(self,state):
+        """ Return the time in s after the command after which the shutter is settled in state. """
+        times = self.open if state else self.close
+        if times.size == 0:
+            return 0.
+        return float(np.quantile(times,self.quantile))+self.margin
+
+    def statistics(self):
+        stats = dict()
+        for name, times in (("open",self.open),("close",self.close)):
+            if times.size:
+                t = times*1000
+                stats[name] = dict(n=int(t.size),mean=float(np.mean(t)),median=float(np.median(t)),p95=float(np.percentile(t,95)),max=float(np.max(t)))
+        return stats
+
+    def toDict(self):
+        return dict(open=self.open.tolist(),close=self.close.tolist(),quantile=self.quantile,margin=self.margin)
+
+    @classmethod
+    def fromDict(cls,d):
+        return cls(**{key: d[key] for key in ("open","close","quantile","margin") if key in d})
+
+
+def measureToggle(shutter,state,intensity=None,levels=None,timeout=2.):
+    """ Toggle the shutter to state and return the timestamps of the toggle.
+    levels is the (closed, open) intensity, the optical time is when the intensity
+    crosses the mid point. """
+    t0 = time.perf_counter()
+    shutter.setShutter(state,timeout=0)
+    ack = time.perf_counter()-t0
+    reported = None
+    optical = None if intensity is not None and levels is not None else np.nan
+    threshold = np.mean(levels) if levels is not None else None
+    while reported is None or optical is None:
+        now = time.perf_counter()-t0
+        if now>timeout:
+            raise TimeoutError("Shutter did not reach state {} within {} s".format(state,timeout))
+        if reported is None and bool(shutter._queryState()) == state:
+            reported = time.perf_counter()-t0
+        if optical is None:
+            value = intensity()
+            if bool(value>threshold) == state:
+                optical = time.perf_counter()-t0
+    return dict(state=state,ack=ack,state_time=reported,optical=optical)
+
+def measureLevels(shutter,intensity,repeats=5,settle=0.5):
+    """ Return the mean (closed, open) intensity. """
+    levels = []
+    for state in (False,True):
+        shutter.setShutter(state)
+        time.sleep(settle)
+        levels.append(float(np.mean([intensity() for _ in range(repeats)])))
+    shutter.setShutter(False)
+    if levels[1]<=levels[0]:
+        logger.warning("Open intensity {:g} not above closed intensity {:g}, skipping optical check".format(*levels[::-1]))
+        return None
+    return tuple(levels)
+
+def calibrateShutter(shutter,repeats=50,intensity=None,pause=0.1,timeout=2.):
+    """ Toggle the shutter repeats times open and closed. Returns the list of
+    records of measureToggle. """
+    levels = measureLevels(shutter,intensity) if intensity is not None else None
+    shutter.setShutter(False)
+    time.sleep(pause)
+    records = []
+    for _ in range(repeats):
+        for state in (True,False):
+            rec = measureToggle(shutter,state,intensity,levels,timeout)
+            logger.debug("{}: ack {:.4f} s, state {:.4f} s, optical {:.4f} s".format(
+                "open" if state else "close",rec["ack"],rec["state_time"],rec["optical"]))
+            records.append(rec)
+            time.sleep(pause)
+    return records
+
+def fitLatency(records,**kwargs):
+    """ Build the ShutterLatency from the records of calibrateShutter. """
+    latency = {True: [], False: []}
+    for rec in records:
+        latency[rec["state"]].append(np.nanmax([rec["ack"],rec["state_time"],rec["optical"]]))
+    return ShutterLatency(open=latency[True],close=latency[False],**kwargs)
+
+
+def _latencyFile(serial,folder=None):
+    if folder is None:
+        folder = SHUTTER_LATENCY_FOLDER
+    return os.path.join(folder,"{}.json".format(serial))
+
+def saveShutterLatency(serial,latency,folder=None,**info):
+    """ Store the latency for the device with the given serial. """
+    path = _latencyFile(serial,folder)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    content = dict(serial=str(serial),timestamp=time.time(),latency=latency.toDict(),statistics=latency.statistics())
+    content.update(info)
+    with open(path,"w") as f:
+        json.dump(content,f,indent=2)
+    logger.info("Saved shutter latency for {} to {}".format(serial,path))
+    return path
+
+def loadShutterLatency(serial,folder=None,default=None):
+    """ Load the latency for the device with the given serial, return default if there is none. """
+    if serial is None:
+        return default
+    try:
+        with open(_latencyFile(serial,folder)) as f:
+            return ShutterLatency.fromDict(json.load(f)["latency"])
+    except (OSError,KeyError,ValueError):
+        return default
+
+def calibrateAndSave(shutter,serial=None,folder=None,**kwargs):
+    """ Calibrate the shutter and store the latency under its serial.
+    Returns the latency and the raw records. """
+    if serial is None:
+        serial = getattr(shutter,"serial",None)
+    if serial is None:
+        raise ValueError("No serial known for shutter, pass serial explicitly.")
+    records = calibrateShutter(shutter,**kwargs)
+    latency = fitLatency(records)
+    logger.info("Shutter {}: {}".format(serial,latency))
+    saveShutterLatency(serial,latency,folder=folder,
+        records=[{key: (float(value) if key != "state" else bool(value)) for key, value in rec.items()} for rec in records])
+    shutter.latency = latency
+    return latency, records
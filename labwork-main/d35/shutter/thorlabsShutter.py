@@ -1,8 +1,18 @@
-from PyQt5 import QtGui, QtCore, QtWidgets
+from PyQt5 import QtWidgets
 from pylablib.devices import Thorlabs
 
 from ..utils.widgets import ShutterWidget
+from ..utils.aio import AsyncShutterMixin
+from ..utils.tracing import traced
+from ..utils.observer import Signal
+from ..utils.qtSignals import connectQt
+from ..utils.shadowState import ShadowState, ShutterStateError
+from .calibration import loadShutterLatency
 import time
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class ThorlabsShutterWidget(ShutterWidget):
@@ -15,39 +25,72 @@ class ThorlabsShutterWidget(ShutterWidget):
         self.signalOpenShutter.connect(self.openShutter)
         self.signalCloseShutter.connect(self.closeShutter)
 
-        self._dev.signalOpenedShutter.connect(self.shutterOpened)
-        self._dev.signalClosedShutter.connect(self.shutterClosed)
+        connectQt(self._dev.signalOpenedShutter,self.shutterOpened,self)
+        connectQt(self._dev.signalClosedShutter,self.shutterClosed,self)
 
         
     def openShutter(self):
-        self._dev.setShutter(True)
+        self._dev.setShutter(True,wait_function=QtWidgets.QApplication.processEvents)
 
     def closeShutter(self):
-        self._dev.setShutter(False)
+        self._dev.setShutter(False,wait_function=QtWidgets.QApplication.processEvents)
 
     def _update(self):
-        self._dev.getShutter()
-
-
-
-class ThorlabsShutterHardware(QtCore.QObject):
-    signalOpenedShutter = QtCore.pyqtSignal()
-    signalClosedShutter = QtCore.pyqtSignal()
-    signalDeviceConnect = QtCore.pyqtSignal()
-    signalDeviceDisconnected = QtCore.pyqtSignal()
-
-    def __init__(self):
+        try:
+            self._dev.getShutter()
+        except ShutterStateError:
+            logger.exception("Shutter state mismatch:")
+
+
+
+class ThorlabsShutterHardware(AsyncShutterMixin):
+    """ Kinesis shutter with a shadow state.
+
+    After a confirmed transition the shadow state is trusted for validity
+    seconds, getShutter does not query the controller within that window and
+    requests for the state the shutter is already in or moving to are coalesced.
+    A background thread verifies the shadow state every verify_interval seconds,
+    which also renews the window. A disagreement is reported by stateMismatch and
+    raised as ShutterStateError by the next setShutter or getShutter. The state
+    machine is utils.shadowState.ShadowState, guarded by the device lock. """
+    signalOpenedShutter = Signal()
+    signalClosedShutter = Signal()
+    signalDeviceConnect = Signal()
+    signalDeviceDisconnected = Signal()
+    stateMismatch = Signal(bool) # state reported by the hardware
+
+    def __init__(self,validity=1.0,verify_interval=2.0,transition_timeout=1.0):
         super().__init__()
-        self._shadowShutter = None # Local copy of desired state
-
+        self.verify_interval = verify_interval # s, 0 disables the background verification
+        self.serial = None
+        self.latency = None # see shutter.calibration, loaded on open if calibrated before
+        self.queries = 0 # number of state queries sent
+        # The verifier thread and the GUI share the device and the shadow state
+        self._lock = threading.RLock()
+        self.shadow = ShadowState(validity,transition_timeout,self._lock)
+        self._verifier = None
+        self._stopVerifier = threading.Event()
+
+    @traced("shutter.queryState")
     def _queryState(self):
-        msg = self._dev.query(0x04CC)
+        with self._lock:
+            self.queries += 1
+            msg = self._dev.query(0x04CC)
         return msg.param2==0x01        
 
     def _emitSignal(self, state):
         if state: self.signalOpenedShutter.emit() 
         else: self.signalClosedShutter.emit()
 
+    # read by the async variants of utils.aio
+    _pending = property(lambda self: self.shadow.pending)
+    _shadowShutter = property(lambda self: self.shadow.state)
+    coalesced = property(lambda self: self.shadow.coalesced)
+
+    def _confirm(self,state,emit=True):
+        if self.shadow.confirm(state) or emit:
+            self._emitSignal(state)
+
     def open(self,serial=None):
         if serial is None:
             try:
@@ -57,41 +100,104 @@ class ThorlabsShutterHardware(QtCore.QObject):
                 # But for now let's give up
                 raise
         self._dev = Thorlabs.BasicKinesisDevice(serial)
+        self.serial = serial
+        self.latency = loadShutterLatency(serial)
+        if self.latency is not None:
+            logger.info("Loaded shutter latency for {}: {}".format(serial,self.latency))
         self.signalDeviceConnect.emit()
-        self._shadowShutter = self.getShutter(forceEmit=True)        
+        self.getShutter(forceEmit=True)
+        self._startVerifier()
 
     def close(self):
+        self._stopVerifier.set()
+        if self._verifier is not None:
+            self._verifier.join()
+            self._verifier = None
         self._dev.close()
 
-    def setShutter(self,state=False,timeout=1000):
+    @traced("shutter.setShutter")
+    def setShutter(self,state=False,timeout=1000,wait_function=None):
         """ Open or close the shutter, shutter will open if state is set to true. 
         If timeout is 0, will not check if shutter movement completed.
         If timeout is <0 will wait until shutter movement completed
-        If timeout is >0 will wait value in ms for shutter to movement to complete or raise TimeoutError """
-        # As per Thorlabs Doc, Set SOL is 0x04CB
-        self._dev.send_comm(0x04CB,0x00,0x01 if state else 0x02)
+        If timeout is >0 will wait value in ms for shutter to movement to complete or raise TimeoutError
+        wait_function is called between the state queries, e.g. to keep a GUI responsive """
+        self.shadow.checkMismatch()
+        state = bool(state)
+        with self._lock:
+            if self.shadow.needsCommand(state): # not already there or on the way
+                # As per Thorlabs Doc, Set SOL is 0x04CB
+                self._dev.send_comm(0x04CB,0x00,0x01 if state else 0x02)
+                self.shadow.commanded(state)
         if timeout != 0:
-            return self.waitOnShutter(state,timeout)
+            return self.waitOnShutter(state,timeout,wait_function)
 
 
-    def waitOnShutter(self,state: bool,timeout=1000):
+    @traced("shutter.waitOnShutter")
+    def waitOnShutter(self,state: bool,timeout=1000,wait_function=None):
         """ Wait until shutter reports complete opening """
+        if self.shadow.holds(state):
+            return state
         start = time.time()
         while self._queryState() is not state:
-            QtWidgets.QApplication.processEvents()
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(1e-3) # don't flood the controller with queries
             if timeout>=0 and (time.time()-start)>(timeout/1000.):
                 raise TimeoutError
-        self._shadowShutter = state
-        self._emitSignal(state)
+        self._confirm(state)
         return state
 
+    @traced("shutter.waitSettled")
+    def waitSettled(self,state=None,wait_function=None):
+        """ Wait until the calibrated latency has passed since the last set command.
+        Does nothing if the shutter has not been calibrated. """
+        last, t0 = self.shadow.lastCommand
+        if state is None:
+            state = last
+        if self.latency is None or state is None:
+            return
+        end = t0+self.latency.safeWait(state)
+        while time.perf_counter()<end:
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(min(1e-3,max(end-time.perf_counter(),0)))
+
     def getShutter(self,forceEmit=False):
-        """ Query the state of the shutter, return true if shutter is open """
-        # As per Thorlabs Doc, Req SOL is 0x04CC
-        state = self._queryState()
-        if state is not self._shadowShutter or forceEmit:
+        """ Query the state of the shutter, return true if shutter is open.
+        Within the validity window the shadow state is returned without a query. """
+        self.shadow.checkMismatch()
+        with self._lock:
+            if not forceEmit and self.shadow.valid():
+                return self.shadow.state
+            # As per Thorlabs Doc, Req SOL is 0x04CC
+            state = self._queryState()
+            previous = self.shadow.state
+            confirmed = self.shadow.observed(state)
+        if confirmed and (forceEmit or state is not previous):
             self._emitSignal(state)
-            self._shadowShutter = state
         return state
 
+    def _startVerifier(self):
+        if self.verify_interval <= 0 or (self._verifier is not None and self._verifier.is_alive()):
+            return
+        self._stopVerifier.clear()
+        self._verifier = threading.Thread(target=self._verify,daemon=True)
+        self._verifier.start()
 
+    def _verify(self):
+        while not self._stopVerifier.wait(self.verify_interval):
+            try:
+                with self._lock:
+                    previous = self.shadow.state
+                    error = self.shadow.verify(self._queryState)
+                    state = self.shadow.state
+            except Exception:
+                logger.exception("Shutter verification failed:")
+                continue
+            if error is not None:
+                self.stateMismatch.emit(state)
+            elif state is not previous:
+                self._emitSignal(state) # a pending transition was confirmed
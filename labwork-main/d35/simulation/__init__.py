@@ -0,0 +1,3 @@
+from .stages import SimulatedPIStageHardware, SimulatedThorlabsStageHardware, SimulatedAxis
+from .shutter import SimulatedShutterHardware
+from .camera import SimulatedPicam, simulatedCamera
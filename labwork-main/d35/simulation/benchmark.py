@@ -0,0 +1,441 @@
+"""
+Scan throughput benchmarks on simulated hardware.
+
+Runs the acquisition workflows against the simulated stages, shutter and
+camera of this package, with the latencies given on the command line:
+    gas_transient   the plan and executor of GasTransient.run, streamed to a file
+    pump_probe      one iteration of the pump on/off scan of runTransientScan.py
+                    (TransientSession.runScan), streamed to a SWMR file
+    adaptive        the batches of GasTransient(sampling="adaptive") until
+                    --time-budget is used, streamed to a file. The piezo is
+                    profiled first, with --unprofiled the default motion model
+                    is used, as for a stage that was never profiled
+    preview         spectrum preview of XUVCameraGui, frames per second
+
+For every scan the wall time is split into phases, measured by wrapping the
+calls of the plan's axes, detectors and the file writer:
+    move     starting stage moves            settle   waiting for on target
+    shutter  shutter commands and settling   expose   camera integration
+    readout  waiting for the frame after the exposure ended
+    decode   converting frames               write    HDF5 writes and flushes
+The time to the first exposure covers the setup moves of the plan. Decoding
+and writing run on worker threads in the PipelinedExecutor, so the phases
+overlap and their sum can exceed the wall time. Peak memory is the
+tracemalloc peak of the workflow (python and numpy allocations) and the peak
+RSS of the process where the platform reports it.
+
+    python -m d35.simulation.benchmark --points 50 --exposure 20
+    python -m d35.simulation.benchmark --save-baseline bench.json
+    python -m d35.simulation.benchmark --baseline bench.json --tolerance 0.1
+
+Numbers depend on the machine, compare against a baseline taken on the same
+machine with the same settings. With --baseline the exit code is 1 if a
+workflow got slower or needs more memory than the tolerance allows.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+from PyQt5 import QtCore, QtWidgets
+
+from .stages import SimulatedPIStageHardware, SimulatedThorlabsStageHardware
+from .shutter import SimulatedShutterHardware
+from .camera import simulatedCamera
+from ..collections.engine import ScanExecutor, PipelinedExecutor, StageAxis, PositionAxis, ShutterAxis
+from ..collections.plans import gasTransientPlan, transientPlan
+from ..collections.adaptiveSampling import AdaptiveDelaySampler
+from ..utils.motion import DEFAULT_MOTION_MODEL
+from ..utils.frameGeometry import frameGeometry
+from ..utils.stageProfiler import profileStage, fitProfile, measureOverhead
+from ..utils.streamWriter import StreamWriter
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+PHASES = ("move","settle","shutter","expose","readout","decode","write")
+
+# metric -> True if larger is better, compared against the baseline
+METRICS = {"points_per_s": True, "fps": True, "wall_s": False, "tracemalloc_peak_mb": False}
+
+
+class PhaseTimer(object):
+    """ Wall time per phase, summed over calls from all threads. A call made
+    while its thread is already in a phase is counted to the outer phase. """
+
+    def __init__(self):
+        self.totals = dict.fromkeys(PHASES,0.)
+        self.counts = dict.fromkeys(PHASES,0)
+        self.first = None # perf_counter time of the first exposure
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self,phase,duration):
+        with self._lock:
+            self.totals[phase] += duration
+            self.counts[phase] += 1
+
+    @contextmanager
+    def phase(self,phase):
+        if getattr(self._local,"phase",None) is not None:
+            yield
+            return
+        self._local.phase = phase
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.phase = None
+            self.add(phase,time.perf_counter()-start)
+
+    def wrap(self,obj,name,phase):
+        """ Time obj.name as phase, the method is replaced on the instance. """
+        method = getattr(obj,name)
+        def timed(*args,**kwargs):
+            with self.phase(phase):
+                return method(*args,**kwargs)
+        setattr(obj,name,timed)
+
+    def instrumentPlan(self,plan):
+        for axis in plan.axes:
+            if isinstance(axis,ShutterAxis):
+                self.wrap(axis,"move","shutter")
+                self.wrap(axis,"wait","shutter")
+            elif isinstance(axis,(StageAxis,PositionAxis)):
+                self.wrap(axis,"move","move")
+                self.wrap(axis,"wait","settle")
+        if plan.shutter is not None:
+            for name in ("setShutter","waitSettled"):
+                if not isinstance(getattr(type(plan.shutter),name,None),property):
+                    self.wrap(plan.shutter,name,"shutter")
+        for detector in plan.detectors:
+            self._instrumentDetector(detector)
+
+    def _instrumentDetector(self,detector):
+        start, read = detector.start, detector.read
+        ends = dict()
+        def timedStart():
+            t0 = time.perf_counter()
+            if self.first is None:
+                self.first = t0
+            end = start()
+            ends["end"] = end
+            self.add("expose",(end-t0) if end is not None else 0.)
+            return end
+        def timedRead():
+            t0 = time.perf_counter()
+            raw = read()
+            end = ends.get("end")
+            # the part of the wait after the exposure ended
+            self.add("readout",time.perf_counter()-max(t0,end if end is not None else t0))
+            return raw
+        detector.start = timedStart
+        detector.read = timedRead
+        self.wrap(detector,"decode","decode")
+
+    def instrumentWriter(self,writer):
+        self.wrap(writer,"_write","write")
+        self.wrap(writer,"_flush","write")
+
+
+class SimulatedSetup(object):
+    """ The stages and the pump shutter of D35StageController on simulated
+    hardware, enough to run the plans of plans.py. """
+    paused = False
+    stopped = False
+    aborted = False
+
+    def __init__(self,stage_latency=None,shutter_latency=2e-3,shutter_time=8e-3,seed=0):
+        self.xstage = SimulatedPIStageHardware("C-663",latency=stage_latency,seed=seed)
+        self.ystage = SimulatedPIStageHardware("C-663",latency=stage_latency,seed=seed)
+        self.piezoStage = SimulatedPIStageHardware("E-754",latency=stage_latency,seed=seed)
+        self.longStage = SimulatedThorlabsStageHardware(latency=stage_latency,seed=seed)
+        self.shutter = SimulatedShutterHardware(open_time=shutter_time,close_time=0.75*shutter_time,latency=shutter_latency,seed=seed)
+        for name, stage in (("x",self.xstage),("y",self.ystage),("piezo",self.piezoStage),("long",self.longStage)):
+            stage.open(serial=name,position=10.)
+        self.shutter.open("pump")
+
+
+def _camera(config):
+    cam = simulatedCamera(readout_overhead=config.readout_overhead,AdcSpeed=config.adc_speed,seed=0)
+    cam.setExposure(config.exposure)
+    if config.width is not None or config.xbin != 1:
+        width = config.width if config.width is not None else 1340
+        cam.setROI(0,width,0,400,xbin=config.xbin)
+    cam.commit()
+    return cam
+
+def _executor(config):
+    wait_function = QtWidgets.QApplication.processEvents
+    if config.executor == "plain":
+        return ScanExecutor(None,wait_function)
+    return PipelinedExecutor(None,wait_function)
+
+def _memory():
+    return dict(tracemalloc_peak_mb=tracemalloc.get_traced_memory()[1]/2**20 if tracemalloc.is_tracing() else None)
+
+def _rss():
+    """ Peak RSS of the process in MB, None where not available. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10
+
+def _runPlan(config,plan,writer,group,points):
+    timer = PhaseTimer()
+    timer.instrumentPlan(plan)
+    timer.instrumentWriter(writer)
+    executor = _executor(config)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    executor.run(plan,writer.group(group),keep=False)
+    writer.close()
+    wall = time.perf_counter()-start
+    result = dict(points=points,wall_s=wall,points_per_s=points/wall,
+        first_point_s=timer.first-start if timer.first is not None else None,
+        phases_s={phase: timer.totals[phase] for phase in PHASES})
+    result.update(_memory())
+    return result
+
+
+def benchGasTransient(config,folder):
+    setup = SimulatedSetup(config.stage_latency,config.shutter_latency,config.shutter_time)
+    cam = _camera(config)
+    delays = np.linspace(5,15,config.points,endpoint=False)
+    plan = gasTransientPlan(setup,cam,12.8,19.1,delays,exposure=config.exposure)
+    writer = StreamWriter(os.path.join(folder,"gas_transient.hdf5"))
+    return _runPlan(config,plan,writer,"data",config.points)
+
+def benchPumpProbe(config,folder):
+    setup = SimulatedSetup(config.stage_latency,config.shutter_latency,config.shutter_time)
+    cam = _camera(config)
+    delays = np.linspace(40,60,config.points,endpoint=False)
+    plan = transientPlan(setup,cam,8.,11.,delays,exposure=config.exposure)
+    writer = StreamWriter(os.path.join(folder,"pump_probe.hdf5"),swmr=True)
+    return _runPlan(config,plan,writer,"data",2*config.points)
+
+def benchAdaptive(config,folder):
+    setup = SimulatedSetup(config.stage_latency,config.shutter_latency,config.shutter_time)
+    cam = _camera(config)
+    if not config.unprofiled:
+        # as on the beamline, see utils/stageProfiler.py
+        records = profileStage(setup.piezoStage,(0.1,1.,5.),repeats=1,trackPosition=False)
+        setup.piezoStage.motionModel = fitProfile(records,overhead=measureOverhead(setup.piezoStage))
+    sampler = AdaptiveDelaySampler(5,15,10./config.points,config.time_budget,
+        model=getattr(setup.piezoStage,"motionModel",None) or DEFAULT_MOTION_MODEL)
+    writer = StreamWriter(os.path.join(folder,"adaptive.hdf5"))
+    writer.createDataset("data/points",frameGeometry(cam).spectrum_shape)
+    timer = PhaseTimer()
+    timer.instrumentWriter(writer)
+    executor = _executor(config)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    batch = sampler.coarse()
+    while batch is not None:
+        t0 = time.perf_counter()
+        plan = gasTransientPlan(setup,cam,12.8,19.1,batch,np.arange(len(batch)),exposure=config.exposure)
+        timer.instrumentPlan(plan)
+        spectra = executor.run(plan)[plan.detectors[0].name]
+        sampler.update(batch,spectra,time.perf_counter()-t0)
+        for spectrum in spectra:
+            writer.append("data/points",spectrum)
+        batch = sampler.nextBatch()
+    delays, results = sampler.averagedSpectra()
+    writer.writeDataset("data/res0",results,attrs=dict(delays=delays))
+    writer.close()
+    wall = time.perf_counter()-start
+    points = len(sampler.delays)
+    result = dict(points=points,wall_s=wall,points_per_s=points/wall,
+        first_point_s=timer.first-start if timer.first is not None else None,
+        phases_s={phase: timer.totals[phase] for phase in PHASES})
+    result.update(_memory())
+    return result
+
+def benchPreview(config,folder):
+    from ..xuvcamera import XUVCameraGui
+    cam = _camera(config)
+    gui = XUVCameraGui(device=cam)
+    gui.connect()
+    cam.setExposure(config.exposure) # connect applies the exposure of the GUI
+    gui.cameraExposureSpin.setValue(config.exposure)
+    times = []
+    cam.spectrumReady.connect(lambda spectrum: times.append(time.perf_counter()))
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    loop = QtCore.QEventLoop()
+    QtCore.QTimer.singleShot(int(config.preview_time*1000),loop.quit)
+    start = time.perf_counter()
+    gui.startSpectrum()
+    loop.exec_()
+    wall = time.perf_counter()-start
+    gui.stop()
+    gui._readTemp.stop()
+    gui.close()
+    intervals = np.diff(times)
+    result = dict(frames=len(times),wall_s=wall,fps=len(times)/wall,
+        frame_interval_ms=dict(median=float(np.median(intervals)*1000),p95=float(np.percentile(intervals,95)*1000)) if len(intervals) else None)
+    result.update(_memory())
+    return result
+
+WORKFLOWS = dict(gas_transient=benchGasTransient,pump_probe=benchPumpProbe,adaptive=benchAdaptive,preview=benchPreview)
+
+
+def _median(results):
+    """ Median over repeats of every number in the result dicts. """
+    merged = dict()
+    for key, value in results[0].items():
+        if isinstance(value,dict):
+            merged[key] = _median([r[key] for r in results])
+        elif isinstance(value,(int,float)) and not isinstance(value,bool):
+            merged[key] = float(np.median([r[key] for r in results]))
+        else:
+            merged[key] = value
+    return merged
+
+def _commit():
+    try:
+        return subprocess.run(["git","rev-parse","--short","HEAD"],capture_output=True,text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),timeout=5).stdout.strip() or None
+    except (OSError,subprocess.SubprocessError):
+        return None
+
+def runBenchmarks(config):
+    """ Run the workflows of config, return the report dict. """
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    if config.memory:
+        tracemalloc.start()
+    report = dict(commit=_commit(),time=time.strftime("%Y-%m-%d %H:%M:%S"),machine=platform.node(),
+        python=platform.python_version(),settings=_settings(config),workflows=dict())
+    try:
+        for name in config.workflows:
+            runs = []
+            for n in range(config.repeat):
+                with tempfile.TemporaryDirectory() as folder:
+                    try:
+                        runs.append(WORKFLOWS[name](config,folder))
+                    except ImportError as e:
+                        logger.warning("Skipping {}: {}".format(name,e))
+                        report["workflows"][name] = dict(skipped=str(e))
+                        break
+            if runs:
+                report["workflows"][name] = _median(runs)
+                report["workflows"][name]["repeats"] = len(runs)
+    finally:
+        if config.memory:
+            tracemalloc.stop()
+    report["rss_peak_mb"] = _rss()
+    return report
+
+def _settings(config):
+    return {key: value for key, value in vars(config).items() if key not in ("workflows","baseline","save_baseline","output","tolerance","verbose")}
+
+
+def compareBaseline(report,baseline,tolerance=0.1):
+    """ Relative change of every metric, returns (rows, regressions) with rows
+    (workflow, metric, baseline, current, change). """
+    rows = []
+    regressions = []
+    for name, current in report["workflows"].items():
+        old = baseline.get("workflows",dict()).get(name)
+        if old is None or "skipped" in current or "skipped" in old:
+            continue
+        for metric, larger_better in METRICS.items():
+            if current.get(metric) is None or not old.get(metric):
+                continue
+            change = current[metric]/old[metric]-1
+            rows.append((name,metric,old[metric],current[metric],change))
+            if (-change if larger_better else change)>tolerance:
+                regressions.append((name,metric,change))
+    return rows, regressions
+
+def formatReport(report):
+    lines = ["commit {}  {}  python {}".format(report["commit"],report["time"],report["python"])]
+    for name, result in report["workflows"].items():
+        if "skipped" in result:
+            lines.append("{:<14} skipped: {}".format(name,result["skipped"]))
+            continue
+        if "points_per_s" in result:
+            lines.append("{:<14} {:.0f} points in {:.2f} s, {:.1f} points/s, first exposure after {:.2f} s".format(name,result["points"],result["wall_s"],result["points_per_s"],result["first_point_s"] or 0))
+            lines.append("    "+"  ".join("{} {:.3f}".format(phase,result["phases_s"][phase]) for phase in PHASES)+" (s)")
+        else:
+            lines.append("{:<14} {:.0f} frames in {:.2f} s, {:.1f} fps".format(name,result["frames"],result["wall_s"],result["fps"]))
+        if result.get("tracemalloc_peak_mb") is not None:
+            lines.append("    memory peak {:.1f} MB".format(result["tracemalloc_peak_mb"]))
+    if report.get("rss_peak_mb") is not None:
+        lines.append("process peak RSS {:.0f} MB".format(report["rss_peak_mb"]))
+    return "\n".join(lines)
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m d35.simulation.benchmark",description="Scan throughput benchmarks on simulated hardware.")
+    parser.add_argument("workflows",nargs="*",metavar="workflow",
+        help="any of {} (default all)".format(", ".join(WORKFLOWS)))
+    parser.add_argument("--points",type=int,default=50,help="delays per scan")
+    parser.add_argument("--exposure",type=int,default=20,help="camera exposure in ms")
+    parser.add_argument("--adc-speed",type=float,default=2.0,help="ADC speed in MHz (2 or 0.1 on the PIXIS)")
+    parser.add_argument("--readout-overhead",type=float,default=2e-3,help="s per frame on top of the pixel conversion")
+    parser.add_argument("--width",type=int,default=None,help="ROI width in pixels, default full chip")
+    parser.add_argument("--xbin",type=int,default=1,help="horizontal binning")
+    parser.add_argument("--stage-latency",type=float,default=None,help="s per stage command, default per controller model")
+    parser.add_argument("--shutter-latency",type=float,default=2e-3,help="s per shutter command or query")
+    parser.add_argument("--shutter-time",type=float,default=8e-3,help="s the shutter takes to open")
+    parser.add_argument("--executor",choices=("pipelined","plain"),default="pipelined")
+    parser.add_argument("--time-budget",type=float,default=3.,help="s of adaptive sampling")
+    parser.add_argument("--unprofiled",action="store_true",help="adaptive: don't profile the piezo, use the default motion model")
+    parser.add_argument("--preview-time",type=float,default=3.,help="s of preview")
+    parser.add_argument("--repeat",type=int,default=1,help="runs per workflow, the median is reported")
+    parser.add_argument("--no-memory",dest="memory",action="store_false",help="don't trace allocations (tracemalloc slows allocations down)")
+    parser.add_argument("--output",help="write the report as JSON")
+    parser.add_argument("--save-baseline",help="write the report as baseline JSON")
+    parser.add_argument("--baseline",help="compare to this baseline JSON")
+    parser.add_argument("--tolerance",type=float,default=0.1,help="relative change counted as regression")
+    parser.add_argument("--verbose",action="store_true")
+    config = parser.parse_args(argv)
+    unknown = [name for name in config.workflows if name not in WORKFLOWS]
+    if unknown:
+        parser.error("unknown workflow {}".format(", ".join(unknown)))
+    config.workflows = config.workflows or list(WORKFLOWS)
+    return config
+
+def main(argv=None):
+    config = parseArguments(argv)
+    logging.basicConfig(level=logging.INFO if config.verbose else logging.WARNING)
+    report = runBenchmarks(config)
+    print(formatReport(report))
+    for path in (config.output,config.save_baseline):
+        if path:
+            with open(path,"w") as f:
+                json.dump(report,f,indent=2)
+    if config.baseline:
+        with open(config.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != report["settings"]:
+            print("Warning: baseline was taken with different settings: {}".format(baseline.get("settings")))
+        rows, regressions = compareBaseline(report,baseline,config.tolerance)
+        print("\nCompared to baseline {} ({}):".format(baseline.get("commit"),baseline.get("time")))
+        for name, metric, old, new, change in rows:
+            print("  {:<14} {:<20} {:>10.3f} -> {:>10.3f}  {:+.1%}".format(name,metric,old,new,change))
+        if regressions:
+            print("Regressions beyond {:.0%}: {}".format(config.tolerance,", ".join("{} {}".format(name,metric) for name, metric, change in regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
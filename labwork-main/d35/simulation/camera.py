@@ -0,0 +1,224 @@
+"""
+Simulated camera backend.
+
+SimulatedPicam stands in for the picam wrapper (xuvcamera/picam.py) below
+XUVCamera, so the acquisition code, the locks and the camera GUI run
+unchanged:
+
+    cam = simulatedCamera() # XUVCamera(cam=SimulatedPicam()), connected
+
+A frame is ready exposure plus readout after the acquisition started (frames
+of one acquisition follow each other). The readout time follows the ROI: a
+fixed overhead, a vertical shift per chip row and one conversion per binned
+pixel at the ADC speed (AdcSpeed in MHz), so cropped and binned readouts are
+faster, as on the PIXIS. Spectra are a harmonic comb with shot noise, or
+whatever signal(x_axis, exposure) returns.
+"""
+import threading
+import time
+
+import numpy as np
+
+from ..utils.tracing import traced
+
+import logging
+logger = logging.getLogger(__name__)
+
+# picam error codes (PicamError in xuvcamera/picam_types.py)
+NO_ERROR = 0
+ACQUISITION_IN_PROGRESS = 20
+ACQUISITION_NOT_IN_PROGRESS = 27
+TIMEOUT = 32
+
+DEFAULT_PARAMETERS = dict(
+    ExposureTime=100, # ms
+    AdcAnalogGain=2,
+    AdcQuality=1,
+    AdcSpeed=2.0, # MHz
+    ReadoutCount=1,
+    SensorTemperatureReading=-70.,
+    SensorTemperatureSetPoint=-70.,
+    ActiveWidth=1340,
+    ActiveHeight=400,
+    )
+
+
+def harmonicSpectrum(x_axis,exposure,rng=None,spacing=60.,width=6.,peak=4000.,dark=600.):
+    """ Odd harmonics every spacing chip columns on a dark level, counts for exposure (ms) of 100 ms scaled. """
+    x_axis = np.asarray(x_axis,dtype=np.double)
+    centers = np.arange(spacing,x_axis.max()+spacing,spacing)
+    envelope = np.exp(-((centers-x_axis.mean())/(0.4*np.ptp(x_axis)+1))**2)
+    signal = np.sum(envelope[:,None]*np.exp(-0.5*((x_axis[None,:]-centers[:,None])/width)**2),axis=0)
+    counts = dark+peak*signal*exposure/100.
+    if rng is not None:
+        counts = rng.poisson(np.clip(counts,0,None)).astype(np.double)
+    return counts
+
+
+class SimulatedPicam(object):
+    """ Stand-in for picam, see module doc. Times in s, readout_overhead per
+    frame, shift_time per chip row, readout_rate overrides AdcSpeed (pixels/s). """
+
+    def __init__(self,readout_overhead=2e-3,shift_time=5e-6,readout_rate=None,signal=None,seed=None,**parameters):
+        self.readout_overhead = readout_overhead
+        self.shift_time = shift_time
+        self.readout_rate = readout_rate
+        self.signal = signal
+        self._rng = np.random.default_rng(seed)
+        self._parameters = dict(DEFAULT_PARAMETERS)
+        self._parameters.update(parameters)
+        self.cam = None
+        self.err = NO_ERROR
+        self.frames = 0 # frames delivered
+        self._roi = (0,self._parameters["ActiveWidth"],0,self._parameters["ActiveHeight"],1,self._parameters["ActiveHeight"])
+        self._started = None # time the running acquisition started
+        self._delivered = 0 # frames of the running acquisition returned
+        self._lock = threading.Lock()
+        self.updateROIS()
+
+    # connection
+    def loadLibrary(self,pathToLib=""):
+        pass
+
+    def getAvailableCameras(self):
+        return ["SIM"]
+
+    def connect(self,camID=None):
+        self.cam = "SIM-PIXIS"
+        logger.info("Connected to simulated camera")
+
+    def is_opened(self):
+        return self.cam is not None
+
+    def disconnect(self):
+        self.cam = None
+
+    def getCurrentCameraID(self):
+        return self.cam
+
+    def getLastError(self):
+        return {NO_ERROR: "None", ACQUISITION_IN_PROGRESS: "AcquisitionInProgress",
+            ACQUISITION_NOT_IN_PROGRESS: "AcquisitionNotInProgress", TIMEOUT: "TimeOutOccurred"}.get(self.err,str(self.err))
+
+    # parameters
+    def getParameter(self,name):
+        if name not in self._parameters:
+            logger.warning("Ignoring parameter "+name+".  Parameter does not exist for current camera!")
+            return None
+        return self._parameters[name]
+
+    def setParameter(self,name,value):
+        self._parameters[name] = value
+
+    @traced("picam.sendConfiguration")
+    def sendConfiguration(self):
+        self.updateROIS()
+
+    def updateROIS(self):
+        x0, w, y0, h, xbin, ybin = self._roi
+        columns = int(np.ceil(float(w)/xbin))
+        rows = int(np.ceil(float(h)/ybin))
+        self.ROIS = [(columns,rows,0)]
+        self.totalFrameSize = columns*rows
+
+    def setROI(self,x0,w,xbin,y0,h,ybin):
+        self._roi = (x0,w,y0,h,xbin,ybin)
+        self.updateROIS()
+
+    def getROI(self):
+        return self._roi
+
+    # timing
+    def readoutTime(self):
+        """ s to read one frame of the current ROI. """
+        columns, rows, _ = self.ROIS[0]
+        rate = self.readout_rate if self.readout_rate is not None else self._parameters["AdcSpeed"]*1e6
+        return self.readout_overhead+self._roi[3]*self.shift_time+columns*rows/rate
+
+    def frameTime(self):
+        return self._parameters["ExposureTime"]/1000.+self.readoutTime()
+
+    def _frame(self):
+        columns, rows, _ = self.ROIS[0]
+        x0, w, y0, h, xbin, ybin = self._roi
+        x_axis = x0+xbin*np.arange(columns)+(xbin-1)/2
+        exposure = self._parameters["ExposureTime"]
+        if self.signal is not None:
+            spectrum = np.asarray(self.signal(x_axis,exposure),dtype=np.double)
+        else:
+            spectrum = harmonicSpectrum(x_axis,exposure,self._rng)
+        # spectrum is the full vertical bin, a binned row collects ybin of the h chip rows
+        return np.repeat((spectrum*ybin/h)[None,:],rows,axis=0)
+
+    # acquisition
+    def isAcquisitionRunning(self):
+        with self._lock:
+            return self._started is not None
+
+    @traced("picam.startAcquisition")
+    def startAcquisition(self):
+        with self._lock:
+            if self._started is not None:
+                self.err = ACQUISITION_IN_PROGRESS
+                return self.err
+            self._started = time.perf_counter()
+            self._delivered = 0
+        return NO_ERROR
+
+    @traced("picam.stopAcquisition")
+    def stopAcquisition(self):
+        with self._lock:
+            self._started = None
+
+    def _available(self,now):
+        """ Frames of the running acquisition ready at now but not returned yet. """
+        count = self._parameters["ReadoutCount"]
+        ready = min(count,int((now-self._started)/self.frameTime()))
+        return ready-self._delivered
+
+    @traced("picam.waitForFrame")
+    def waitForFrame(self,timeout=0,frames=1):
+        """ (error, [frames]) as picam.waitForFrame, timeout in ms, <0 waits forever. """
+        deadline = time.perf_counter()+timeout/1000. if timeout>=0 else np.inf
+        while True:
+            with self._lock:
+                if self._started is None:
+                    self.err = ACQUISITION_NOT_IN_PROGRESS
+                    return self.err, None
+                now = time.perf_counter()
+                available = self._available(now)
+                if available>=frames:
+                    self._delivered += available
+                    if self._delivered>=self._parameters["ReadoutCount"]:
+                        self._started = None
+                    self.frames += available
+                    self.err = NO_ERROR
+                    return self.err, [np.array([self._frame() for _ in range(available)])]
+                next_frame = self._started+(self._delivered+frames)*self.frameTime()
+            if now>=deadline:
+                self.err = TIMEOUT
+                return self.err, None
+            time.sleep(max(min(next_frame,deadline)-now,1e-4))
+
+    @traced("picam.readNFrames")
+    def readNFrames(self,N=1,timeout=-1):
+        if self.isAcquisitionRunning():
+            logger.error("Acquisition still running")
+            return []
+        self._parameters["ReadoutCount"], count = N, self._parameters["ReadoutCount"]
+        try:
+            self.startAcquisition()
+            err, res = self.waitForFrame(timeout=N*self.frameTime()*1000+timeout if timeout>=0 else -1,frames=N)
+        finally:
+            self._parameters["ReadoutCount"] = count
+            self.stopAcquisition()
+        return res if res is not None else []
+
+
+def simulatedCamera(connect=True,**kwargs):
+    """ XUVCamera on a SimulatedPicam, kwargs go to SimulatedPicam. """
+    from ..xuvcamera.xuvcamera import XUVCamera
+    cam = XUVCamera(cam=SimulatedPicam(**kwargs))
+    if connect:
+        cam.connect()
+    return cam
@@ -0,0 +1,125 @@
+"""
+Crash test of the checkpoint journal and StreamWriter.resume.
+
+A child process streams points to a SWMR file and marks them in a ScanJournal
+the way ScanExecutor.run does, the parent kills it with SIGKILL (TerminateProcess
+on Windows) in the middle of the scan. The scan is then resumed from the journal:
+every point the journal holds has to be in the file, the missing points are
+written and the finished file has to hold all of them.
+
+    python -m d35.simulation.crashResume --points 500 --kill-after 0.5
+
+The exit code is 1 if the resumed file is incomplete or holds wrong data.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from ..collections.checkpoint import ScanJournal
+from ..utils.streamWriter import StreamWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+WIDTH = 64 # points are spectra of WIDTH pixels
+
+
+def point(index):
+    return np.full(WIDTH,index,dtype=np.double)
+
+
+def writePoints(writer,journal,points,done=(),delay=0.):
+    """ Write the points not in done and mark them, as ScanExecutor.run does. """
+    checkpoint = journal.scope(0,writer)
+    for index in range(points):
+        if (index,) in done:
+            continue
+        writer.write("data/res0",index,point(index))
+        checkpoint.mark("res0",(index,))
+        if delay>0:
+            time.sleep(delay)
+
+
+def child(data_file,journal_file,points,delay):
+    journal = ScanJournal(journal_file)
+    writer = StreamWriter(data_file,swmr=True,flush_every=10,flush_interval=0.1)
+    journal.startScan(0,data_file)
+    writer.createDataset("data/res0",(WIDTH,),grid=(points,),fillvalue=-1)
+    writer.startSWMR()
+    print("started",flush=True)
+    writePoints(writer,journal,points,delay=delay)
+    writer.close()
+
+
+def crashAndResume(folder,points=500,kill_after=0.5,delay=2e-3):
+    """ Run the child, kill it after kill_after s and resume. Returns a list of problems. """
+    data_file = os.path.join(folder,"scan_000.hdf5")
+    journal_file = os.path.join(folder,"journal.jsonl")
+    ScanJournal(journal_file,config=dict(points=points))
+    process = subprocess.Popen([sys.executable,"-m","d35.simulation.crashResume","--child",data_file,journal_file,
+        "--points",str(points),"--delay",str(delay)],stdout=subprocess.PIPE,universal_newlines=True)
+    process.stdout.readline()
+    time.sleep(kill_after)
+    process.kill()
+    process.wait()
+    if process.returncode == 0:
+        return ["The writer finished before it was killed, lower --kill-after"]
+
+    problems = []
+    journal = ScanJournal(journal_file)
+    done = journal.done(0,"res0")
+    logger.info("Killed the writer after {} of {} committed points".format(len(done),points))
+    writer = StreamWriter.resume(journal.files[0],swmr=True)
+    if writer.filename != journal.files[0]:
+        journal.startScan(0,writer.filename)
+    with writer:
+        writer.createDataset("data/res0",(WIDTH,),grid=(points,)) # reused
+        writer.startSWMR()
+        writePoints(writer,journal,points,done)
+        journal.commit()
+
+    with h5py.File(journal.files[0],"r") as f:
+        data = f["data/res0"][:]
+    for index in range(points):
+        if not np.array_equal(data[index],point(index)):
+            # points in the journal were not written again
+            problems.append("Point {} is {} the resumed file".format(index,
+                "in the journal but not in" if (index,) in done else "missing in"))
+    if len(journal.done(0,"res0")) != points:
+        problems.append("The journal holds {} of {} points".format(len(journal.done(0,"res0")),points))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points",type=int,default=500)
+    parser.add_argument("--kill-after",type=float,default=0.5,help="s after the scan started")
+    parser.add_argument("--delay",type=float,default=2e-3,help="s between points")
+    parser.add_argument("--folder",help="keep the files in this folder")
+    parser.add_argument("--child",nargs=2,help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.child:
+        child(*args.child,args.points,args.delay)
+        return 0
+    if args.folder:
+        os.makedirs(args.folder,exist_ok=True)
+        problems = crashAndResume(args.folder,args.points,args.kill_after,args.delay)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            problems = crashAndResume(folder,args.points,args.kill_after,args.delay)
+    for problem in problems:
+        logger.error(problem)
+    if not problems:
+        logger.info("Resumed scan is complete")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
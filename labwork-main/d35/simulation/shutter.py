@@ -0,0 +1,137 @@
+"""
+Simulated shutter backend.
+
+Drop-in replacement for the Kinesis ThorlabsShutterHardware. A command costs
+latency, the shutter then reports the new state after the transition time
+(open_time/close_time plus jitter) and waitSettled waits the transition time
+plus settle, so the timing of scans toggling the pump can be benchmarked
+without the controller. Like the real class it keeps a shadow state, so
+repeated requests for the current state don't cost a command.
+"""
+import time
+
+import numpy as np
+
+from ..utils.aio import AsyncShutterMixin
+from ..utils.tracing import traced
+from ..utils.observer import Signal
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SimulatedShutterHardware(AsyncShutterMixin):
+    """ Simulated ThorlabsShutterHardware, times in s. """
+    signalOpenedShutter = Signal()
+    signalClosedShutter = Signal()
+    signalDeviceConnect = Signal()
+    signalDeviceDisconnected = Signal()
+    stateMismatch = Signal(bool)
+
+    def __init__(self,open_time=8e-3,close_time=6e-3,jitter=1e-3,settle=2e-3,latency=2e-3,seed=None):
+        super().__init__()
+        self.open_time = open_time
+        self.close_time = close_time
+        self.jitter = jitter # rms of the transition time
+        self.settle = settle # added by waitSettled on top of the nominal transition
+        self.latency = latency # per command or query
+        self._rng = np.random.default_rng(seed)
+        self._state = False # state the hardware reports
+        self._target = False
+        self._arrival = 0. # perf_counter time the target state is reached
+        self._shadowShutter = None
+        self._pending = None
+        self._lastCommand = (None,0.)
+        self.serial = None
+        self.commands = 0
+        self.queries = 0
+        self.coalesced = 0
+
+    def _command(self):
+        if self.latency>0:
+            time.sleep(self.latency)
+
+    @traced("shutter.queryState")
+    def _queryState(self):
+        self.queries += 1
+        self._command()
+        if time.perf_counter()>=self._arrival:
+            self._state = self._target
+        return self._state
+
+    def _emitSignal(self,state):
+        if state: self.signalOpenedShutter.emit()
+        else: self.signalClosedShutter.emit()
+
+    def _confirm(self,state,emit=True):
+        changed = state is not self._shadowShutter
+        self._shadowShutter = state
+        self._pending = None
+        if changed or emit:
+            self._emitSignal(state)
+
+    def open(self,serial=None):
+        self.serial = "SIM-{}".format(serial)
+        logger.info("Connected to simulated shutter {}".format(self.serial))
+        self.signalDeviceConnect.emit()
+        self.getShutter(forceEmit=True)
+
+    def close(self):
+        pass
+
+    @traced("shutter.setShutter")
+    def setShutter(self,state=False,timeout=1000,wait_function=None):
+        """ Same semantics for timeout (in ms) as ThorlabsShutterHardware.setShutter. """
+        state = bool(state)
+        if self._pending is state or (self._pending is None and self._shadowShutter is state):
+            self.coalesced += 1
+        else:
+            self.commands += 1
+            self._command()
+            transition = self.open_time if state else self.close_time
+            now = time.perf_counter()
+            self._state = self._target if now>=self._arrival else self._state
+            self._target = state
+            self._arrival = now+max(transition+self._rng.normal(0,self.jitter) if self.jitter else transition,0)
+            self._pending = state
+            self._lastCommand = (state,now)
+        if timeout != 0:
+            return self.waitOnShutter(state,timeout,wait_function)
+
+    @traced("shutter.waitOnShutter")
+    def waitOnShutter(self,state,timeout=1000,wait_function=None):
+        if self._pending is None and self._shadowShutter is state:
+            return state
+        start = time.perf_counter()
+        while self._queryState() is not state:
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(1e-3) # don't flood the controller with queries
+            if timeout>=0 and (time.perf_counter()-start)>(timeout/1000.):
+                raise TimeoutError
+        self._confirm(state)
+        return state
+
+    @traced("shutter.waitSettled")
+    def waitSettled(self,state=None,wait_function=None):
+        """ Wait the nominal transition plus settle time after the last command. """
+        last, t0 = self._lastCommand
+        if state is None:
+            state = last
+        if state is None:
+            return
+        end = t0+(self.open_time if state else self.close_time)+self.settle
+        while time.perf_counter()<end:
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(min(1e-3,max(end-time.perf_counter(),0)))
+
+    def getShutter(self,forceEmit=False):
+        if not forceEmit and self._pending is None and self._shadowShutter is not None:
+            return self._shadowShutter
+        state = self._queryState()
+        if self._pending is None or state is self._pending:
+            self._confirm(state,emit=forceEmit)
+        return state
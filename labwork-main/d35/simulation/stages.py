@@ -0,0 +1,341 @@
+"""
+Simulated stage backends.
+
+Drop-in replacements for PIStageHardware and ThorlabsStageHardware that don't
+need the controllers or their libraries. Moves follow a trapezoidal velocity
+profile, followed by a settle phase with position noise. Every command costs a
+configurable serial latency, and errors can be injected at a given rate, so
+scans can be run and benchmarked without the beamline.
+
+Select them with D35StageController(simulate=True) or by setting D35_SIMULATE=1.
+"""
+import numpy as np
+import threading
+import time
+from contextlib import contextmanager
+
+from ..utils.aio import AsyncStageMixin
+from ..utils.tracing import traced
+from ..utils.observer import Signal
+
+try:
+    from PIPython import GCSError
+except ImportError:
+    class GCSError(Exception):
+        """ Stand-in for PIPython.GCSError if PIPython is not installed. """
+        def __init__(self,value=0,message=""):
+            super().__init__(message or "GCS error {}".format(value))
+            self.val = value
+
+try:
+    from pylablib.devices.Thorlabs import ThorlabsError
+except ImportError:
+    class ThorlabsError(Exception):
+        """ Stand-in for pylablib's ThorlabsError if pylablib is not installed. """
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Typical dynamics per controller model, units of the stage (um for the piezo, mm otherwise).
+SIMULATED_DYNAMICS = {
+    "E-754": dict(velocity=1000., acceleration=1e5, settle=5e-3, noise=1e-3, latency=1e-3, limits=(0.,100.)),
+    "C-663": dict(velocity=10., acceleration=50., settle=20e-3, noise=1e-4, latency=5e-3, limits=(0.,50.)),
+    "KinesisMotor": dict(velocity=2., acceleration=2., settle=50e-3, noise=1e-4, latency=10e-3, limits=(0.,50.)),
+    }
+
+
+class SimulatedAxis(object):
+    """ Motion dynamics of a single axis. The state is evaluated lazily from the
+    time the last move started, no background thread is needed. """
+
+    def __init__(self,velocity=1.,acceleration=10.,settle=0.,noise=0.,settle_noise=0.,position=0.,limits=(0.,50.),seed=None):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.settle = settle # s, nominal settle time after the profile finished
+        self.noise = noise # rms position noise while on target
+        self.settle_noise = settle_noise # rms jitter of the settle time in s
+        self.limits = limits
+        self._rng = np.random.default_rng(seed)
+        self._start = position
+        self._target = position
+        self._t0 = 0.
+        self._profile = (0.,0.,0.,0.) # vpeak, t_acc, t_cruise, total
+        self._settled_at = 0.
+
+    def moveTo(self,target,now=None):
+        if now is None:
+            now = time.perf_counter()
+        if not self.limits[0]<=target<=self.limits[1]:
+            raise ValueError("Target {} outside of limits {}".format(target,self.limits))
+        self._start = self.position(now,noise=False)
+        self._target = target
+        self._t0 = now
+        distance = abs(target-self._start)
+        vpeak = min(self.velocity,np.sqrt(distance*self.acceleration))
+        t_acc = vpeak/self.acceleration
+        t_cruise = (distance-vpeak**2/self.acceleration)/vpeak if vpeak>0 else 0.
+        total = 2*t_acc+max(t_cruise,0.)
+        self._profile = (vpeak,t_acc,max(t_cruise,0.),total)
+        settle = self.settle+abs(self._rng.normal(0,self.settle_noise)) if self.settle_noise>0 else self.settle
+        self._settled_at = now+total+(settle if distance>0 else 0.)
+
+    def position(self,now=None,noise=True):
+        if now is None:
+            now = time.perf_counter()
+        vpeak, t_acc, t_cruise, total = self._profile
+        tau = now-self._t0
+        distance = abs(self._target-self._start)
+        if tau<=0:
+            s = 0.
+        elif tau<t_acc:
+            s = 0.5*self.acceleration*tau**2
+        elif tau<t_acc+t_cruise:
+            s = 0.5*self.acceleration*t_acc**2+vpeak*(tau-t_acc)
+        elif tau<total:
+            s = distance-0.5*self.acceleration*(total-tau)**2
+        else:
+            s = distance
+        pos = self._start+np.sign(self._target-self._start)*s
+        if noise and self.noise>0:
+            pos += self._rng.normal(0,self.noise)
+        return float(pos)
+
+    def target(self):
+        return self._target
+
+    def isMoving(self,now=None):
+        if now is None:
+            now = time.perf_counter()
+        return now<self._t0+self._profile[3]
+
+    def isOnTarget(self,now=None):
+        if now is None:
+            now = time.perf_counter()
+        return now>=self._settled_at
+
+
+class _SimulatedStageHardware(AsyncStageMixin):
+    """ Common part of the simulated stages, handles latency and error injection. """
+    signalDeviceConnect = Signal()
+    signalDeviceDisconnected = Signal()
+    newSetpoint = Signal(float)
+    newPosition = Signal(float)
+    onTarget = Signal()
+    onMove = Signal()
+
+    error = Exception
+    model = None
+
+    def __init__(self,model=None,latency=None,error_rate=0.,seed=None,**dynamics):
+        super().__init__()
+        if model is not None:
+            self.model = model
+        defaults = dict(SIMULATED_DYNAMICS.get(self.model,dict()))
+        defaults.update(dynamics)
+        default_latency = defaults.pop("latency",0.)
+        self.latency = default_latency if latency is None else latency
+        self._explicit = dict(dynamics,latency=latency) # kept when open switches the model
+        self.error_rate = error_rate
+        self._dynamics = defaults
+        self._seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._axis = None
+        self.serial = None
+        self.motionModel = None
+        self.commands = 0 # number of commands sent, to compare bus usage
+        self._deferErrors = False # controller errors are only reported by checkpoint, see fastMode
+        self._pendingError = None
+
+    def _command(self):
+        """ Account for one round trip to the controller. """
+        self.commands += 1
+        if self.latency>0:
+            time.sleep(self.latency)
+        if self.error_rate>0 and self._rng.random()<self.error_rate:
+            if not self._deferErrors:
+                raise self._error("Injected error")
+            if self._pendingError is None:
+                self._pendingError = "Injected error"
+        if self._axis is None:
+            raise self._error("Device not connected")
+
+    def _error(self,message):
+        return self.error(message)
+
+    def _open(self,serial,position=None):
+        dynamics = dict(self._dynamics)
+        if position is not None:
+            dynamics["position"] = position
+        self._axis = SimulatedAxis(seed=self._seed,**dynamics)
+        self.serial = "SIM-{}".format(serial)
+        logger.info("Connected to simulated device: {} {}".format(self.model,self.serial))
+        self.signalDeviceConnect.emit()
+
+    def close(self):
+        self._axis = None
+
+    def getLimits(self,*args):
+        return self.getMinimum(), self.getMaximum()
+
+    def getMinimum(self,*args):
+        self._command()
+        return self._axis.limits[0]
+
+    def getMaximum(self,*args):
+        self._command()
+        return self._axis.limits[1]
+
+    def startup(self,*args):
+        pass
+
+    def shutdown(self,*args):
+        pass
+
+    @traced("stage.sim.getPosition")
+    def getPosition(self,*args):
+        self._command()
+        pos = self._axis.position()
+        self.newPosition.emit(pos)
+        return pos
+
+    def getTarget(self,*args):
+        return self._axis.target()
+
+    @traced("stage.sim.setPosition")
+    def setPosition(self,position,*args,**kwargs):
+        self._command()
+        try:
+            self._axis.moveTo(position)
+        except ValueError as e:
+            raise self._error(str(e))
+        self.newSetpoint.emit(position)
+
+    def isPosition(self,position,eps=0.001,*args):
+        pos = self.getPosition()
+        return abs(position-pos)<eps and self.isOnTarget()
+
+    @traced("stage.sim.isOnTarget")
+    def isOnTarget(self,*args):
+        self._command()
+        state = self._axis.isOnTarget()
+        if state:
+            self.onTarget.emit()
+        return state
+
+    def isMoving(self,*args):
+        self._command()
+        state = self._axis.isMoving()
+        if state:
+            self.onMove.emit()
+        return state
+
+
+class SimulatedPIStageHardware(_SimulatedStageHardware):
+    """ Simulated stand-in for PIStageHardware (E-754 piezo, C-663 steppers). """
+    error = GCSError
+
+    def __init__(self,model="C-663",**kwargs):
+        super().__init__(model=model,**kwargs)
+
+    def _error(self,message):
+        return GCSError(-1,message)
+
+    @contextmanager
+    def fastMode(self):
+        """ Same as PIStageHardware.fastMode, injected errors are deferred to checkpoint(). """
+        self._deferErrors = True
+        self._steps = None
+        try:
+            yield self
+            self.checkpoint()
+        finally:
+            self._deferErrors = False
+            self._steps = None
+
+    def markStep(self,step):
+        if getattr(self,"_steps",None) is None:
+            self._steps = (step,step)
+        else:
+            self._steps = (self._steps[0],step)
+
+    def checkpoint(self):
+        self._command()
+        message, self._pendingError = self._pendingError, None
+        steps, self._steps = getattr(self,"_steps",None), None
+        if message is not None:
+            if steps is not None:
+                message = "{} (during steps {} to {})".format(message,*steps)
+            error = self._error(message)
+            error.steps = steps
+            raise error
+
+    def open(self,model=None,serial=None,connect_type=None,com_port=None,ip=None,baudrate=115200,fastmode=False,position=None):
+        if model is not None and model != self.model:
+            # pick up the dynamics of the model from the device configuration
+            self.model = model
+            self._dynamics.update(SIMULATED_DYNAMICS.get(model,dict()))
+            latency = self._dynamics.pop("latency",0.)
+            if self._explicit["latency"] is None:
+                self.latency = latency
+            self._dynamics.update((key,value) for key, value in self._explicit.items() if key != "latency")
+        self._open(serial if serial is not None else com_port,position)
+
+
+class SimulatedThorlabsStageHardware(_SimulatedStageHardware):
+    """ Simulated stand-in for ThorlabsStageHardware (KinesisMotor). """
+    error = ThorlabsError
+    model = "KinesisMotor"
+    moveFinished = Signal(float) # emitted by the move watcher with the final position
+
+    def __init__(self,profiles=None,fine_step=0.5,**kwargs):
+        super().__init__(**kwargs)
+        self.profiles = profiles if profiles is not None else dict()
+        self.fine_step = fine_step
+        self._watcher = None
+
+    def open(self,serial=None,BSC201=None,scale="stage",profiles=None,position=None):
+        if serial is None:
+            raise AttributeError
+        if profiles is not None:
+            self.profiles = profiles
+        self._open(serial,position)
+
+    def setPosition(self,position,profile=None,notify=False):
+        """ Same as ThorlabsStageHardware.setPosition, with notify moveFinished is
+        emitted from a watcher thread once the axis is on target. """
+        if profile is None:
+            profile = "fine" if abs(position-self.getTarget())<=self.fine_step else "jump"
+        if profile in self.profiles:
+            self._axis.velocity = self.profiles[profile].get("max_velocity",self._axis.velocity)
+            self._axis.acceleration = self.profiles[profile].get("acceleration",self._axis.acceleration)
+        super().setPosition(position)
+        if notify:
+            self._startWatcher()
+
+    def _startWatcher(self,poll=0.02):
+        if self._watcher is not None and self._watcher.is_alive():
+            return # the running watcher will pick up the new target
+        self._watcher = threading.Thread(target=self._watchMove,args=(poll,),daemon=True)
+        self._watcher.start()
+
+    def _watchMove(self,poll):
+        try:
+            while not self.isOnTarget():
+                time.sleep(poll)
+            pos = self.getPosition()
+        except ThorlabsError:
+            logger.exception("Error while waiting for move to finish:")
+            return
+        self.moveFinished.emit(pos)
+
+    def waitMove(self,timeout=None,wait_function=None,poll=0.05):
+        start = time.perf_counter()
+        while not self.isOnTarget():
+            if timeout is not None and time.perf_counter()-start>timeout:
+                raise TimeoutError
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(poll)
+        return True
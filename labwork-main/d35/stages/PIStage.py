@@ -1,7 +1,12 @@
-from PyQt5 import QtGui, QtCore
 from PIPython import GCSDevice, GCSError, gcserror
+from contextlib import contextmanager
 
 from ..utils.widgets import ClosedLoopStageWidget
+from ..utils.motion import loadMotionModel
+from ..utils.aio import AsyncStageMixin
+from ..utils.tracing import traced
+from ..utils.observer import Signal
+from ..utils.qtSignals import connectQt
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,7 +25,7 @@ class PIStageWidget(ClosedLoopStageWidget):
         if device is None:
             device = PIStageHardware(**kwargs)
         self._dev = device
-        self._dev.signalDeviceConnect.connect(self.setStateOK)
+        connectQt(self._dev.signalDeviceConnect,self.setStateOK,self)
 
         self.newSetpoint.connect(self.changeSetpoint)
        
@@ -57,16 +62,19 @@ class PIStageWidget(ClosedLoopStageWidget):
 
 
 
-class PIStageHardware(QtCore.QObject):
-    signalDeviceConnect = QtCore.pyqtSignal()
-    signalDeviceDisconnected = QtCore.pyqtSignal()
-    newSetpoint = QtCore.pyqtSignal(float)
-    newPosition = QtCore.pyqtSignal(float)
-    onTarget = QtCore.pyqtSignal()
-    onMove = QtCore.pyqtSignal()
+class PIStageHardware(AsyncStageMixin):
+    signalDeviceConnect = Signal()
+    signalDeviceDisconnected = Signal()
+    newSetpoint = Signal(float)
+    newPosition = Signal(float)
+    onTarget = Signal()
+    onMove = Signal()
     
     def __init__(self):
         super().__init__()
+        self.serial = None
+        self.motionModel = None # see utils.motion, loaded on open if profiled before
+        self._steps = None # (first, last) step marked since the last checkpoint in fast mode
 
     def open(self,model=None,serial=None,connect_type=None,com_port=None,ip=None,baudrate=115200,fastmode=False):
         if model is None:
@@ -81,7 +89,16 @@ class PIStageHardware(QtCore.QObject):
         else:
             self._dev.InterfaceSetupDlg()
 
-        logger.info("Connected to device: " + self._dev.qIDN().strip())
+        idn = self._dev.qIDN().strip()
+        logger.info("Connected to device: " + idn)
+        if serial is None:
+            # serial number is the third field of the identification string
+            try:
+                serial = idn.split(",")[2].strip()
+            except IndexError:
+                serial = com_port if com_port is not None else ip
+        self.serial = serial
+        self.motionModel = loadMotionModel(self.serial)
 
         if fastmode:
             self._dev.errcheck = False
@@ -106,6 +123,7 @@ class PIStageHardware(QtCore.QObject):
     def shutdown(self,axes="1"):
         self._dev.SVO(axes,0)
 
+    @traced("stage.PI.getPosition")
     def getPosition(self,axes="1"):
         pos = self._dev.qPOS(axes)[axes]
         self.newPosition.emit(pos)
@@ -114,6 +132,7 @@ class PIStageHardware(QtCore.QObject):
     def getTarget(self,axes="1"):
         return self._dev.qMOV(axes)[axes]
 
+    @traced("stage.PI.setPosition")
     def setPosition(self,position,axes="1"):
         self._dev.MOV(axes,position)
         self.newSetpoint.emit(position)
@@ -122,6 +141,7 @@ class PIStageHardware(QtCore.QObject):
         pos = self.getPosition()
         return abs(position-pos)<eps and self.isOnTarget()
         
+    @traced("stage.PI.isOnTarget")
     def isOnTarget(self,axes="1"):
         state = self._dev.qONT(axes)[axes]
         if state:
@@ -134,6 +154,52 @@ class PIStageHardware(QtCore.QObject):
             self.onMove.emit()
         return not state
 
+    @contextmanager
+    def fastMode(self):
+        """ Disable the error check after every command (a qERR round trip) for the enclosed block.
+        Errors are checked once per checkpoint() and when leaving the block, mark the scan
+        step with markStep() to know where an error occured. The controller only keeps the
+        last error, not the command causing it, so an error is located to the range of steps
+        since the previous checkpoint, not to a single step. Call checkpoint() more often
+        (e.g. once per row) to narrow the range, each call costs one qERR round trip:
+
+            with piezo.fastMode():
+                for n, tau in enumerate(delays):
+                    piezo.markStep(n)
+                    piezo.setPosition(tau)
+                    ...
+                piezo.checkpoint() # optional, also done on exit
+        """
+        errcheck = self._dev.errcheck
+        self._dev.errcheck = False
+        self._steps = None
+        try:
+            yield self
+            self.checkpoint()
+        finally:
+            self._dev.errcheck = errcheck
+            self._steps = None
+
+    def markStep(self,step):
+        """ Record the index of the scan step the following commands belong to. """
+        if self._steps is None:
+            self._steps = (step,step)
+        else:
+            self._steps = (self._steps[0],step)
+
+    @traced("stage.PI.checkpoint")
+    def checkpoint(self):
+        """ Query the controller error once, raise GCSError with the steps since the last checkpoint.
+        error.steps is the (first, last) step of that range, the failing step is not known. """
+        err = self._dev.qERR()
+        steps, self._steps = self._steps, None
+        if err:
+            error = GCSError(err)
+            if steps is not None:
+                error = GCSError(err,"{} (during steps {} to {})".format(error,*steps))
+            error.steps = steps
+            raise error
+
 
 
 
@@ -1,9 +1,15 @@
-from PyQt5 import QtGui, QtCore
 from pylablib.devices import Thorlabs
 from pylablib.devices.Thorlabs import ThorlabsError
 
 from ..utils.widgets import ClosedLoopStageWidget
-
+from ..utils.motion import loadMotionModel
+from ..utils.aio import AsyncStageMixin
+from ..utils.tracing import traced
+from ..utils.observer import Signal
+from ..utils.qtSignals import connectQt
+
+import time
+import threading
 import logging
 logger = logging.getLogger(__name__)
 hwlogger = logging.getLogger("D35 DEVICES")
@@ -12,15 +18,22 @@ hwlogger = logging.getLogger("D35 DEVICES")
 D35_THORLABS_DELAYSTAGE_SERIAL = dict(serial=40871684,BSC201=409600)
 D35_THORLABS_BBOSTAGE_SERIAL = dict(serial=27501742)
 
+# Velocity profiles per move class, passed to KinesisMotor.setup_velocity (stage units, mm/s and mm/s^2).
+# Moves longer than fine_step use the "jump" profile, shorter moves the "fine" profile.
+D35_THORLABS_DELAYSTAGE_PROFILES = dict(
+    jump = dict(max_velocity=2.0, acceleration=2.0),
+    fine = dict(max_velocity=0.5, acceleration=1.0),
+    )
+
 class ThorlabsStageWidget(ClosedLoopStageWidget):
     def __init__(self,device=None,parent=None,label="Thorlabs Stage",digits=3):
         super().__init__(parent,label=label,digits=digits)        
         if device is None:
             device = ThorlabsStageHardware(label=label)
         self._dev = device     
-        self._dev.newPosition.connect(self.updatePos)
-        self._dev.onTarget.connect(self.setStateOK)
-        self._dev.onMove.connect(self.setStateMoving)
+        connectQt(self._dev.newPosition,self.updatePos,self)
+        connectQt(self._dev.onTarget,self.setStateOK,self)
+        connectQt(self._dev.onMove,self.setStateMoving,self)
 
         self.newSetpoint.connect(self.changeSetpoint)
         
@@ -53,20 +66,30 @@ class ThorlabsStageWidget(ClosedLoopStageWidget):
 
 
 
-class ThorlabsStageHardware(QtCore.QObject):
-    signalDeviceConnect = QtCore.pyqtSignal()
-    signalDeviceDisconnected = QtCore.pyqtSignal()
-    newSetpoint = QtCore.pyqtSignal(float)
-    newPosition = QtCore.pyqtSignal(float)
-    onTarget = QtCore.pyqtSignal()
-    onMove = QtCore.pyqtSignal()
+class ThorlabsStageHardware(AsyncStageMixin):
+    signalDeviceConnect = Signal()
+    signalDeviceDisconnected = Signal()
+    newSetpoint = Signal(float)
+    newPosition = Signal(float)
+    onTarget = Signal()
+    onMove = Signal()
+    moveFinished = Signal(float) # emitted by the move watcher with the final position
 
-    def __init__(self):
+    def __init__(self,profiles=None,fine_step=0.5):
         super().__init__()
         self._target = 0
         self._eps = 0.1
-
-    def open(self,serial=None,BSC201=None,scale="stage"):
+        self._settled = True # cached on-target state, only reset by a new move
+        self._profile = None # name of the velocity profile currently set on the controller
+        self.profiles = profiles if profiles is not None else dict()
+        self.fine_step = fine_step
+        self.serial = None
+        self.motionModel = None # see utils.motion, loaded on open if profiled before
+        # The move watcher thread and the GUI share the device
+        self._lock = threading.RLock()
+        self._watcher = None
+
+    def open(self,serial=None,BSC201=None,scale="stage",profiles=None):
         if serial is None:
             raise AttributeError
 
@@ -78,9 +101,14 @@ class ThorlabsStageHardware(QtCore.QObject):
             vpr=53.68 # values from pylablib
             avr=204.94E-6
             scale =(ssc,ssc*vpr,ssc*vpr*avr)
+        if profiles is not None:
+            self.profiles = profiles
         self._dev = Thorlabs.KinesisMotor(serial,scale)
+        self.serial = serial
+        self.motionModel = loadMotionModel(self.serial)
         self.signalDeviceConnect.emit()
         self._target = self._dev.get_position()
+        self._settled = True
 
     def close(self):
         self._dev.close()
@@ -103,8 +131,10 @@ class ThorlabsStageHardware(QtCore.QObject):
     def shutdown(self):
         pass
 
+    @traced("stage.thorlabs.getPosition")
     def getPosition(self):
-        pos = self._dev.get_position()
+        with self._lock:
+            pos = self._dev.get_position()
         self.newPosition.emit(pos)
         return pos
 
@@ -112,25 +142,89 @@ class ThorlabsStageHardware(QtCore.QObject):
         # No hardware support, report internal value
         return self._target
 
-    def setPosition(self,position):
-        self._dev.move_to(position)
-        self._target = position
+    def setMoveProfile(self,name):
+        """ Configure velocity and acceleration for the move class name (see profiles).
+        The controller is only reconfigured if the profile changes. """
+        if name == self._profile or name not in self.profiles:
+            return
+        with self._lock:
+            self._dev.setup_velocity(**self.profiles[name])
+        self._profile = name
+
+    @traced("stage.thorlabs.setPosition")
+    def setPosition(self,position,profile=None,notify=False):
+        """ Start a move to position. If profile is None, the velocity profile is chosen by the
+        step size. If notify is True, moveFinished is emitted from a watcher thread once the
+        controller reports the move as complete. """
+        if profile is None:
+            profile = "fine" if abs(position-self._target)<=self.fine_step else "jump"
+        self.setMoveProfile(profile)
+        with self._lock:
+            self._dev.move_to(position)
+            self._target = position
+            self._settled = False
         self.newSetpoint.emit(position)
+        if notify:
+            self._startWatcher()
 
     def isPosition(self,position,eps=0.001):
         pos = self.getPosition()
         return abs(position-pos)<eps
         
+    @traced("stage.thorlabs.isOnTarget")
     def isOnTarget(self):
-        state = abs(self.getPosition()-self._target)<self._eps
+        """ Check the controller status bits instead of reading back the position.
+        The position is only read once when the stage stopped, to confirm the target was reached. """
+        with self._lock:
+            if not self._settled and not self._dev.is_moving():
+                # a move that hasn't started yet also reports not moving, so don't cache a miss
+                self._settled = abs(self._dev.get_position()-self._target)<self._eps
+            state = self._settled
         if state:
             self.onTarget.emit()
         return state
 
     def isMoving(self):
-        state =  self._dev.is_moving()
+        with self._lock:
+            state =  self._dev.is_moving()
         if state:
             self.onMove.emit()
         return state
 
-
+    @traced("stage.thorlabs.waitMove")
+    def waitMove(self,timeout=None,wait_function=None,poll=0.05):
+        """ Wait until the move is complete. The status is checked every poll s, in between
+        wait_function is called or, without one, the thread sleeps. The device lock is only held
+        for the status checks, so other threads can read the stage during the move.
+        Raises TimeoutError if timeout (in s) is exceeded, errors of the controller are passed on. """
+        start = time.perf_counter()
+        next_check = start
+        while True:
+            now = time.perf_counter()
+            if now>=next_check:
+                if self.isOnTarget():
+                    return True
+                next_check = now+poll
+            if timeout is not None and now-start>timeout:
+                raise TimeoutError
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(max(min(next_check-time.perf_counter(),poll),0))
+
+    def _startWatcher(self,poll=0.02):
+        if self._watcher is not None and self._watcher.is_alive():
+            return # the running watcher will pick up the new target
+        self._watcher = threading.Thread(target=self._watchMove,args=(poll,),daemon=True)
+        self._watcher.start()
+
+    def _watchMove(self,poll):
+        try:
+            while not self.isOnTarget():
+                time.sleep(poll)
+            with self._lock:
+                pos = self._dev.get_position()
+        except ThorlabsError:
+            logger.exception("Error while waiting for move to finish:")
+            return
+        self.moveFinished.emit(pos)
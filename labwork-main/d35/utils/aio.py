@@ -0,0 +1,76 @@
+"""
+asyncio variants of the blocking hardware calls.
+
+The stage and shutter libraries (PIPython, pylablib) own their ports, so the
+calls are run in a worker thread. Every device has its own asyncio.Lock, calls
+to one device are serialised while different devices run concurrently, e.g.
+
+    await asyncio.gather(shutter.setShutterAsync(True), piezo.moveAsync(tau), camera_coroutine)
+"""
+import asyncio
+import time
+
+
+async def runSerialised(lock,func,*args,**kwargs):
+    """ Run the blocking func in a worker thread while holding lock. """
+    async with lock:
+        return await asyncio.get_running_loop().run_in_executor(None,lambda: func(*args,**kwargs))
+
+
+class AsyncDeviceMixin(object):
+    """ Per device serialisation of the async calls. """
+    _asyncLock = None
+
+    def runAsync(self,func,*args,**kwargs):
+        if self._asyncLock is None:
+            self._asyncLock = asyncio.Lock()
+        return runSerialised(self._asyncLock,func,*args,**kwargs)
+
+
+class AsyncStageMixin(AsyncDeviceMixin):
+    """ Async variants for the stage hardware classes. """
+
+    async def getPositionAsync(self):
+        return await self.runAsync(self.getPosition)
+
+    async def setPositionAsync(self,position,**kwargs):
+        return await self.runAsync(self.setPosition,position,**kwargs)
+
+    async def isOnTargetAsync(self):
+        return await self.runAsync(self.isOnTarget)
+
+    async def waitOnTargetAsync(self,timeout=None,poll=0.01):
+        """ Poll the on-target state without blocking the event loop, raises TimeoutError """
+        start = time.perf_counter()
+        while not await self.isOnTargetAsync():
+            if timeout is not None and time.perf_counter()-start>timeout:
+                raise TimeoutError
+            await asyncio.sleep(poll)
+        return True
+
+    async def moveAsync(self,position,timeout=None,poll=0.01,**kwargs):
+        """ Set the position and wait until the stage is on target """
+        await self.setPositionAsync(position,**kwargs)
+        return await self.waitOnTargetAsync(timeout,poll)
+
+
+class AsyncShutterMixin(AsyncDeviceMixin):
+    """ Async variants for the shutter hardware classes. """
+
+    async def getShutterAsync(self):
+        return await self.runAsync(self.getShutter)
+
+    async def setShutterAsync(self,state=False,timeout=1000,poll=0.005):
+        """ Same semantics for timeout (in ms) as setShutter, waiting doesn't block the event loop """
+        await self.runAsync(self.setShutter,state,timeout=0)
+        if timeout == 0:
+            return
+        if self._pending is None and self._shadowShutter is state:
+            return state # request was coalesced, the shadow state is confirmed
+        start = time.perf_counter()
+        while await self.runAsync(self._queryState) is not state:
+            if timeout>=0 and (time.perf_counter()-start)>(timeout/1000.):
+                raise TimeoutError
+            await asyncio.sleep(poll)
+        self._confirm(state)
+        return state
@@ -1,20 +1,18 @@
-from PyQt5.QtCore import QObject, pyqtSignal
-import logging
+from .observer import Signal
 
-class AcquisitionContext(QObject):
-    acquisitionStarted = pyqtSignal()
-    acquisitionStopped = pyqtSignal()
-    acquisitionFinished = pyqtSignal()
+class AcquisitionContext(object):
+    acquisitionStarted = Signal()
+    acquisitionStopped = Signal()
+    acquisitionFinished = Signal()
 
-    def __init__(self,*args,**kwargs):
-        super().__init__(*args,**kwargs)
+    def __init__(self):
         self._finished = False
 
     def __enter__(self):
         self._finished = False
         self.acquisitionStarted.emit()
 
-    def __exit__(self):
+    def __exit__(self,*args):
         if not self._finished:
             self.acquisitionStopped.emit()
         self._finished = True
@@ -30,14 +28,3 @@ class AcquisitionContext(QObject):
     @property
     def finished(self):
         return self._finished
-
-
-class ConsoleWindowLogHandler(logging.Handler, QObject):
-    sigLog = pyqtSignal(str)
-    def __init__(self):
-        logging.Handler.__init__(self)
-        QObject.__init__(self)
-
-    def emit(self, logRecord):
-        message = str(logRecord.getMessage())
-        self.sigLog.emit(message)
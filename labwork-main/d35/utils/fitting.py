@@ -0,0 +1,89 @@
+"""
+Fit models for gas transients, without Qt so they can run in scans and scripts.
+
+The cross-correlation is fitted with an exponentially modified gaussian
+(gaussMod) on the delay axis in fs. Parameters are
+    t0 [fs], FWHM [fs], amplitude, background[, gamma]
+"""
+import warnings
+
+import numpy as np
+from scipy.stats import exponnorm, norm, expon
+from scipy.optimize import curve_fit, OptimizeWarning
+from scipy.ndimage import uniform_filter1d
+
+FS_PER_UNIT = 6.6 # fs delay per piezo stage unit (2x travel)
+
+
+def gaussMod(x,c,s,a,bg,l=3e-3):
+    s/=(2*np.sqrt(2*np.log(2))) # FWHM to sigma
+    k = 1/(s*l)
+    return exponnorm.pdf(-x,k,loc=-c,scale=s)*a+bg
+
+def gauss(x,c,s,a,bg,*args):
+    s/=(2*np.sqrt(2*np.log(2)))
+    return norm.pdf(-x,loc=-c,scale=s)
+
+def expodecay(x,c,s,a,bg,l=3e-3):
+    ex = expon.pdf(-x,loc=-c,scale=1/l)*a+bg
+    return ex
+
+
+def _curveFit(fit,x,y,p0,bounds,maxfev):
+    """ Return popt, perr, residual or None if the fit failed. """
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", OptimizeWarning)
+        try:
+            popt,pcov=curve_fit(fit,x,y,p0=p0,maxfev=maxfev,bounds=bounds)
+        except (OptimizeWarning,RuntimeError,ValueError):
+            return None
+    return popt, np.sqrt(np.diag(pcov)), np.sum(np.abs(y-fit(x,*popt)))
+
+def fitGasTransient(delays,data,fix_decay=False,force_invert=False,try_invert=True,maxfev=10000):
+    """ Fit gaussMod to the trace data at delays (stage units). The sign of the
+    trace is guessed, with try_invert the inverted trace is fitted as well and
+    the better fit kept. Returns the report dict x, y (trace with the fitted
+    sign), opt, err, residual; opt and err are None if no fit converged. """
+    delay_vector_fs = FS_PER_UNIT*np.asarray(delays,dtype=np.double)
+    data = np.array(data,dtype=np.double)
+
+    # guess sign and correct data
+    sig1 = np.sign(np.max(uniform_filter1d(data[:],5,mode="nearest")))
+    if force_invert:
+        sig1 = -sig1
+    if sig1:
+        data *= sig1
+
+    # Order of parameters: t0, FWHM, Amplitude, bg, [Gamma]
+    inital_guess = [np.mean(delay_vector_fs),15.0,0.2,0.0]
+    """ Set bounds
+    Bind t0 to be on the scanned range,
+    the FWHM to be shorter than the scanned range and longer than the single cycle limit
+    the amplitude to be positive. """
+    bounds_max = [np.max(delay_vector_fs),np.max(delay_vector_fs)-np.min(delay_vector_fs), np.inf, np.inf]
+    bounds_min = [np.min(delay_vector_fs),2.6,0,-np.inf]
+    # Optionally, the decay to be not faster than 0.6fs and larger than 0
+    if not fix_decay:
+        inital_guess.append(3e-2)
+        bounds_max.append(1)
+        bounds_min.append(0)
+    bounds = (bounds_min,bounds_max)
+
+    opt = err = None
+    residual = np.inf
+    result = _curveFit(gaussMod,delay_vector_fs,data,inital_guess,bounds,maxfev)
+    if result is not None:
+        opt, err, residual = result
+    if try_invert:
+        result = _curveFit(gaussMod,delay_vector_fs,-data,inital_guess,bounds,maxfev)
+        if result is not None and result[2]<residual:
+            # Second fit was better
+            opt, err, residual = result
+            data *= -1
+
+    return dict(
+        x=np.asarray(delays),
+        y=data,
+        opt=opt,
+        err=err,
+        residual=residual)
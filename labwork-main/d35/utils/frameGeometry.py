@@ -0,0 +1,92 @@
+"""
+Geometry of the camera frames.
+
+The size of a readout follows from the camera ROI: width/x_binning columns and
+height/y_binning rows (in spectrum mode the full height is binned to one row).
+XUVCamera.getGeometry() publishes the FrameGeometry of the current ROI, scans,
+buffers and files allocate from it instead of assuming the full 1340 pixel
+chip, so cropped and binned (faster) readouts work end to end. x_axis holds the
+chip column of every pixel, so spectra of different ROIs share one calibration.
+"""
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FrameGeometry(object):
+    """ Readout geometry of a single ROI (x0, width, y0, height, x_binning, y_binning) in chip pixels. """
+
+    def __init__(self,x0,width,y0,height,xbin=1,ybin=1):
+        self.x0 = int(x0)
+        self.width = int(width)
+        self.y0 = int(y0)
+        self.height = int(height)
+        self.xbin = max(1,int(xbin))
+        self.ybin = max(1,int(ybin))
+
+    @classmethod
+    def fromROI(cls,roi):
+        """ From the tuple returned by picam.getROI(). """
+        return cls(*roi)
+
+    def __repr__(self):
+        return "FrameGeometry(x0={}, width={}, y0={}, height={}, xbin={}, ybin={})".format(
+            self.x0,self.width,self.y0,self.height,self.xbin,self.ybin)
+
+    def __eq__(self,other):
+        return isinstance(other,FrameGeometry) and self.roi == other.roi
+
+    def __hash__(self):
+        return hash(self.roi)
+
+    @property
+    def roi(self):
+        return (self.x0,self.width,self.y0,self.height,self.xbin,self.ybin)
+
+    @property
+    def columns(self):
+        """ Pixels per spectrum, as picam.updateROIS computes them. """
+        return int(np.ceil(self.width/self.xbin))
+
+    @property
+    def rows(self):
+        return int(np.ceil(self.height/self.ybin))
+
+    @property
+    def spectrum_shape(self):
+        return (self.columns,)
+
+    @property
+    def frame_shape(self):
+        """ Shape of one readout, (rows, columns). """
+        return (self.rows,self.columns)
+
+    @property
+    def x_axis(self):
+        """ Chip column of the center of every pixel. """
+        return self.x0+self.xbin*np.arange(self.columns)+(self.xbin-1)/2
+
+    @property
+    def y_axis(self):
+        return self.y0+self.ybin*np.arange(self.rows)+(self.ybin-1)/2
+
+    def rect(self):
+        """ (x, y, width, height) covered on the chip, e.g. for ImageItem.setRect. """
+        return (self.x0,self.y0,self.columns*self.xbin,self.rows*self.ybin)
+
+
+# PIXIS-XO 400B, full chip in spectrum mode
+FULL_CHIP = FrameGeometry(0,1340,0,400,1,400)
+
+
+def frameGeometry(cam):
+    """ Geometry of cam, FULL_CHIP for cameras that don't publish one (e.g. a simulation without ROI). """
+    getter = getattr(cam,"getGeometry",None)
+    if getter is None:
+        return FULL_CHIP
+    try:
+        return getter()
+    except Exception as e:
+        logger.warning("Could not read the camera ROI, assuming the full chip: {}".format(e))
+        return FULL_CHIP
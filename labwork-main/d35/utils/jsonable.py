@@ -0,0 +1,18 @@
+"""
+Conversion of numpy values for the JSON files (journals, cache keys).
+"""
+import numpy as np
+
+
+def jsonable(value):
+    """ value with numpy arrays and scalars converted to lists and python numbers,
+    tuples to lists and dict keys to str, recursively. """
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,(list,tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value,dict):
+        return {str(k): jsonable(v) for k, v in value.items()}
+    return value
@@ -0,0 +1,134 @@
+"""
+Motion models for the delay and sample stages.
+
+A move is modelled as a trapezoidal velocity profile (accelerate, cruise, brake)
+followed by a fixed settle time, plus a constant per-command overhead that covers
+the serial round trip and controller latency. Distances and velocities are in
+stage units (mm for the long stage and sample stages, um for the piezo).
+
+Models are measured with d35.utils.stageProfiler and stored per device serial
+in MOTION_MODEL_FOLDER, the stage hardware classes load them on open.
+"""
+import os
+import json
+import time
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+MOTION_MODEL_FOLDER = os.path.join(os.path.expanduser("~"),".d35","motion")
+
+
+class MotionModel(object):
+    """ Predicts the time a stage needs to move a given distance and settle on target. """
+
+    def __init__(self,velocity=1.,acceleration=10.,settle=0.,overhead=0.):
+        if velocity <= 0 or acceleration <= 0:
+            raise ValueError("Velocity and acceleration need to be positive.")
+        self.velocity = float(velocity) # units/s
+        self.acceleration = float(acceleration) # units/s^2
+        self.settle = float(settle) # s, time between end of move and on target
+        self.overhead = float(overhead) # s, fixed cost of each move command
+
+    def __repr__(self):
+        return "MotionModel(velocity={:g}, acceleration={:g}, settle={:g}, overhead={:g})".format(
+            self.velocity,self.acceleration,self.settle,self.overhead)
+
+    def moveTime(self,distance):
+        """ Return the time in s to travel distance and settle on target.
+        Accepts scalars or arrays, a zero distance only costs the command overhead. """
+        d = np.abs(np.asarray(distance,dtype=np.double))
+        # Below d_ramp the stage never reaches full speed (triangular profile)
+        d_ramp = self.velocity**2/self.acceleration
+        t = np.where(d<d_ramp,
+            2*np.sqrt(d/self.acceleration),
+            d/self.velocity+self.velocity/self.acceleration)
+        t = np.where(d>0,t+self.settle,0.)
+        t = t+self.overhead
+        if t.ndim == 0:
+            return float(t)
+        return t
+
+    def toDict(self):
+        return dict(velocity=self.velocity,acceleration=self.acceleration,settle=self.settle,overhead=self.overhead)
+
+    @classmethod
+    def fromDict(cls,d):
+        return cls(**{key: d[key] for key in ("velocity","acceleration","settle","overhead") if key in d})
+
+
+# Used whenever nothing better is known about a stage.
+DEFAULT_MOTION_MODEL = MotionModel()
+
+
+def _modelFile(serial,folder=None):
+    if folder is None:
+        folder = MOTION_MODEL_FOLDER
+    return os.path.join(folder,"{}.json".format(serial))
+
+def saveMotionModel(serial,model,folder=None,**info):
+    """ Store the model for the device with the given serial. Additional keyword
+    arguments (e.g. the raw profile) are stored alongside. """
+    path = _modelFile(serial,folder)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    content = dict(serial=str(serial),timestamp=time.time(),model=model.toDict())
+    content.update(info)
+    with open(path,"w") as f:
+        json.dump(content,f,indent=2)
+    logger.info("Saved motion model for {} to {}".format(serial,path))
+    return path
+
+def loadMotionModel(serial,folder=None,default=None):
+    """ Load the model for the device with the given serial, return default if there is none. """
+    if serial is None:
+        return default
+    path = _modelFile(serial,folder)
+    try:
+        with open(path) as f:
+            return MotionModel.fromDict(json.load(f)["model"])
+    except (OSError,KeyError,ValueError):
+        return default
+
+def fitMotionModel(steps,times,overhead=0.):
+    """ Fit velocity, acceleration and settle time to measured move times.
+    steps are the step sizes, times the time from move command to on-target in s.
+    The command overhead can't be separated from the settle time by the fit and
+    needs to be measured independently. """
+    from scipy.optimize import curve_fit
+
+    steps = np.abs(np.asarray(steps,dtype=np.double))
+    times = np.asarray(times,dtype=np.double)
+    def model(d,velocity,acceleration,settle):
+        return MotionModel(velocity,acceleration,settle,overhead).moveTime(d)
+
+    # Initial guess from the largest steps, which are dominated by the velocity
+    big = steps>=np.median(steps)
+    v0 = max(np.mean(steps[big]/np.maximum(times[big]-overhead,1e-6)),1e-6)
+    p0 = [v0,10*v0,max(np.min(times)-overhead,0.)]
+    popt, _ = curve_fit(model,steps,times,p0=p0,bounds=([1e-9,1e-9,0],[np.inf,np.inf,np.inf]),maxfev=10000)
+    return MotionModel(*popt,overhead=overhead)
+
+def waitOnTarget(stage,distance=None,model=None,wait_function=None,timeout=None,start=None):
+    """ Wait until stage reports on target. If a motion model is known (either given
+    or from stage.motionModel) the stage is only queried once the move is predicted
+    to be complete, instead of polling the bus during the whole move. start is the
+    perf_counter time the move command returned, default now; pass it when other
+    work ran between the move command and the wait. """
+    if model is None:
+        model = getattr(stage,"motionModel",None)
+    if start is None:
+        start = time.perf_counter()
+    if model is not None and distance is not None:
+        # the command overhead has already passed when the move command returned
+        predicted = start+model.moveTime(distance)-model.overhead
+        while time.perf_counter()<predicted:
+            if wait_function is not None:
+                wait_function()
+            else:
+                time.sleep(min(1e-3,max(predicted-time.perf_counter(),0)))
+    while not stage.isOnTarget():
+        if timeout is not None and time.perf_counter()-start>timeout:
+            raise TimeoutError
+        if wait_function is not None:
+            wait_function()
@@ -0,0 +1,82 @@
+"""
+Qt-free signals of the hardware classes.
+
+The camera, stage and shutter classes notify their observers with plain
+callbacks, so they run in scripts, worker threads and the control server
+without a QApplication. The API follows pyqtSignal:
+
+    class Stage(object):
+        newPosition = Signal() # float
+
+    stage.newPosition.connect(callback)
+    stage.newPosition.emit(12.5) # calls callback(12.5) in the emitting thread
+
+Callbacks run synchronously in the thread calling emit. A GUI updating widgets
+from them connects through qtSignals.connectQt, which hands the call over to
+the Qt event loop of the GUI thread.
+"""
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BoundSignal(object):
+    """ Signal of one instance, holds the connected callbacks. """
+    __slots__ = ("name","_slots","_lock")
+
+    def __init__(self,name):
+        self.name = name
+        self._slots = () # replaced, never mutated, emit iterates without the lock
+        self._lock = threading.Lock()
+
+    def connect(self,slot):
+        """ Call slot with the arguments of every emit, slot may be another signal. """
+        if isinstance(slot,BoundSignal):
+            slot = slot.emit
+        with self._lock:
+            self._slots = self._slots+(slot,)
+
+    def disconnect(self,slot=None):
+        """ Remove slot, all slots if None. Raises TypeError if slot is not connected, like pyqtSignal. """
+        if isinstance(slot,BoundSignal):
+            slot = slot.emit
+        with self._lock:
+            if slot is None:
+                self._slots = ()
+                return
+            if slot not in self._slots:
+                raise TypeError("{} is not connected to {}".format(slot,self.name))
+            slots = list(self._slots)
+            slots.remove(slot)
+            self._slots = tuple(slots)
+
+    def emit(self,*args):
+        """ Call the connected slots, an exception of a slot is logged and does not reach the emitter. """
+        for slot in self._slots:
+            try:
+                slot(*args)
+            except Exception:
+                logger.exception("Slot of {} failed:".format(self.name))
+
+    def __len__(self):
+        return len(self._slots)
+
+
+class Signal(object):
+    """ Class attribute declaring a signal, instances get their own BoundSignal. """
+
+    def __init__(self,*types):
+        self.types = types # documentation only, emit does not check them
+        self.name = None
+
+    def __set_name__(self,owner,name):
+        self.name = name
+
+    def __get__(self,instance,owner=None):
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            return instance.__dict__.setdefault(self.name,BoundSignal("{}.{}".format(type(instance).__name__,self.name)))
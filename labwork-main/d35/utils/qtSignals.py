@@ -0,0 +1,57 @@
+"""
+Qt adapter of the observer signals for the GUIs.
+
+The hardware classes emit observer.Signal callbacks in the thread that changed
+their state, e.g. the scan worker or the stage move watcher. Widgets must only
+be touched from the GUI thread, connectQt relays the emit through a queued Qt
+signal when it comes from another thread:
+
+    connectQt(self._dev.newPosition,self.updatePos,self)
+"""
+from PyQt5 import QtCore
+import logging
+
+
+class SignalRelay(QtCore.QObject):
+    """ Forwards the emits of an observer signal to slot in the thread of the relay. """
+    fired = QtCore.pyqtSignal(tuple)
+
+    def __init__(self,signal,slot,parent=None):
+        super().__init__(parent)
+        self.signal = signal
+        self.slot = slot
+        self.fired.connect(self._deliver) # queued if post is called from another thread
+        signal.connect(self.post)
+
+    def post(self,*args):
+        try:
+            self.fired.emit(args)
+        except RuntimeError: # deleted together with its parent widget
+            self.detach()
+
+    def _deliver(self,args):
+        self.slot(*args)
+
+    def detach(self):
+        """ Stop relaying the signal. """
+        try:
+            self.signal.disconnect(self.post)
+        except TypeError:
+            pass
+
+
+def connectQt(signal,slot,parent=None):
+    """ Connect slot to the observer signal, slot is called in the GUI thread.
+    The relay lives as long as parent, usually the widget owning slot. """
+    return SignalRelay(signal,slot,parent)
+
+
+class ConsoleWindowLogHandler(logging.Handler, QtCore.QObject):
+    sigLog = QtCore.pyqtSignal(str)
+    def __init__(self):
+        logging.Handler.__init__(self)
+        QtCore.QObject.__init__(self)
+
+    def emit(self, logRecord):
+        message = str(logRecord.getMessage())
+        self.sigLog.emit(message)
@@ -0,0 +1,115 @@
+"""
+Shadow state of the shutter hardware classes.
+
+After a confirmed transition the state is trusted for validity seconds, the
+hardware class returns it without a query and coalesces requests for the state
+the shutter is already in or moving to. A background verifier compares it with
+the hardware every few seconds, which also renews the window. A disagreement,
+or a transition not confirmed within transition_timeout, is stored and raised
+as ShutterStateError by the next checkMismatch.
+
+All fields are read and written while holding lock. The hardware classes pass
+the lock that serialises their device calls, so a verification and a command
+never interleave.
+"""
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ShutterStateError(RuntimeError):
+    """ Raised if the shutter is not in the state the shadow state expects. """
+
+
+class ShadowState(object):
+    """ Last confirmed shutter state, see module doc. Times in s. """
+
+    def __init__(self,validity=1.0,transition_timeout=None,lock=None):
+        self.validity = validity # shadow state is trusted this long after a confirmation
+        self.transition_timeout = transition_timeout # a pending transition older than this is an error, None never
+        self.lock = lock if lock is not None else threading.RLock()
+        self.state = None # last confirmed state
+        self.pending = None # state commanded but not confirmed yet
+        self.confirmed = 0. # perf_counter time the state was last confirmed
+        self.lastCommand = (None,0.) # state and perf_counter time of the last command
+        self.coalesced = 0 # number of requests that didn't need a command
+        self._mismatch = None
+
+    def valid(self):
+        """ True if the state can be used without a query. """
+        with self.lock:
+            return (self.pending is None and self.state is not None
+                and time.perf_counter()-self.confirmed<self.validity)
+
+    def holds(self,state):
+        """ True if the shutter is known to be in state without a query. """
+        with self.lock:
+            return self.valid() and self.state is state
+
+    def needsCommand(self,state):
+        """ False if the shutter is in state or moving to it, the request is counted as coalesced. """
+        with self.lock:
+            if self.pending is state or self.holds(state):
+                self.coalesced += 1
+                return False
+            return True
+
+    def commanded(self,state):
+        with self.lock:
+            self.pending = state
+            self.lastCommand = (state,time.perf_counter())
+
+    def confirm(self,state):
+        """ Take state as confirmed by the hardware, returns True if it changed. """
+        with self.lock:
+            changed = state is not self.state
+            self.state = state
+            self.pending = None
+            self.confirmed = time.perf_counter()
+            return changed
+
+    def observed(self,state):
+        """ State read from the hardware outside a transition. Confirms it if nothing
+        is pending or the pending transition is complete, returns True if confirmed. """
+        with self.lock:
+            if self.pending is None or state is self.pending:
+                self.confirm(state)
+                return True
+            return False
+
+    def checkMismatch(self):
+        """ Raise the ShutterStateError found by the last verification, once. """
+        with self.lock:
+            error, self._mismatch = self._mismatch, None
+        if error is not None:
+            raise error
+
+    def verify(self,query):
+        """ Compare the shadow state with query(), the state reported by the hardware.
+        Returns the ShutterStateError if they disagree, the shadow state then continues
+        from the hardware state. """
+        with self.lock:
+            state = query()
+            if self.pending is not None:
+                if state is self.pending:
+                    self.confirm(state)
+                elif (self.transition_timeout is not None
+                        and time.perf_counter()-self.lastCommand[1]>self.transition_timeout):
+                    return self._mismatchFound(state,"Shutter did not reach {} within {} s".format(
+                        "open" if self.pending else "closed",self.transition_timeout))
+            elif self.state is not None and state is not self.state:
+                return self._mismatchFound(state,"Shutter is {} but expected {}".format(
+                    "open" if state else "closed","open" if self.state else "closed"))
+            else:
+                self.confirmed = time.perf_counter() # renew the validity window
+            return None
+
+    def _mismatchFound(self,state,message):
+        logger.error(message)
+        self._mismatch = ShutterStateError(message)
+        self.state = state
+        self.pending = None
+        self.confirmed = 0.
+        return self._mismatch
@@ -0,0 +1,100 @@
+"""
+Settle-time profiler for the stage hardware classes.
+
+Runs step-size sweeps on a stage and records for every step the time from the
+move command to the stage reporting on target, and the overshoot past the
+target. The sweep is fitted with a MotionModel (see d35.utils.motion) which can
+then be saved per device serial.
+
+Works with any object offering setPosition, getPosition and isOnTarget, i.e.
+PIStageHardware and ThorlabsStageHardware.
+"""
+import time
+import numpy as np
+
+from .motion import fitMotionModel, saveMotionModel
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _waitOnTarget(stage,timeout,wait_function=None):
+    start = time.perf_counter()
+    while not stage.isOnTarget():
+        if time.perf_counter()-start>timeout:
+            raise TimeoutError
+        if wait_function is not None:
+            wait_function()
+
+def measureOverhead(stage,repeats=20):
+    """ Return the median time in s of an on-target query, i.e. the round trip of a
+    single command to the controller. """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        stage.isOnTarget()
+        times.append(time.perf_counter()-t0)
+    return float(np.median(times))
+
+def profileStep(stage,start,step,timeout=30.,trackPosition=True,wait_function=None):
+    """ Move to start, then step and time until the stage is on target.
+    If trackPosition is set, the position is read while moving to determine the
+    overshoot. Note this adds traffic on the bus and slightly inflates the time. """
+    stage.setPosition(start)
+    _waitOnTarget(stage,timeout,wait_function)
+
+    target = start+step
+    direction = np.sign(step) if step != 0 else 1.
+    overshoot = 0.
+    t0 = time.perf_counter()
+    stage.setPosition(target)
+    while not stage.isOnTarget():
+        if trackPosition:
+            overshoot = max(overshoot,(stage.getPosition()-target)*direction)
+        if time.perf_counter()-t0>timeout:
+            raise TimeoutError("Stage did not reach {} within {} s".format(target,timeout))
+        if wait_function is not None:
+            wait_function()
+    elapsed = time.perf_counter()-t0
+    final = stage.getPosition()
+    overshoot = max(overshoot,(final-target)*direction)
+    return dict(start=start,step=step,time=elapsed,overshoot=overshoot,error=final-target)
+
+def profileStage(stage,steps,start=None,repeats=3,**kwargs):
+    """ Run a step-size sweep. Every step size is measured repeats times in both
+    directions, starting from start (default: current position).
+    Returns a list of records as returned by profileStep. """
+    if start is None:
+        start = stage.getPosition()
+    records = []
+    for step in steps:
+        for _ in range(repeats):
+            for signed in (step,-step):
+                rec = profileStep(stage,start,signed,**kwargs)
+                logger.debug("Step {:g}: {:.4f} s, overshoot {:g}".format(signed,rec["time"],rec["overshoot"]))
+                records.append(rec)
+    stage.setPosition(start)
+    return records
+
+def fitProfile(records,overhead=0.):
+    """ Fit a MotionModel to the records of profileStage. """
+    steps = [rec["step"] for rec in records]
+    times = [rec["time"] for rec in records]
+    return fitMotionModel(steps,times,overhead=overhead)
+
+def profileAndSave(stage,steps,serial=None,folder=None,**kwargs):
+    """ Profile the stage, fit and store the motion model under the stage's serial.
+    Returns the model and the raw records. """
+    if serial is None:
+        serial = getattr(stage,"serial",None)
+    if serial is None:
+        raise ValueError("No serial known for stage, pass serial explicitly.")
+    overhead = measureOverhead(stage)
+    records = profileStage(stage,steps,**kwargs)
+    model = fitProfile(records,overhead=overhead)
+    logger.info("Stage {}: {}".format(serial,model))
+    saveMotionModel(serial,model,folder=folder,
+        profile=[{key: float(value) for key, value in rec.items()} for rec in records],
+        max_overshoot=float(max(rec["overshoot"] for rec in records)))
+    stage.motionModel = model
+    return model, records
@@ -0,0 +1,320 @@
+"""
+Streaming HDF5 writer.
+
+All access to the file goes through one background thread, the acquisition only
+puts the data in a bounded queue (put blocks if the writer falls behind by more
+than queue_size items, so memory stays bounded). Datasets are chunked per point,
+i.e. one chunk holds one spectrum or frame of the camera ROI, and resizable
+along the first axis, so a scan can be extended and points are appended as they
+come in. The file is flushed every flush_every writes or flush_interval seconds.
+
+With swmr=True the file is created with libver="latest" and switched to SWMR
+mode by startSWMR(), after that the analysis GUI can open it with
+h5py.File(path,"r",swmr=True) while the scan is running. HDF5 doesn't allow new
+groups, datasets or attributes in SWMR mode, so all datasets have to be created
+before startSWMR(). Attributes set afterwards are kept and written when the file
+is closed.
+
+A writer killed in SWMR mode leaves the file marked as open for writing, HDF5
+refuses to open it again for writing until the flag is cleared. StreamWriter.resume
+clears it with h5clear -s if the HDF5 tools are installed, otherwise it copies
+the flushed data to a new file and continues there.
+
+    writer = StreamWriter(path,swmr=True)
+    writer.createDataset("data/res0",(1340,),grid=(len(delays),))
+    writer.startSWMR()
+    writer.write("data/res0",(n,),spectrum)
+    writer.close()
+"""
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+import h5py
+import numpy as np
+
+from .tracing import traced
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StreamGroup(object):
+    """ A group of a StreamWriter, passed to ScanExecutor.run instead of an h5py group. """
+
+    def __init__(self,writer,name):
+        self.writer = writer
+        self.name = name
+
+    def __repr__(self):
+        return "<StreamGroup {} in {}>".format(self.name,self.writer.filename)
+
+
+class StreamWriter(object):
+    """ Writes to an HDF5 file from a background thread, see module doc. target
+    is a path or an open h5py.File, the latter is not closed by close(). """
+
+    def __init__(self,target,mode="x",queue_size=256,flush_every=50,flush_interval=1.0,swmr=False):
+        if isinstance(target,(h5py.File,h5py.Group)):
+            self.file = target.file
+            self._owned = False
+        else:
+            self.file = h5py.File(target,mode,libver="latest" if swmr else None) # mode "r+" to resume
+            self._owned = True
+        self.filename = self.file.filename
+        self.swmr = swmr
+        self.flush_every = flush_every # writes between flushes
+        self.flush_interval = flush_interval # s, max time unflushed data is kept
+        self.writes = 0
+        self._queue = queue.Queue(queue_size)
+        self._counters = dict() # dataset path -> next index for append
+        self._deferred = [] # (path, attrs) set in SWMR mode, written on close
+        self.onFlush = [] # called on the writer thread after every flush, e.g. to commit a checkpoint
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def resume(cls,path,**kwargs):
+        """ Reopen path with mode "r+" to continue writing, also after a crash
+        (see module doc). The file written to is writer.filename. """
+        try:
+            return cls(path,mode="r+",**kwargs)
+        except OSError as e:
+            logger.warning("Could not reopen {}: {}".format(path,e))
+            error = e
+        if clearStatusFlags(path):
+            return cls(path,mode="r+",**kwargs)
+        try:
+            copy = copyFlushed(path)
+        except OSError:
+            raise error
+        logger.warning("Continuing {} in {}".format(path,copy))
+        return cls(copy,mode="r+",**kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    @property
+    def swmrActive(self):
+        return self.file.swmr_mode
+
+    def _run(self):
+        dirty = 0
+        last_flush = time.perf_counter()
+        while True:
+            timeout = max(self.flush_interval-(time.perf_counter()-last_flush),0) if dirty else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False # interval elapsed, flush
+            if item is None:
+                return
+            if item is not False:
+                func, args, future = item
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    logger.exception("Error writing to {}:".format(self.filename))
+                    if future is not None:
+                        future.set_exception(e)
+                    elif self._error is None:
+                        self._error = e
+                else:
+                    if future is not None:
+                        future.set_result(result)
+                    else:
+                        dirty += 1
+                        self.writes += 1
+            if dirty and (item is False or dirty>=self.flush_every):
+                self._flush()
+                dirty = 0
+                last_flush = time.perf_counter()
+
+    @traced("file.flush")
+    def _flush(self):
+        try:
+            self.file.flush()
+            for callback in self.onFlush:
+                callback()
+        except Exception as e:
+            logger.exception("Could not flush {}:".format(self.filename))
+            self._error = self._error or e
+
+    def _submit(self,func,*args,wait=False):
+        """ Queue func(*args) on the writer thread, wait for and return the result if wait. """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        if self._closed:
+            raise ValueError("Writer for {} is closed".format(self.filename))
+        future = Future() if wait else None
+        self._queue.put((func,args,future))
+        if wait:
+            return future.result()
+
+    def _createDataset(self,path,shape,grid,dtype,fillvalue,attrs):
+        if path in self.file:
+            # file reopened to resume a scan
+            data_set = self.file[path]
+            if data_set.shape[1:] != tuple(grid[1:])+tuple(shape):
+                raise ValueError("{} exists with shape {}, expected {}".format(path,data_set.shape,tuple(grid)+tuple(shape)))
+            return data_set.name
+        data_set = self.file.create_dataset(path,shape=tuple(grid)+tuple(shape),dtype=dtype,
+            maxshape=(None,)+tuple(grid[1:])+tuple(shape) if grid else None,
+            chunks=(1,)*len(grid)+tuple(shape) if grid else None,fillvalue=fillvalue)
+        for key, value in attrs.items():
+            data_set.attrs[key] = value
+        return data_set.name
+
+    def createDataset(self,path,shape,grid=(0,),dtype=np.double,fillvalue=0,attrs=None):
+        """ Create a dataset of grid+shape points, path relative to the file root.
+        shape is the shape of one point, e.g. (width,) of a spectrum, grid the
+        number of points per scan axis, the first one grows as needed. An
+        existing dataset of matching shape is reused. """
+        if self.swmrActive:
+            raise RuntimeError("Can't create {} in SWMR mode, create all datasets before startSWMR()".format(path))
+        name = self._submit(self._createDataset,path,shape,grid,dtype,fillvalue,dict() if attrs is None else attrs,wait=True)
+        self._counters[name] = 0
+        return name
+
+    def group(self,path,attrs=None):
+        """ Create (if needed) and return the StreamGroup path. """
+        def create():
+            group = self.file.require_group(path)
+            for key, value in (attrs or dict()).items():
+                group.attrs[key] = value
+            return group.name
+        return StreamGroup(self,self._submit(create,wait=True))
+
+    def writeDataset(self,path,data,attrs=None):
+        """ Write a complete array, e.g. a background taken before the scan. """
+        data = np.asarray(data)
+        name = self.createDataset(path,data.shape[1:],grid=data.shape[:1],dtype=data.dtype,attrs=attrs)
+        self.write(name,slice(None),data)
+        return name
+
+    @traced("file.write")
+    def _write(self,path,index,data):
+        data_set = self.file[path]
+        first = index[0] if isinstance(index,tuple) else index
+        if isinstance(first,(int,np.integer)) and first>=data_set.shape[0]:
+            data_set.resize(first+1,axis=0)
+        data_set[index] = data
+
+    def write(self,path,index,data):
+        """ Queue data for data_set[index], blocks while the queue is full. """
+        self._submit(self._write,path,index,data)
+
+    def append(self,path,data):
+        """ Queue data as the next point along the first axis. """
+        name = path if path.startswith("/") else "/"+path
+        index = self._counters.get(name,0)
+        self._counters[name] = index+1
+        self.write(name,index,data)
+        return index
+
+    def _setAttrs(self,path,attrs):
+        if self.file.swmr_mode:
+            self._deferred.append((path,attrs))
+            return
+        for key, value in attrs.items():
+            self.file[path].attrs[key] = value
+
+    def setAttrs(self,path,**attrs):
+        """ Set attributes of path, in SWMR mode they are written on close. """
+        self._submit(self._setAttrs,path,attrs)
+
+    def startSWMR(self):
+        """ Switch to SWMR mode, readers can open the file from now on. """
+        if not self.swmr or self.swmrActive:
+            return
+        def start():
+            self.file.flush()
+            self.file.swmr_mode = True
+        self._submit(start,wait=True)
+        logger.info("{} open for SWMR readers".format(self.filename))
+
+    def call(self,func,*args):
+        """ Queue func(*args) on the writer thread, after the data queued so far. """
+        self._submit(func,*args)
+
+    def getAttrs(self,path):
+        """ Return the attributes of path as a dict. """
+        return self._submit(lambda: dict(self.file[path].attrs),wait=True)
+
+    def flush(self):
+        """ Write all queued data and flush the file. """
+        self._submit(self._flush,wait=True)
+
+    def close(self):
+        """ Write the queued data, stop the thread and close the file if owned.
+        An owned file is closed even if a write failed, the error is raised afterwards. """
+        if self._closed:
+            return
+        error = None
+        try:
+            self.flush()
+        except Exception as e:
+            error = e # a stored write error, the queued data is still written below
+        finally:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        try:
+            if self._deferred:
+                if not self._owned:
+                    logger.warning("Attributes set in SWMR mode are lost for {}, the file is not owned by the writer".format(self.filename))
+                else:
+                    self.file.close()
+                    self.file = h5py.File(self.filename,"r+")
+                    for path, attrs in self._deferred:
+                        for key, value in attrs.items():
+                            self.file[path].attrs[key] = value
+                    self._deferred = []
+        finally:
+            if self._owned:
+                self.file.close()
+        error = error or self._error
+        self._error = None
+        if error is not None:
+            raise error
+
+
+def clearStatusFlags(path):
+    """ Clear the flags a crashed writer left in the superblock with h5clear -s,
+    returns False if h5clear is not installed or failed. """
+    h5clear = shutil.which("h5clear")
+    if h5clear is None:
+        return False
+    result = subprocess.run([h5clear,"-s",path],stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    if result.returncode != 0:
+        logger.warning("h5clear failed on {}: {}".format(path,result.stdout.strip()))
+        return False
+    logger.info("Cleared the status flags of {}".format(path))
+    return True
+
+
+def copyFlushed(path):
+    """ Copy the data flushed to path by a crashed SWMR writer to a new file
+    next to it, returns the new path. """
+    base, ext = os.path.splitext(path)
+    copy = base+"_resumed"+ext
+    n = 1
+    while os.path.exists(copy):
+        n += 1
+        copy = "{}_resumed{}{}".format(base,n,ext)
+    with h5py.File(path,"r",swmr=True) as source, h5py.File(copy,"x",libver="latest") as target:
+        for key, value in source.attrs.items():
+            target.attrs[key] = value
+        for name in source:
+            source.copy(source[name],target,name=name)
+    return copy
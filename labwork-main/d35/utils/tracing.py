@@ -0,0 +1,196 @@
+"""
+Span tracing for the hardware classes and the scans.
+
+Calls of the camera, picam, stage and shutter methods and the steps of the scan
+executor are recorded as spans: name, start, duration, thread and the point of
+the scan (step) they belong to. The spans go into a fixed size ring of numpy
+arrays, recording one costs about a microsecond and nothing is allocated, so
+tracing stays on during measurements. When the ring is full the oldest spans
+are overwritten.
+
+    @traced("camera.grabFrame")
+    def grabFrame(self,timeout=0): ...
+
+    with tracer.span("scan.move"):
+        ...
+
+    mark = tracer.mark()
+    ... # run a scan
+    logger.info(tracer.formatSummary(mark)) # duration histogram per span name
+    tracer.export("scan.trace.json",mark)   # open in chrome://tracing or ui.perfetto.dev
+
+The executor sets tracer.point to the step of the point it acquires, spans
+default to it. Decoding and storing on the worker threads pass the step of
+their point, file writes get the point acquired while they ran.
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# histogram bin edges of formatSummary in s
+BINS = (1e-5,1e-4,1e-3,1e-2,1e-1,1.)
+BIN_LABELS = ("<10us","<100us","<1ms","<10ms","<100ms","<1s",">=1s")
+
+
+class _Span(object):
+    __slots__ = ("tracer","name","point","start")
+
+    def __init__(self,tracer,name,point):
+        self.tracer = tracer
+        self.name = name
+        self.point = point
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self,*args):
+        self.tracer.record(self.name,self.start,time.perf_counter_ns()-self.start,self.point)
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer(object):
+    """ Ring of the last capacity spans, see module doc. Times are
+    time.perf_counter_ns, i.e. monotonic. """
+
+    def __init__(self,capacity=2**16,enabled=True):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.point = -1 # step of the scan point being acquired, -1 outside of scans
+        self._start = np.zeros(capacity,dtype=np.int64)
+        self._duration = np.zeros(capacity,dtype=np.int64)
+        self._name = np.zeros(capacity,dtype=np.int16)
+        self._thread = np.zeros(capacity,dtype=np.int16)
+        self._point = np.zeros(capacity,dtype=np.int32)
+        self._written = 0 # spans recorded since the start, the ring holds the last capacity
+        self.names = [] # span names, indexed by _name
+        self._nameIds = dict()
+        self.threads = [] # thread names, indexed by _thread
+        self._threadIds = dict()
+        self._lock = threading.Lock()
+
+    def _id(self,table,ids,key,label):
+        n = ids.get(key)
+        if n is None:
+            with self._lock:
+                n = ids.setdefault(key,len(table))
+                if n == len(table):
+                    table.append(label)
+        return n
+
+    def span(self,name,point=None):
+        """ Context manager recording the time spent in it as name, point
+        defaults to tracer.point. """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self,name,point)
+
+    def record(self,name,start,duration,point=None):
+        """ Record a span, start and duration in ns of perf_counter_ns. """
+        name_id = self._id(self.names,self._nameIds,name,name)
+        ident = threading.get_ident()
+        thread_id = self._threadIds.get(ident)
+        if thread_id is None:
+            thread_id = self._id(self.threads,self._threadIds,ident,threading.current_thread().name)
+        with self._lock:
+            n = self._written%self.capacity
+            self._written += 1
+            self._start[n] = start
+            self._duration[n] = duration
+            self._name[n] = name_id
+            self._thread[n] = thread_id
+            self._point[n] = self.point if point is None else point
+
+    def mark(self):
+        """ Position in the ring, pass it as since to get only the spans recorded later. """
+        return self._written
+
+    def clear(self):
+        with self._lock:
+            self._written = 0
+
+    def spans(self,since=None):
+        """ (start, duration, name, thread, point) arrays of the spans recorded
+        after since (a mark, default all) and still in the ring, oldest first. """
+        with self._lock:
+            written = self._written
+            first = max(since or 0,written-self.capacity)
+            if since is not None and since<first:
+                logger.warning("Trace ring overflowed, {} spans lost".format(first-since))
+            order = np.arange(first,written)%self.capacity
+            return (self._start[order],self._duration[order],self._name[order],
+                self._thread[order],self._point[order])
+
+    def summary(self,since=None):
+        """ {name: dict(count, total, median, p95, max, histogram)} with times in s,
+        histogram the counts in the BINS of durations. """
+        start, duration, names, threads, points = self.spans(since)
+        summary = dict()
+        for name_id in np.unique(names):
+            durations = duration[names == name_id]*1e-9
+            summary[self.names[name_id]] = dict(count=len(durations),total=float(durations.sum()),
+                median=float(np.median(durations)),p95=float(np.percentile(durations,95)),max=float(durations.max()),
+                histogram=np.bincount(np.searchsorted(BINS,durations,side="right"),minlength=len(BIN_LABELS)).tolist())
+        return summary
+
+    def formatSummary(self,since=None):
+        """ Table of summary, slowest total first. """
+        summary = self.summary(since)
+        if not summary:
+            return "No spans recorded"
+        width = max(len(name) for name in summary)
+        lines = ["{:<{}} {:>7} {:>9} {:>9} {:>9} {:>9}  ".format("span",width,"count","total s","median ms","p95 ms","max ms")
+            +" ".join("{:>6}".format(label) for label in BIN_LABELS)]
+        for name, s in sorted(summary.items(),key=lambda item: -item[1]["total"]):
+            lines.append("{:<{}} {:>7d} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}  ".format(name,width,s["count"],s["total"],
+                s["median"]*1e3,s["p95"]*1e3,s["max"]*1e3)+" ".join("{:>6d}".format(n) for n in s["histogram"]))
+        return "\n".join(lines)
+
+    def events(self,since=None):
+        """ The spans as Chrome trace events (complete events, times in us). """
+        start, duration, names, threads, points = self.spans(since)
+        pid = os.getpid()
+        events = [dict(name="thread_name",ph="M",pid=pid,tid=n,args=dict(name=name)) for n, name in enumerate(self.threads)]
+        for t, d, name_id, thread_id, point in zip((start//1000).tolist(),(duration/1000.).tolist(),names.tolist(),threads.tolist(),points.tolist()):
+            name = self.names[name_id]
+            events.append(dict(name=name,cat=name.split(".")[0],ph="X",ts=t,dur=d,pid=pid,tid=thread_id,args=dict(point=point)))
+        return events
+
+    def export(self,path,since=None):
+        """ Write the spans as Chrome trace JSON, which Perfetto reads as well. """
+        with open(path,"w") as f:
+            json.dump(dict(traceEvents=self.events(since),displayTimeUnit="ms"),f)
+        logger.info("Trace written to {}".format(path))
+
+
+tracer = Tracer() # shared by the instrumented classes
+
+def traced(name):
+    """ Decorator recording every call of the function as a span name of tracer. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not tracer.enabled:
+                return func(*args,**kwargs)
+            with _Span(tracer,name,None):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
@@ -12,8 +12,9 @@ import logging
 logger=logging.getLogger(__name__)
 
 from ..utils.widgets import LabviewQDoubleSpinBox
-from ..utils.definitions import ConsoleWindowLogHandler
+from ..utils.qtSignals import ConsoleWindowLogHandler, connectQt
 from ..utils.functions import axes_to_rect
+from ..utils.frameGeometry import FULL_CHIP, frameGeometry
 
 from .xuvcamera import XUVCamera, logger
 
@@ -69,13 +70,14 @@ class XUVCameraGui(QtWidgets.QMainWindow):
         self.pltImageView.setLabel('left','Y')
         self.pltImageView.setLabel('bottom','X')
 
-        self.pltImage = ImageItem(np.random.normal(size=(1340,400)))
+        self.geometry = FULL_CHIP # updated from the camera once connected
+        self.pltImage = ImageItem(np.zeros(self.geometry.frame_shape[::-1]))
         self.pltImageView.addItem(self.pltImage)
         
         # Add colorBar to plot
         # Note: We set the initial value to (100,1800) as these were the limits
         # in the LabView program. Adjust accordingly.
-        self.pltImageView.addColorBar( self.pltImage, values=(100,1800), colorMap='cet-r4', limits=(0,2**16-1)) # , interactive=False)
+        self.pltImageView.addColorBar( self.pltImage, values=(100,1800), colorMap='CET-R4', limits=(0,2**16-1)) # , interactive=False)
 
         #self.ImageRoi = pg.ROI([0, 0], [1340, 400], maxBounds=QtCore.QRect(0,0,1340,400), rotatable=False, pen=pg.mkPen('r', width=3))  # (1,9))
         #self.ImageRoi.sigRegionChangeFinished.connect(self._roi_update)  
@@ -141,14 +143,17 @@ class XUVCameraGui(QtWidgets.QMainWindow):
         self.previewStop.clicked.connect(self.stop)
 
     def _registerSignals(self):
-        self.dev.tempUpdated.connect(self.temperatureChanged)
-        self.dev.spectrumReady.connect(self.updateSpectrum)
-        self.dev.imageReady.connect(self.updateImage)
-        self.dev.acquisitionStarted.connect(self.interfaceLocked)
-        self.dev.acquisitionFinished.connect(self.interfaceUnlocked)
-        self.dev.acquisitionStopped.connect(self.interfaceUnlocked)
-        self.dev.previewStopped.connect(self.cancelPreview)
-        self.dev.previewFinished.connect(self.cancelPreview)
+        self.geometryChanged(frameGeometry(self.dev))
+        if hasattr(self.dev,"geometryChanged"):
+            connectQt(self.dev.geometryChanged,self.geometryChanged,self)
+        connectQt(self.dev.tempUpdated,self.temperatureChanged,self)
+        connectQt(self.dev.spectrumReady,self.updateSpectrum,self)
+        connectQt(self.dev.imageReady,self.updateImage,self)
+        connectQt(self.dev.acquisitionStarted,self.interfaceLocked,self)
+        connectQt(self.dev.acquisitionFinished,self.interfaceUnlocked,self)
+        connectQt(self.dev.acquisitionStopped,self.interfaceUnlocked,self)
+        connectQt(self.dev.previewStopped,self.cancelPreview,self)
+        connectQt(self.dev.previewFinished,self.cancelPreview,self)
 
     def _setState(self,text):
         self.cameraStateText.setText(text)
@@ -165,8 +170,14 @@ class XUVCameraGui(QtWidgets.QMainWindow):
         self.count_history[-1] = counts
         self.pltCounts.setData(x=np.arange(len(self.count_history)),y=self.count_history)
 
+    def geometryChanged(self,geometry):
+        self.geometry = geometry
+        self.pltImage.setImage(np.zeros(geometry.frame_shape[::-1]),autoRange=False,autoLevels=False)
+        self.pltImage.setRect(QtCore.QRectF(*geometry.rect()))
+
     def updateSpectrum(self,spectrum):
-        self.pltSpectrum.setData(x=np.arange(len(spectrum)),y=spectrum)
+        x = self.geometry.x_axis if len(spectrum) == self.geometry.columns else np.arange(len(spectrum))
+        self.pltSpectrum.setData(x=x,y=spectrum)
         self.updateCounts(np.mean(spectrum))
 
     def updateImage(self,image):
@@ -177,6 +188,8 @@ class XUVCameraGui(QtWidgets.QMainWindow):
         self.updateSpectrum(np.mean(image,axis=0))
 
     def getRect(self,shape):
+        if shape == self.geometry.frame_shape[::-1]:
+            return QtCore.QRectF(*self.geometry.rect()) # binned pixels cover several chip pixels
         return QtCore.QRectF(self.cameraROILeft.value(),self.cameraROIBottom.value(),shape[0],shape[1])
 
     def interfaceLocked(self):
@@ -103,6 +103,7 @@ import os
 import ctypes
 import numpy as np
 from .picam_types import *
+from ..utils.tracing import traced
 
 import logging
 
@@ -487,6 +488,7 @@ class picam():
 
     # this function has to be called once all configurations
     # are done to apply settings to the camera
+    @traced("picam.sendConfiguration")
     def sendConfiguration(self):
         """This function has to be called once all configurations are done to apply settings to the camera.
         """
@@ -572,6 +574,7 @@ class picam():
     # readNFrames waits till all frames have been collected (using Picam_Acquire)
     # N = number of frames
     # timeout = max wait time between frames in ms or -1 for no timeout
+    @traced("picam.readNFrames")
     def readNFrames(self, N=1, timeout=-1):
         """This function acquires N frames using Picam_Acquire. It waits till all frames have been collected before it returns.
 
@@ -605,12 +608,15 @@ class picam():
         self.status(self.lib.Picam_IsAcquisitionRunning(self.cam, ptr(running)))
         return running
     
+    @traced("picam.startAcquisition")
     def startAcquisition(self):
         return self.lib.Picam_StartAcquisition(self.cam)
 
+    @traced("picam.stopAcquisition")
     def stopAcquisition(self):
         self.lib.Picam_StopAcquisition(self.cam)
 
+    @traced("picam.waitForFrame")
     def waitForFrame(self,timeout=0,frames=1):
         available = PicamAvailableData()
         status = PicamAcquisitionStatus()
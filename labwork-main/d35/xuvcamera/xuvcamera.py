@@ -1,5 +1,3 @@
-from PyQt5 import QtCore
-
 from .picam import picam, PicamErrorLookup
 
 import numpy as np
@@ -8,27 +6,32 @@ import logging
 logger=logging.getLogger(__name__)
 
 from ..utils.definitions import AcquisitionContext
+from ..utils.observer import Signal
+from ..utils.frameGeometry import FrameGeometry
+from ..utils.tracing import traced
 
-class XUVCamera(QtCore.QObject):
+class XUVCamera(object):
     """ Wrapper class for PiCam, offers convenience functions to underlying library API """
 
-    tempUpdated = QtCore.pyqtSignal(float)
+    tempUpdated = Signal(float)
+
+    spectrumReady = Signal(np.ndarray)
+    spectrumFinished = Signal()
+    imageReady = Signal(np.ndarray)
+    imageFinished = Signal()
 
-    spectrumReady = QtCore.pyqtSignal(np.ndarray)
-    spectrumFinished = QtCore.pyqtSignal()
-    imageReady = QtCore.pyqtSignal(np.ndarray)
-    imageFinished = QtCore.pyqtSignal()
+    acquisitionStarted = Signal()
+    acquisitionStopped = Signal()
+    acquisitionFinished = Signal()
 
-    acquisitionStarted = QtCore.pyqtSignal()
-    acquisitionStopped = QtCore.pyqtSignal()
-    acquisitionFinished = QtCore.pyqtSignal()
+    previewStarted = Signal()
+    previewStopped = Signal()
+    previewFinished = Signal()
 
-    previewStarted = QtCore.pyqtSignal()
-    previewStopped = QtCore.pyqtSignal()
-    previewFinished = QtCore.pyqtSignal()
 
+    errorLogged = Signal(str)
 
-    errorLogged = QtCore.pyqtSignal(str)
+    geometryChanged = Signal(object) # FrameGeometry
 
     def __init__(self,cam=None) -> None:
         
@@ -48,8 +51,11 @@ class XUVCamera(QtCore.QObject):
 
         # initialize library
         # The library is initialized on import. Could consider importing here instead of at module level
-        self.cam= picam()
-        self.cam.loadLibrary()
+        if cam is None:
+            self.cam= picam()
+            self.cam.loadLibrary()
+        else:
+            self.cam = cam # another backend, e.g. simulation.SimulatedPicam
         
     def add_logger(self):
         self.logger = logger
@@ -118,14 +124,26 @@ class XUVCamera(QtCore.QObject):
     def setROI(self,x0, w, y0, h, xbin=1, ybin=1):
         self.cam.setROI(x0, w, xbin, y0, h, self._imageBin(ybin,h)) # call signature of picam.py
         self._tainted = True
+        self.geometryChanged.emit(self.getGeometry())
 
     def getROI(self):
         return self.cam.getROI()
 
+    def getGeometry(self):
+        """ FrameGeometry of the readout, from the ROI picam.updateROIS sized the buffers with. """
+        rois = getattr(self.cam,"ROIS",[]) # set by picam.updateROIS
+        if len(rois)>1:
+            logger.warning("{} ROIs set, only the first one is used".format(len(rois)))
+        geometry = FrameGeometry.fromROI(self.getROI())
+        if rois and tuple(rois[0][:2]) != (geometry.columns,geometry.rows):
+            raise ValueError("ROI {} does not match the readout size {}".format(geometry,rois[0][:2]))
+        return geometry
+
     def setFullChip(self):
         w = self.cam.getParameter("ActiveWidth")
         h = self.cam.getParameter("ActiveHeight")
         self.cam.setROI(0,w,1,0,h,self._imageBin())
+        self.geometryChanged.emit(self.getGeometry())
 
     def setImageMode(self,state):
         if not state == self._imageMode:
@@ -148,6 +166,7 @@ class XUVCamera(QtCore.QObject):
         return self.cam.getParameter("ReadoutCount")
 
 
+    @traced("camera.checkAcquisition")
     def checkAcquisition(self):
         """ Return True if camera is ready to acquire image """
         if self.cam.isAcquisitionRunning():
@@ -168,11 +187,13 @@ class XUVCamera(QtCore.QObject):
             return False  
         return True
 
+    @traced("camera.commit")
     def commit(self):
         if self._tainted:
             self.cam.sendConfiguration()
             self._tainted = False
 
+    @traced("camera.getFrame")
     def getFrame(self,nframes=1,timeout=-1):
         """ Starts exposure for one frame/nframes and then stops. 
         Function will block until Acquisition is finished. """
@@ -192,6 +213,7 @@ class XUVCamera(QtCore.QObject):
             self.imageReady.emit(res[0][-1,:])
         return res[0]
 
+    @traced("camera.startFrame")
     def startFrame(self,nframes=1):
         """ Starts a continous acquisition. 
         Function will start acquisition and returns True if succesfull. Status needs to be polled. """
@@ -205,6 +227,7 @@ class XUVCamera(QtCore.QObject):
             return False
         return True
 
+    @traced("camera.grabFrame")
     def grabFrame(self,timeout=0):
         """ Return all frames in buffer. If no frame remains in buffer, will return None."""
         err, res = self.waitOnFrame(timeout=timeout)
@@ -216,12 +239,14 @@ class XUVCamera(QtCore.QObject):
                 self.imageReady.emit(res[0][-1,:])
         return err, res
 
+    @traced("camera.clearFrames")
     def clearFrames(self):
         """ Under certain circumstances it might be better to keep the camera in acquisition when changing experimental parameters (eg time-delay, open/close shutter)
         instead of stopping and setting up an acquisition (this will be true for very short exposurs). The frames taken between then need to be disregarded, which this method is suppose to achieve """
         while self.waitOnFrame()[1] is not None:
             pass
 
+    @traced("camera.clearAcquisition")
     def clearAcquisition(self):
         for _ in range(5):
             err, _ = self.waitOnFrame()
@@ -233,6 +258,7 @@ class XUVCamera(QtCore.QObject):
     def waitOnFrame(self,timeout=0,frames=1):
         return self.cam.waitForFrame(timeout=timeout,frames=frames)
 
+    @traced("camera.stopFrame")
     def stopFrame(self):
         return self.cam.stopAcquisition()
 
@@ -47,7 +47,8 @@ setup(
     },
     packages=find_packages(include=['d35*']),
     install_requires=dep_base+dep_pyqt5+dep_hardware,
-    entry_points={'gui_scripts':['plotGasTransients=d35.collections.plotGasTransients:main',]}
+    entry_points={'gui_scripts':['plotGasTransients=d35.collections.plotGasTransients:main',],
+        'console_scripts':['batchFitGasTransients=d35.collections.batchFit:main',]}
     #extras_require={
     #    'devio-full':dep_devio_extra,
     #}
@@ -2,67 +2,247 @@
 This class controls a Thorlabs SC10 shutter controller through a serial connection.
 
 Jonathan Van Schenck, 11/14/18
+
+The SC10 echoes every command, followed by the reply (queries only) and the
+prompt "> ". Responses are read until the prompt instead of reading fixed sizes,
+so a framing mismatch can't stall the port for the full timeout. Setting the
+shutter sends the toggle and the confirming query in one write, the state is
+tracked locally and only verified against the controller when it is older than
+verify_interval.
+
+AsyncSC10 offers the same protocol on top of AsyncSerial.AsyncSerialTransport
+for use from asyncio coroutines.
 """
 import serial
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+PROMPT = b'> '
+
+
+class SC10Error(IOError):
+    """
+    Raised if the SC10 does not answer or answers with an unexpected response
+    """
+
+
+def parseResponse(command,data):
+    """
+    strips echo and prompt from a response frame and returns the reply
+    """
+    if not data.endswith(PROMPT):
+        raise SC10Error("No prompt after command {!r}, got {!r}".format(command,data))
+    data = data[:-len(PROMPT)]
+    echo = command.encode()+b'\r'
+    if data.startswith(echo):
+        data = data[len(echo):]
+    reply = data.strip(b'\r\n ').decode()
+    if reply.startswith('Command error') or reply.startswith('CMD_NOT_DEFINED'):
+        raise SC10Error("{} returned {!r}".format(command,reply))
+    return reply
+
+
 class SC10:
-    def __init__(self,comport='COM9'):
+    PROMPT = PROMPT
+    # SC10 operating modes, see manual p. 14
+    MODE_MANUAL = 1
+    MODE_AUTO = 2
+    MODE_SINGLE = 3
+    MODE_REPEAT = 4
+    MODE_EXTERNAL = 5
+
+    def __init__(self,comport='COM9',baudrate=9600,timeout=1,mode=MODE_MANUAL,verify_interval=1.0,ser=None):
         """
         Initialized hardware with a closed shutter
         """
-        self.ser = serial.Serial(comport,9600,timeout=1,parity=serial.PARITY_NONE,stopbits=serial.STOPBITS_ONE,bytesize=serial.EIGHTBITS)
-        jump = self.ser.write("mode=0\r".encode())
-        self.ser.read(size=jump+2)
+        if ser is None:
+            ser = serial.Serial(comport,baudrate,timeout=timeout,parity=serial.PARITY_NONE,stopbits=serial.STOPBITS_ONE,bytesize=serial.EIGHTBITS)
+        self.ser = ser
+        self.verify_interval = verify_interval # s, age after which the local state is re-read
+        self._lock = threading.RLock() # one command/response exchange at a time
+        self._state = None # local copy of the shutter state, True if open
+        self._verified = 0. # time the local state was last confirmed by the controller
+        self._latency = dict() # command -> deque of round trip times in s
+        self.ser.reset_input_buffer()
+        self.setMode(mode)
         # if self.qopenShutter():
         #    self.toggleShutter()
-        
+
+    def _readResponse(self,command):
+        """
+        reads one response up to the prompt and returns the reply without echo and prompt
+        """
+        return parseResponse(command,self.ser.read_until(self.PROMPT))
+
+    def command(self,*commands):
+        """
+        sends one or more commands in a single write and returns the list of replies
+        """
+        with self._lock:
+            start = time.perf_counter()
+            self.ser.write(''.join(c+'\r' for c in commands).encode())
+            replies = [self._readResponse(c) for c in commands]
+            elapsed = time.perf_counter()-start
+        self._latency.setdefault('+'.join(commands),deque(maxlen=1000)).append(elapsed)
+        return replies
+
+    def query(self,command):
+        """
+        sends a query, e.g. 'ens?', and returns the reply
+        """
+        return self.command(command)[0]
+
+    def setMode(self,mode):
+        """
+        sets the operating mode, 1: manual, 2: auto, 3: single, 4: repeat, 5: external gate
+        """
+        self.command("mode={:d}".format(mode))
+        if mode != getattr(self,'mode',mode):
+            self._state = None # in the other modes the shutter moves on its own
+        self.mode = mode
+
+    def _updateState(self,reply):
+        if reply == '1':
+            self._state = True
+        elif reply == '0':
+            self._state = False
+        else:
+            raise SC10Error("Unexpected shutter state {!r}".format(reply))
+        self._verified = time.perf_counter()
+        return self._state
+
     def toggleShutter(self):
         """
         toggles the state of the shutter
         """
-        jump = self.ser.write('ens\r'.encode())
-        self.ser.read(size=jump+2)
-        
+        self.command('ens')
+        if self._state is not None:
+            self._state = not self._state
+
     def qopenShutter(self):
         """
         Checks if shutter is open
         """
-        jump = self.ser.write('ens?\r'.encode())
-        # print(jump)
-        self.ser.read(size=jump)
-        res = self.ser.read()
-        self.ser.read(size=3)
-        res = b'1'
-        if  res == b'1':
-            return True
-        elif res == b'0':
-            return False
-        else:
-            print('Something\'s amiss, closing serial connection...')
-            self.shutdown()
-    
+        return self._updateState(self.query('ens?'))
+
     def qcloseShutter(self):
         """
         checks if shutter is closed
         """
         return not self.qopenShutter()
-    
+
+    def isOpen(self,max_age=None):
+        """
+        returns the locally tracked state, it is verified with the controller if it is older than max_age (default verify_interval)
+        """
+        if max_age is None:
+            max_age = self.verify_interval
+        if self._state is None or time.perf_counter()-self._verified>max_age:
+            return self.qopenShutter()
+        return self._state
+
+    def setShutter(self,state):
+        """
+        opens (True) or closes (False) the shutter. Toggle and confirmation query are sent in one go.
+        """
+        if self.isOpen() is bool(state):
+            return self._state
+        _, reply = self.command('ens','ens?')
+        if self._updateState(reply) is not bool(state):
+            raise SC10Error("Shutter did not change state")
+        return self._state
+
     def openShutter(self):
         """
         opens shutter, if closed
         """
-        if not self.qopenShutter():
-            self.toggleShutter()
-    
+        self.setShutter(True)
+
     def closeShutter(self):
         """
         closes shutter if opened
         """
-        if self.qopenShutter():
-            self.toggleShutter()
-        
+        self.setShutter(False)
+
+    def latencyStatistics(self):
+        """
+        returns round trip statistics in ms for each command (or pipelined command group)
+        """
+        stats = dict()
+        for key, times in self._latency.items():
+            t = np.array(times)*1000
+            stats[key] = dict(n=len(t),mean=float(np.mean(t)),median=float(np.median(t)),p95=float(np.percentile(t,95)),max=float(np.max(t)))
+        return stats
+
     def shutdown(self):
         """
-        closes the serial connection. MUST EXICUTED BEFORE CALLING ANOTHER 
+        closes the serial connection. MUST EXICUTED BEFORE CALLING ANOTHER
         INSTANCE OF THIS CLASS, otherwise you need restart your kernel.
         """
         self.ser.close()
+
+
+class AsyncSC10:
+    """
+    SC10 protocol for asyncio, create with
+        shutter = await AsyncSC10.open('COM9')
+    """
+    MODE_MANUAL = SC10.MODE_MANUAL
+    MODE_EXTERNAL = SC10.MODE_EXTERNAL
+
+    def __init__(self,transport,verify_interval=1.0,timeout=1.0):
+        self.transport = transport
+        self.verify_interval = verify_interval
+        self.timeout = timeout
+        self._state = None
+        self._verified = 0.
+
+    @classmethod
+    async def open(cls,comport='COM9',baudrate=9600,mode=SC10.MODE_MANUAL,**kwargs):
+        from AsyncSerial import AsyncSerialTransport
+        transport = await AsyncSerialTransport.open(comport,baudrate,terminator=PROMPT).start()
+        self = cls(transport,**kwargs)
+        await self.setMode(mode)
+        return self
+
+    async def command(self,*commands):
+        frames = await self.transport.request(''.join(c+'\r' for c in commands).encode(),responses=len(commands),timeout=self.timeout)
+        return [parseResponse(c,f) for c, f in zip(commands,frames)]
+
+    async def query(self,command):
+        return (await self.command(command))[0]
+
+    async def setMode(self,mode):
+        await self.command("mode={:d}".format(mode))
+        self.mode = mode
+
+    def _updateState(self,reply):
+        if reply not in ('0','1'):
+            raise SC10Error("Unexpected shutter state {!r}".format(reply))
+        self._state = reply == '1'
+        self._verified = time.perf_counter()
+        return self._state
+
+    async def qopenShutter(self):
+        return self._updateState(await self.query('ens?'))
+
+    async def isOpen(self,max_age=None):
+        if max_age is None:
+            max_age = self.verify_interval
+        if self._state is None or time.perf_counter()-self._verified>max_age:
+            return await self.qopenShutter()
+        return self._state
+
+    async def setShutter(self,state):
+        if await self.isOpen() is bool(state):
+            return self._state
+        _, reply = await self.command('ens','ens?')
+        if self._updateState(reply) is not bool(state):
+            raise SC10Error("Shutter did not change state")
+        return self._state
+
+    async def shutdown(self):
+        await self.transport.close()